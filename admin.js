@@ -259,6 +259,141 @@ tagExplanation.innerHTML = `
 document.getElementById('updateTagsForm').insertBefore(tagExplanation, document.getElementById('updateTagsForm').firstChild);
 
 
+// Retention policies, kept for filling the form when one is edited
+let retentionPolicies = [];
+
+function resetPolicyForm() {
+    document.getElementById('policyId').value = '';
+    document.getElementById('policyName').value = '';
+    document.getElementById('policyPattern').value = '*';
+    document.getElementById('policyHostTags').value = '';
+    document.getElementById('policyRetention').value = '';
+    document.getElementById('policyPriority').value = 0;
+}
+
+function editPolicy(policyId) {
+    const policy = retentionPolicies.find(p => p.id === policyId);
+    if (!policy) {
+        return;
+    }
+    document.getElementById('policyId').value = policy.id;
+    document.getElementById('policyName').value = policy.name;
+    document.getElementById('policyPattern').value = policy.metric_pattern;
+    document.getElementById('policyHostTags').value = Object.keys(policy.host_tags).length ? JSON.stringify(policy.host_tags) : '';
+    document.getElementById('policyRetention').value = JSON.stringify(policy.retention);
+    document.getElementById('policyPriority').value = policy.priority;
+}
+
+async function deletePolicy(policyId) {
+    if (!confirm('Are you sure you want to delete this retention policy?')) {
+        return;
+    }
+    try {
+        const response = await fetch('/admin/retention_policies', {
+            method: 'DELETE',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ id: policyId }),
+        });
+
+        if (response.ok) {
+            fetchRetentionPolicies();
+        } else {
+            const errorData = await response.json();
+            alert(`Failed to delete retention policy: ${errorData.error}`);
+        }
+    } catch (error) {
+        console.error('Error deleting retention policy:', error);
+        alert('An error occurred while deleting the retention policy');
+    }
+}
+
+// Function to fetch retention policies and populate the table
+async function fetchRetentionPolicies() {
+    try {
+        const response = await fetch('/admin/retention_policies');
+        if (response.ok) {
+            retentionPolicies = await response.json();
+            const table = document.getElementById('retentionPoliciesTable');
+            table.innerHTML = '';
+            retentionPolicies.forEach(policy => {
+                const row = document.createElement('tr');
+                [policy.name, policy.metric_pattern, JSON.stringify(policy.host_tags),
+                 JSON.stringify(policy.retention), policy.priority].forEach(value => {
+                    const cell = document.createElement('td');
+                    cell.textContent = value;
+                    row.appendChild(cell);
+                });
+                const actions = document.createElement('td');
+                const editButton = document.createElement('button');
+                editButton.className = 'btn btn-sm btn-secondary me-1';
+                editButton.textContent = 'Edit';
+                editButton.addEventListener('click', () => editPolicy(policy.id));
+                const deleteButton = document.createElement('button');
+                deleteButton.className = 'btn btn-sm btn-danger';
+                deleteButton.textContent = 'Delete';
+                deleteButton.addEventListener('click', () => deletePolicy(policy.id));
+                actions.appendChild(editButton);
+                actions.appendChild(deleteButton);
+                row.appendChild(actions);
+                table.appendChild(row);
+            });
+        } else {
+            console.error('Failed to fetch retention policies');
+        }
+    } catch (error) {
+        console.error('Error fetching retention policies:', error);
+    }
+}
+
+document.getElementById('newPolicyButton').addEventListener('click', resetPolicyForm);
+
+// Event listener for saving a retention policy
+document.getElementById('retentionPolicyForm').addEventListener('submit', async (event) => {
+    event.preventDefault();
+    const policyId = document.getElementById('policyId').value;
+    const hostTags = document.getElementById('policyHostTags').value;
+    let policy;
+    try {
+        policy = {
+            name: document.getElementById('policyName').value,
+            metric_pattern: document.getElementById('policyPattern').value,
+            host_tags: hostTags ? JSON.parse(hostTags) : {},
+            retention: JSON.parse(document.getElementById('policyRetention').value),
+            priority: parseInt(document.getElementById('policyPriority').value, 10) || 0
+        };
+    } catch (error) {
+        alert(`Invalid JSON format: ${error.message}`);
+        return;
+    }
+    if (policyId) {
+        policy.id = parseInt(policyId, 10);
+    }
+
+    try {
+        const response = await fetch('/admin/retention_policies', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(policy),
+        });
+
+        if (response.ok) {
+            alert('Retention policy saved; it applies from the next aggregation run');
+            resetPolicyForm();
+            fetchRetentionPolicies();
+        } else {
+            const errorData = await response.json();
+            alert(`Failed to save retention policy: ${errorData.error}`);
+        }
+    } catch (error) {
+        console.error('Error saving retention policy:', error);
+        alert('An error occurred while saving the retention policy');
+    }
+});
+
 // Initialize the page
 document.addEventListener('DOMContentLoaded', () => {
     // Fetch metrics for the initially selected host
@@ -266,4 +401,5 @@ document.addEventListener('DOMContentLoaded', () => {
     if (initialHostname) {
         fetchMetricsForHost(initialHostname);
     }
+    fetchRetentionPolicies();
 });
\ No newline at end of file
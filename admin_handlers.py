@@ -1,15 +1,15 @@
 import json
 import logging
 from auth_handlers import BaseHandler
+from retention import parse_policy
 
 logger = logging.getLogger(__name__)
 
 class FetchClientIdsHandler(BaseHandler):
     async def get(self):
         try:
-            with self.db.get_cursor() as cursor:
-                cursor.execute("SELECT client_id FROM client_configs")
-                client_ids = [row['client_id'] for row in cursor.fetchall()]
+            rows = await self.db.fetchall("SELECT client_id FROM client_configs")
+            client_ids = [row['client_id'] for row in rows]
             self.write(json.dumps(client_ids))
         except Exception as e:
             logger.error(f"Error in FetchClientIdsHandler: {str(e)}")
@@ -17,11 +17,10 @@ class FetchClientIdsHandler(BaseHandler):
             self.write({"error": "Internal server error"})
 
 class AdminInterfaceHandler(BaseHandler):
-    def get(self):
+    async def get(self):
         try:
-            with self.db.get_cursor() as cursor:
-                cursor.execute("SELECT hostname FROM hosts")
-                hosts = [row['hostname'] for row in cursor.fetchall()]
+            rows = await self.db.fetchall("SELECT hostname FROM hosts")
+            hosts = [row['hostname'] for row in rows]
             self.render("admin_interface.html", hosts=hosts)
         except Exception as e:
             logger.error(f"Error in AdminInterfaceHandler: {str(e)}")
@@ -29,7 +28,7 @@ class AdminInterfaceHandler(BaseHandler):
             self.write({"error": "Internal server error"})
 
 class UpdateClientHandler(BaseHandler):
-    def post(self):
+    async def post(self):
         data = json.loads(self.request.body)
         client_id = data.get('client_id')
         hostname = data.get('hostname')
@@ -41,13 +40,12 @@ class UpdateClientHandler(BaseHandler):
             return
 
         try:
-            with self.db.get_cursor() as cursor:
-                cursor.execute("""
-                    INSERT INTO client_configs (client_id, hostname, config)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (client_id) DO UPDATE
-                    SET hostname = EXCLUDED.hostname, config = EXCLUDED.config, last_updated = NOW()
-                """, (client_id, hostname, json.dumps(config)))
+            await self.db.execute("""
+                INSERT INTO client_configs (client_id, hostname, config)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (client_id) DO UPDATE
+                SET hostname = EXCLUDED.hostname, config = EXCLUDED.config, last_updated = NOW()
+            """, (client_id, hostname, json.dumps(config)))
             self.write({"message": "Client configuration updated successfully"})
         except Exception as e:
             logger.error(f"Error updating client configuration: {str(e)}")
@@ -56,7 +54,7 @@ class UpdateClientHandler(BaseHandler):
 
 
 class UploadMetricHandler(BaseHandler):
-    def post(self):
+    async def post(self):
         data = json.loads(self.request.body)
         metric_name = data.get('name')
         metric_code = data.get('code')
@@ -68,16 +66,80 @@ class UploadMetricHandler(BaseHandler):
             return
 
         try:
-            with self.db.get_cursor() as cursor:
-                cursor.execute("""
-                    INSERT INTO metric_scripts (name, code, tags)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (name) DO UPDATE
-                    SET code = EXCLUDED.code, tags = EXCLUDED.tags
-                """, (metric_name, metric_code, json.dumps(tags)))
+            await self.db.execute("""
+                INSERT INTO metric_scripts (name, code, tags)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (name) DO UPDATE
+                SET code = EXCLUDED.code, tags = EXCLUDED.tags
+            """, (metric_name, metric_code, json.dumps(tags)))
 
             self.write({"message": f"Metric '{metric_name}' uploaded successfully"})
         except Exception as e:
             logger.error(f"Error uploading metric: {str(e)}")
             self.set_status(500)
-            self.write({"message": "Internal server error"})
\ No newline at end of file
+            self.write({"message": "Internal server error"})
+
+class RetentionPolicyHandler(BaseHandler):
+    async def get(self):
+        try:
+            rows = await self.db.fetchall("""
+                SELECT id, name, metric_pattern, host_tags, retention, priority
+                FROM retention_policies
+                ORDER BY priority DESC, id
+            """)
+            self.write(json.dumps([dict(row) for row in rows]))
+        except Exception as e:
+            logger.error(f"Error in RetentionPolicyHandler GET: {str(e)}")
+            self.set_status(500)
+            self.write({"error": "Internal server error"})
+
+    async def post(self):
+        try:
+            data = json.loads(self.request.body)
+            policy = parse_policy(data)
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"error": str(e)})
+            return
+
+        try:
+            params = (policy['name'], policy['metric_pattern'], json.dumps(policy['host_tags']),
+                      json.dumps(policy['retention']), policy['priority'])
+            if data.get('id'):
+                updated = await self.db.execute("""
+                    UPDATE retention_policies
+                    SET name = %s, metric_pattern = %s, host_tags = %s, retention = %s, priority = %s
+                    WHERE id = %s
+                """, params + (data['id'],))
+                if updated == 0:
+                    self.set_status(404)
+                    self.write({"error": "Retention policy not found"})
+                    return
+                policy_id = data['id']
+            else:
+                row = await self.db.fetchone("""
+                    INSERT INTO retention_policies (name, metric_pattern, host_tags, retention, priority)
+                    VALUES (%s, %s, %s, %s, %s)
+                    RETURNING id
+                """, params)
+                policy_id = row['id']
+            self.write({"status": "success", "id": policy_id})
+        except Exception as e:
+            logger.error(f"Error in RetentionPolicyHandler POST: {str(e)}")
+            self.set_status(500)
+            self.write({"error": "Internal server error"})
+
+    async def delete(self):
+        try:
+            data = json.loads(self.request.body)
+            deleted = await self.db.execute("DELETE FROM retention_policies WHERE id = %s", (data['id'],))
+            if deleted == 0:
+                self.set_status(404)
+                self.write({"error": "Retention policy not found"})
+                return
+
+            self.write({"status": "success"})
+        except Exception as e:
+            logger.error(f"Error in RetentionPolicyHandler DELETE: {str(e)}")
+            self.set_status(500)
+            self.write({"error": "Internal server error"})
@@ -7,13 +7,11 @@ logger = logging.getLogger(__name__)
 class AlertConfigHandler(BaseHandler):
     async def get(self):
         try:
-            with self.db.get_cursor() as cursor:
-                cursor.execute("""
-                    SELECT a.id, h.hostname, a.metric_name, a.condition, a.threshold, a.duration, a.enabled
-                    FROM alerts a
-                    JOIN hosts h ON a.host_id = h.id
-                """)
-                alerts = cursor.fetchall()
+            alerts = await self.db.fetchall("""
+                SELECT a.id, h.hostname, a.metric_name, a.condition, a.threshold, a.duration, a.enabled
+                FROM alerts a
+                JOIN hosts h ON a.host_id = h.id
+            """)
 
             result = [dict(a) for a in alerts]
             self.write(json.dumps(result))
@@ -25,20 +23,11 @@ class AlertConfigHandler(BaseHandler):
     async def post(self):
         try:
             data = json.loads(self.request.body)
-            with self.db.get_cursor() as cursor:
-                cursor.execute("SELECT id FROM hosts WHERE hostname = %s", (data['hostname'],))
-                host = cursor.fetchone()
-                if not host:
-                    self.set_status(404)
-                    self.write({"error": "Host not found"})
-                    return
-
-                cursor.execute("""
-                    INSERT INTO alerts (host_id, metric_name, condition, threshold, duration, enabled)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    RETURNING id
-                """, (host['id'], data['metric_name'], data['condition'], data['threshold'], data['duration'], True))
-                alert_id = cursor.fetchone()['id']
+            alert_id = await self.db.run(self.insert_alert, data)
+            if alert_id is None:
+                self.set_status(404)
+                self.write({"error": "Host not found"})
+                return
 
             self.write({"status": "success", "id": alert_id})
         except Exception as e:
@@ -46,15 +35,27 @@ class AlertConfigHandler(BaseHandler):
             self.set_status(500)
             self.write({"error": "Internal server error"})
 
+    def insert_alert(self, cursor, data):
+        cursor.execute("SELECT id FROM hosts WHERE hostname = %s", (data['hostname'],))
+        host = cursor.fetchone()
+        if not host:
+            return None
+
+        cursor.execute("""
+            INSERT INTO alerts (host_id, metric_name, condition, threshold, duration, enabled)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING id
+        """, (host['id'], data['metric_name'], data['condition'], data['threshold'], data['duration'], True))
+        return cursor.fetchone()['id']
+
     async def delete(self):
         try:
             data = json.loads(self.request.body)
-            with self.db.get_cursor() as cursor:
-                cursor.execute("DELETE FROM alerts WHERE id = %s", (data['id'],))
-                if cursor.rowcount == 0:
-                    self.set_status(404)
-                    self.write({"error": "Alert not found"})
-                    return
+            deleted = await self.db.execute("DELETE FROM alerts WHERE id = %s", (data['id'],))
+            if deleted == 0:
+                self.set_status(404)
+                self.write({"error": "Alert not found"})
+                return
 
             self.write({"status": "success"})
         except Exception as e:
@@ -66,12 +67,11 @@ class AlertStateHandler(BaseHandler):
     async def post(self):
         try:
             data = json.loads(self.request.body)
-            with self.db.get_cursor() as cursor:
-                cursor.execute("UPDATE alerts SET enabled = %s WHERE id = %s", (data['enabled'], data['id']))
-                if cursor.rowcount == 0:
-                    self.set_status(404)
-                    self.write({"error": "Alert not found"})
-                    return
+            updated = await self.db.execute("UPDATE alerts SET enabled = %s WHERE id = %s", (data['enabled'], data['id']))
+            if updated == 0:
+                self.set_status(404)
+                self.write({"error": "Alert not found"})
+                return
 
             self.write({"status": "success"})
         except Exception as e:
@@ -101,9 +101,7 @@ class RecentAlertsHandler(BaseHandler):
             query += " ORDER BY ah.timestamp DESC LIMIT %s"
             params.append(limit)
 
-            with self.db.get_cursor() as cursor:
-                cursor.execute(query, params)
-                recent_alerts = cursor.fetchall()
+            recent_alerts = await self.db.fetchall(query, params)
 
             result = [
                 {
@@ -0,0 +1,267 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from partitions import DAY
+from tsdb import Block, MAX_TICKS, MIN_TICKS, from_ticks, to_ticks
+
+logger = logging.getLogger(__name__)
+
+def series_key(series_ids):
+    """Short name for a set of series (all when None), recorded for the days archived for them."""
+    if series_ids is None:
+        return 'all'
+    return hashlib.sha1(','.join(str(series_id) for series_id in sorted(series_ids)).encode()).hexdigest()[:16]
+
+def _series_points(chunks):
+    # Lists of rows ordered by series id and timestamp, regrouped into one list of
+    # (ticks, value, message) per series
+    current, points = None, []
+    for chunk in chunks:
+        for series_id, timestamp, value, message in chunk:
+            if series_id != current:
+                if points:
+                    yield current, points
+                current, points = series_id, []
+            points.append((to_ticks(timestamp), value, message))
+    if points:
+        yield current, points
+
+class Archive:
+    """Raw points past retention, kept on local disk as one compressed block per day.
+
+    Blocks use the embedded store's chunk format (tsdb.Block). manifest.json lists
+    the archived days and the days found empty, and series.json names the series
+    ids in them, so an archive can be read without the database. Only the
+    aggregation job writes to it; every server process can read it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.days = {}  # day start -> manifest entry
+        self.empty_days = {}  # day start -> keys of the series that had no points that day
+        self.manifest_mtime = None
+        self.blocks = {}  # block name -> open Block
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if name.endswith('.tmp'):
+                # Left by an export interrupted before its rename
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+        with self.lock:
+            self._load()
+        logger.info(f"Opened archive at {self.path}: {len(self.days)} days")
+
+    def _load(self):
+        # Picks up days exported by another process; caller holds self.lock
+        path = os.path.join(self.path, 'manifest.json')
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.manifest_mtime:
+            return
+        with open(path) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.days = {int(day): entry for day, entry in manifest['days'].items()}
+        self.empty_days = {int(day): keys for day, keys in manifest.get('empty_days', {}).items()}
+        self.manifest_mtime = mtime
+        current = {entry['block'] for entry in self.days.values()}
+        self.blocks = {name: block for name, block in self.blocks.items() if name in current}
+
+    def _block(self, name):
+        block = self.blocks.get(name)
+        if block is None:
+            block = self.blocks[name] = Block(os.path.join(self.path, name))
+        return block
+
+    def _write_json(self, name, data):
+        tmp_path = os.path.join(self.path, name + '.tmp')
+        with open(tmp_path, 'w') as json_file:
+            json.dump(data, json_file, sort_keys=True)
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        os.rename(tmp_path, os.path.join(self.path, name))
+
+    def start(self):
+        """Start of the oldest archived day, or None when the archive is empty."""
+        with self.lock:
+            self._load()
+            return min(self.days) if self.days else None
+
+    def end(self):
+        """End of the newest archived day, or None when the archive is empty."""
+        with self.lock:
+            self._load()
+            return max(self.days) + DAY if self.days else None
+
+    def first_timestamp(self, series_ids):
+        """Oldest archived timestamp of the given series, None when none of them is archived."""
+        with self.lock:
+            self._load()
+            blocks = [self._block(entry['block']) for _, entry in sorted(self.days.items())]
+        for block in blocks:
+            firsts = [block.series[series_id][2] for series_id in series_ids if series_id in block.series]
+            if firsts:
+                return from_ticks(min(firsts))
+        return None
+
+    def read(self, series_ids, start=None, end=None):
+        """Archived points of the given series (all when None) in [start, end], ordered by timestamp."""
+        with self.lock:
+            self._load()
+            blocks = [self._block(entry['block']) for day, entry in sorted(self.days.items())
+                      if (start is None or day + DAY > start) and (end is None or day <= end)]
+        start_ticks = to_ticks(start) if start is not None else MIN_TICKS
+        end_ticks = to_ticks(end) if end is not None else MAX_TICKS
+        rows = []
+        for block in blocks:
+            for series_id in (block.series if series_ids is None else series_ids):
+                rows.extend((series_id, from_ticks(ticks), value, message)
+                            for ticks, value, message in block.read_series(series_id, start_ticks, end_ticks))
+        rows.sort(key=lambda row: row[1])
+        return rows
+
+    def read_before(self, series_ids, start, end, firsts):
+        """Archived points read() returns that are older than their series' first point in
+        hot storage, given as {series_id: timestamp}; series missing from it have none there.
+
+        Compared in ticks, as archived timestamps are rounded to them.
+        """
+        limits = {series_id: to_ticks(first) for series_id, first in firsts.items()}
+        return [row for row in self.read(series_ids, start, end)
+                if row[0] not in limits or to_ticks(row[1]) < limits[row[0]]]
+
+    def merge(self, rows, series_ids, start=None, end=None):
+        """Add archived points to rows read from hot storage, which wins on equal timestamps."""
+        archive_end = self.end()
+        if archive_end is None or (start is not None and start >= archive_end):
+            return rows
+        stored = {(row[0], row[1]) for row in rows}
+        archived = [row for row in self.read(series_ids, start, end) if (row[0], row[1]) not in stored]
+        if not archived:
+            return rows
+        return sorted(rows + archived, key=lambda row: row[1])
+
+    def has_day(self, day, key):
+        """Whether the day starting at day was archived for the series named by key."""
+        with self.lock:
+            self._load()
+            keys = self.days.get(day, {}).get('keys', []) + self.empty_days.get(day, [])
+        return key in keys or 'all' in keys
+
+    def _merge(self, old, chunks, stats):
+        # The new points of every series merged into those of the old block, which
+        # win on equal ticks; series only the old block has are copied over
+        old_ids = sorted(old.series) if old else []
+        i = 0
+        for series_id, points in _series_points(chunks):
+            while i < len(old_ids) and old_ids[i] < series_id:
+                yield old_ids[i], old.read_series(old_ids[i], MIN_TICKS, MAX_TICKS)
+                i += 1
+            archived = {}
+            if i < len(old_ids) and old_ids[i] == series_id:
+                archived = {ticks: (value, message)
+                            for ticks, value, message in old.read_series(series_id, MIN_TICKS, MAX_TICKS)}
+                i += 1
+            added = {ticks: (value, message) for ticks, value, message in points if ticks not in archived}
+            if added:
+                stats['added'] += len(added)
+                stats['series'].add(series_id)
+            archived.update(added)
+            yield series_id, [(ticks, value, message) for ticks, (value, message) in sorted(archived.items())]
+        for series_id in old_ids[i:]:
+            yield series_id, old.read_series(series_id, MIN_TICKS, MAX_TICKS)
+
+    def export_day(self, day, chunks, key, name_series):
+        """Archive the points of the day starting at day and record it as archived for key.
+
+        chunks are lists of (series id, timestamp, value, message) rows ordered by
+        series id and timestamp, written out one series at a time. Points already
+        archived for that day are kept. name_series(series_ids) returns the
+        (hostname, metric name, field) of each id. Returns the number of new points.
+        """
+        with self.lock:
+            self._load()
+            entry = self.days.get(day)
+            old = self._block(entry['block']) if entry else None
+        version = entry['version'] + 1 if entry else 1
+        name = f"{time.strftime('%Y%m%d', time.gmtime(day))}.{version}"
+        stats = {'added': 0, 'series': set()}
+        block = Block.write_series(self.path, name, version, self._merge(old, chunks, stats))
+        if block is None and entry is None:
+            # Nothing stored for the day; recorded so it isn't exported again
+            with self.lock:
+                self.empty_days[day] = sorted(set(self.empty_days.get(day, [])) | {key})
+                self._write_manifest()
+            return 0
+        if not stats['added']:
+            # The old block holds every point already; only the key is new
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+            with self.lock:
+                entry = dict(entry, keys=sorted(set(entry.get('keys', [])) | {key}))
+                self.days[day] = entry
+                self._write_manifest()
+            return 0
+
+        series_path = os.path.join(self.path, 'series.json')
+        known = {}
+        if os.path.exists(series_path):
+            with open(series_path) as series_file:
+                known = json.load(series_file)
+        unknown = [series_id for series_id in stats['series'] if str(series_id) not in known]
+        if unknown:
+            known.update({str(series_id): list(names) for series_id, names in name_series(unknown).items()})
+            self._write_json('series.json', known)
+
+        keys = sorted(set(entry.get('keys', [])) | {key}) if entry else [key]
+        with self.lock:
+            self.days[day] = {"block": name, "version": version, "points": block.point_count(),
+                              "series": len(block.series), "bytes": block.size(), "keys": keys}
+            self._write_manifest()
+            self.blocks[name] = block
+            if entry:
+                self.blocks.pop(entry['block'], None)
+        if entry:
+            # Readers still holding the old block keep their mapping
+            shutil.rmtree(os.path.join(self.path, entry['block']), ignore_errors=True)
+        return stats['added']
+
+    def _write_manifest(self):
+        # Caller holds self.lock
+        self._write_json('manifest.json', {"days": {str(d): e for d, e in sorted(self.days.items())},
+                                           "empty_days": {str(d): k for d, k in sorted(self.empty_days.items())}})
+        self.manifest_mtime = os.stat(os.path.join(self.path, 'manifest.json')).st_mtime_ns
+
+    def get_stats(self):
+        with self.lock:
+            self._load()
+            days = dict(self.days)
+        return {
+            "days": len(days),
+            "points": sum(entry['points'] for entry in days.values()),
+            "bytes": sum(entry['bytes'] for entry in days.values()),
+            "first_day": min(days) if days else None,
+            "last_day": max(days) if days else None
+        }
+
+archive = None
+
+def init_archive(config):
+    global archive
+    if config.get('enabled', False):
+        archive = Archive(config.get('path', 'archive'))
+        archive.open()
+    return archive
+
+def get_archive():
+    return archive
@@ -1,6 +1,8 @@
 import bcrypt
+import tornado.ioloop
 import tornado.web
 from database import get_db
+from storage import get_storage
 import logging
 
 logger = logging.getLogger(__name__)
@@ -8,6 +10,7 @@ logger = logging.getLogger(__name__)
 class BaseHandler(tornado.web.RequestHandler):
     def initialize(self):
         self.db = get_db()
+        self.storage = get_storage()
 
     def get_current_user(self):
         user_id = self.get_secure_cookie("user")
@@ -35,12 +38,12 @@ class LoginHandler(tornado.web.RequestHandler):
     async def check_credentials(self, username, password):
         db = get_db()
         try:
-            with db.get_cursor() as cursor:
-                cursor.execute("SELECT id, password FROM users WHERE username = %s", (username,))
-                user = cursor.fetchone()
+            user = await db.fetchone("SELECT id, password FROM users WHERE username = %s", (username,))
 
-                if user and bcrypt.checkpw(password.encode('utf-8'), user['password'].encode('utf-8')):
-                    return user
+            # bcrypt is deliberately slow; keep it off the IOLoop
+            if user and await tornado.ioloop.IOLoop.current().run_in_executor(
+                    None, bcrypt.checkpw, password.encode('utf-8'), user['password'].encode('utf-8')):
+                return user
         except Exception as e:
             logger.error(f"Database error during login: {e}")
         return None
@@ -49,7 +52,7 @@ class RegisterHandler(tornado.web.RequestHandler):
     def get(self):
         self.render("register.html")
 
-    def post(self):
+    async def post(self):
         username = self.get_argument("username", "")
         password = self.get_argument("password", "")
         confirm_password = self.get_argument("confirm_password", "")
@@ -58,26 +61,25 @@ class RegisterHandler(tornado.web.RequestHandler):
             self.write("Passwords do not match")
             return
 
-        if self.username_exists(username):
+        if await self.username_exists(username):
             self.write("Username already exists")
             return
 
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        hashed_password = await tornado.ioloop.IOLoop.current().run_in_executor(
+            None, bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt())
 
         db = get_db()
-        with db.get_cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO users (username, password) VALUES (%s, %s)",
-                (username, hashed_password.decode('utf-8'))
-            )
+        await db.execute(
+            "INSERT INTO users (username, password) VALUES (%s, %s)",
+            (username, hashed_password.decode('utf-8'))
+        )
 
         self.redirect("/login")
 
-    def username_exists(self, username):
+    async def username_exists(self, username):
         db = get_db()
-        with db.get_cursor() as cursor:
-            cursor.execute("SELECT 1 FROM users WHERE username = %s", (username,))
-            return cursor.fetchone() is not None
+        row = await db.fetchone("SELECT 1 FROM users WHERE username = %s", (username,))
+        return row is not None
 
 class LogoutHandler(BaseHandler):
     def get(self):
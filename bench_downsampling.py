@@ -0,0 +1,89 @@
+import argparse
+import logging
+import random
+import time
+from downsampling import downsample_rows, numpy, select, MODES
+from series import assemble_history
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SERIES_ID = 1
+
+def synthetic_rows(points, spikes, seed):
+    """One series sampled every second: a noisy random walk with a few one-point spikes."""
+    rng = random.Random(seed)
+    start = time.time() - points
+    value = 50.0
+    rows = []
+    for i in range(points):
+        value += rng.gauss(0, 0.5)
+        rows.append((SERIES_ID, start + i, value, None))
+    spike_times = set()
+    for i in rng.sample(range(1, points - 1), spikes):
+        _, timestamp, value, message = rows[i]
+        rows[i] = (SERIES_ID, timestamp, value + rng.choice((-1, 1)) * 1000, message)
+        spike_times.add(timestamp)
+    return rows, spike_times
+
+def stride(history, target_points):
+    # The history handler's sampling before the downsample modes
+    if len(history) <= target_points:
+        return history
+    sampled = []
+    step = len(history) / target_points
+    index = 0
+    while index < len(history):
+        sampled.append(history[int(index)])
+        index += step
+    return sampled
+
+def to_history(rows):
+    return assemble_history([{'field': 'value', 'timestamp': timestamp, 'value': value, 'message': message}
+                             for _, timestamp, value, message in rows])
+
+def best_of(runs, fn):
+    best = None
+    result = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Time history downsampling on a synthetic series and count "
+                                                 "how many of its spikes each mode keeps.")
+    parser.add_argument('--points', type=int, default=1000000)
+    parser.add_argument('--target-points', type=int, default=500)
+    parser.add_argument('--spikes', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=3, help="Runs per mode; the fastest is reported")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if numpy is None:
+        logger.error("numpy is not installed; the downsample modes need it")
+        return
+
+    rows, spike_times = synthetic_rows(args.points, args.spikes, args.seed)
+    start = rows[0][1]
+    end = rows[-1][1] + 1
+    timestamps = numpy.array([row[1] for row in rows])
+    values = numpy.array([row[2] for row in rows])
+    logger.info(f"{args.points} points, {args.spikes} spikes, target_points={args.target_points}")
+
+    # End to end from storage rows to the response's point list, like the handler
+    elapsed, history = best_of(args.runs, lambda: stride(to_history(rows), args.target_points))
+    kept = sum(1 for point in history if point['timestamp'] in spike_times)
+    print(f"stride: {elapsed * 1000:.1f} ms, {len(history)} points, {kept}/{args.spikes} spikes")
+    for mode in MODES:
+        elapsed, history = best_of(args.runs, lambda: to_history(
+            downsample_rows(rows, mode, args.target_points, start, end)))
+        kernel, _ = best_of(args.runs, lambda: select(mode, timestamps, values, args.target_points, start, end))
+        kept = sum(1 for point in history if point['timestamp'] in spike_times)
+        print(f"{mode}: {elapsed * 1000:.1f} ms ({kernel * 1000:.1f} ms on arrays), "
+              f"{len(history)} points, {kept}/{args.spikes} spikes")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import argparse
+import json
+import random
+import time
+import logging
+from psycopg2 import sql
+from psycopg2.extras import execute_values, RealDictCursor
+from database import init_db, get_db, load_config
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Indexes added by the schema migrations; dropped inside the benchmark transaction for the "before" plans
+MIGRATION_INDEXES = [
+    'idx_alerts_host_metric',
+    'idx_downtimes_host_time',
+    'idx_alert_history_timestamp',
+    'idx_alert_history_host_timestamp',
+    'idx_points_timestamp_brin',
+]
+
+def hot_queries(cursor):
+    """The read paths the indexes are meant for, with parameters taken from the data present."""
+    cursor.execute("""
+        SELECT h.id AS host_id, h.hostname, s.metric_name, COUNT(*) AS points
+        FROM points p
+        JOIN series s ON p.series_id = s.id
+        JOIN hosts h ON s.host_id = h.id
+        GROUP BY h.id, h.hostname, s.metric_name
+        ORDER BY points DESC
+        LIMIT 1
+    """)
+    busiest = cursor.fetchone()
+    if not busiest:
+        return []
+    now = time.time()
+    host_ids = [busiest['host_id']]
+
+    return [
+        ("history", """
+            SELECT s.field, p.timestamp, p.value, p.message
+            FROM points p
+            JOIN series s ON p.series_id = s.id
+            JOIN hosts h ON s.host_id = h.id
+            WHERE h.hostname = %s AND s.metric_name = %s AND p.timestamp BETWEEN %s AND %s
+            ORDER BY p.timestamp
+        """, (busiest['hostname'], busiest['metric_name'], now - 86400, now)),
+        ("latest", """
+            SELECT h.hostname, s.metric_name, s.field, l.value
+            FROM metrics_latest l
+            JOIN series s ON l.series_id = s.id
+            JOIN hosts h ON s.host_id = h.id
+        """, None),
+        ("ingest downtimes", """
+            SELECT host_id, start_time, end_time FROM downtimes
+            WHERE host_id = ANY(%s) AND start_time <= %s AND end_time >= %s
+        """, (host_ids, now, now - 60)),
+        ("ingest alerts", """
+            SELECT * FROM alerts WHERE host_id = ANY(%s) AND enabled = TRUE
+        """, (host_ids,)),
+        ("recent alerts (all hosts)", """
+            SELECT ah.id, h.hostname, a.metric_name, ah.timestamp, ah.value
+            FROM alert_history ah
+            JOIN alerts a ON ah.alert_id = a.id
+            JOIN hosts h ON ah.host_id = h.id
+            ORDER BY ah.timestamp DESC LIMIT 50
+        """, None),
+        ("recent alerts (one host)", """
+            SELECT ah.id, h.hostname, a.metric_name, ah.timestamp, ah.value
+            FROM alert_history ah
+            JOIN alerts a ON ah.alert_id = a.id
+            JOIN hosts h ON ah.host_id = h.id
+            WHERE h.hostname = %s
+            ORDER BY ah.timestamp DESC LIMIT 50
+        """, (busiest['hostname'],)),
+        ("retention range", """
+            SELECT COUNT(*) FROM points WHERE timestamp < %s
+        """, (now - 7 * 86400,)),
+    ]
+
+def seed(cursor, rows):
+    """Add synthetic alerts, downtimes and alert history for the hosts present."""
+    cursor.execute("SELECT id FROM hosts")
+    host_ids = [row['id'] for row in cursor.fetchall()]
+    if not host_ids:
+        return
+    now = time.time()
+    alert_rows = execute_values(cursor, """
+        INSERT INTO alerts (host_id, metric_name, condition, threshold, duration)
+        VALUES %s RETURNING id, host_id
+    """, [(host_id, f"bench.metric_{i}", 'above', 90, 0) for host_id in host_ids for i in range(5)], fetch=True)
+    execute_values(cursor, "INSERT INTO downtimes (host_id, start_time, end_time) VALUES %s",
+                   [(random.choice(host_ids), start, start + 3600)
+                    for start in (now - random.uniform(0, 365 * 86400) for _ in range(rows))])
+    execute_values(cursor, "INSERT INTO alert_history (host_id, alert_id, timestamp, value) VALUES %s",
+                   [(alert['host_id'], alert['id'], now - random.uniform(0, 365 * 86400), json.dumps(95.0))
+                    for alert in (random.choice(alert_rows) for _ in range(rows))], page_size=10000)
+
+def scans(node):
+    """Scan nodes of a JSON plan, e.g. 'Index Scan using idx_x on alerts'."""
+    found = []
+    if 'Relation Name' in node:
+        index = f" using {node['Index Name']}" if 'Index Name' in node else ''
+        found.append(f"{node['Node Type']}{index} on {node['Relation Name']}")
+    for child in node.get('Plans', []):
+        found.extend(scans(child))
+    return found
+
+def explain(cursor, query, params):
+    cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, params)
+    plan = cursor.fetchone()['QUERY PLAN'][0]
+    blocks = plan['Plan'].get('Shared Hit Blocks', 0) + plan['Plan'].get('Shared Read Blocks', 0)
+    return plan['Execution Time'], blocks, scans(plan['Plan'])
+
+def run_plans(cursor, queries, runs):
+    results = {}
+    for name, query, params in queries:
+        explain(cursor, query, params)  # warm the cache
+        results[name] = min(explain(cursor, query, params) for _ in range(runs))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare query plans of the hot queries with and without the migration indexes. "
+                                                 "Everything runs in one rolled-back transaction, but it takes exclusive "
+                                                 "locks, so point it at a test database.")
+    parser.add_argument('--config', default='server_config.json')
+    parser.add_argument('--seed', type=int, default=0, help="Synthetic downtime and alert history rows to add first")
+    parser.add_argument('--runs', type=int, default=5, help="Runs per query; the fastest is reported")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    init_db(config['database'])
+    db = get_db()
+    try:
+        with db.connection() as conn:
+            try:
+                cursor = conn.cursor(cursor_factory=RealDictCursor)
+                if args.seed:
+                    seed(cursor, args.seed)
+                for table in ('points', 'series', 'metrics_latest', 'alerts', 'downtimes', 'alert_history'):
+                    cursor.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+
+                queries = hot_queries(cursor)
+                if not queries:
+                    logger.error("No points found; ingest some data or run simulator.py first")
+                    return
+
+                after = run_plans(cursor, queries, args.runs)
+                for index in MIGRATION_INDEXES:
+                    cursor.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(index)))
+                before = run_plans(cursor, queries, args.runs)
+
+                for name, _, _ in queries:
+                    before_ms, before_blocks, before_scans = before[name]
+                    after_ms, after_blocks, after_scans = after[name]
+                    speedup = before_ms / after_ms if after_ms else float('inf')
+                    print(f"{name}: {before_ms:.3f} ms / {before_blocks} blocks -> "
+                          f"{after_ms:.3f} ms / {after_blocks} blocks ({speedup:.1f}x)")
+                    print(f"    before: {', '.join(before_scans)}")
+                    print(f"    after:  {', '.join(after_scans)}")
+            finally:
+                conn.rollback()
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import sqlite3
 import json
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -1,4 +1,5 @@
 import asyncio
+import json
 import logging
 from config_manager import ConfigManager
 from metric_collector import MetricCollector
@@ -17,8 +18,9 @@ class MonitoringClient:
         self.network_manager = NetworkManager(self.config_manager)
         self.buffer_manager = BufferManager(self.config_manager)
 
-        # Assign metric_collector to config_manager for consistency
+        # Assign metric_collector and buffer_manager to config_manager for consistency
         self.config_manager.metric_collector = self.metric_collector
+        self.config_manager.buffer_manager = self.buffer_manager
 
     async def run(self):
         while True:
@@ -44,12 +46,17 @@ class MonitoringClient:
                     }
                     await self.network_manager.send_metrics(data_to_send)
 
-                # Try to send any buffered metrics
+                # Try to send any buffered metrics, oldest first; stop at the first
+                # failure so an overloaded server isn't hit with the whole backlog
                 buffered_metrics = self.buffer_manager.get_all()
-                for buffered_metric in buffered_metrics:
-                    success = await self.network_manager.send_metrics(buffered_metric)
-                    if success:
-                        self.buffer_manager.remove(buffered_metric['id'])
+                if len(buffered_metrics) > 1 and self.network_manager.can_send_batch():
+                    await self.send_buffered_batches(buffered_metrics)
+                else:
+                    for buffer_id, buffered_data, _ in buffered_metrics:
+                        success = await self.network_manager.send_metrics(json.loads(buffered_data), buffer_on_failure=False)
+                        if not success:
+                            break
+                        self.buffer_manager.remove([buffer_id])
 
                 elapsed_time = asyncio.get_event_loop().time() - start_time
                 sleep_time = max(0, self.metric_collector.get_shortest_interval() - elapsed_time)
@@ -66,6 +73,17 @@ class MonitoringClient:
                 logger.error(f"Error in main loop: {e}", exc_info=True)
                 await asyncio.sleep(60)  # Wait for 1 minute before retrying
 
+    async def send_buffered_batches(self, buffered_metrics, batch_size=500):
+        # Replay the buffer through /metrics/batch instead of one request per snapshot
+        for start in range(0, len(buffered_metrics), batch_size):
+            chunk = buffered_metrics[start:start + batch_size]
+            done = await self.network_manager.send_metrics_batch([json.loads(data) for _, data, _ in chunk])
+            if done is None:
+                break
+            self.buffer_manager.remove([chunk[index][0] for index in done])
+            if len(done) < len(chunk):
+                break
+
 
 async def main():
     client = MonitoringClient()
@@ -20,9 +20,8 @@ class ClientConfigHandler(BaseHandler):
             return
 
         try:
-            with self.db.get_cursor() as cursor:
-                cursor.execute("SELECT config, last_updated FROM client_configs WHERE client_id = %s", (client_id,))
-                result = cursor.fetchone()
+            result = await self.db.fetchone(
+                "SELECT config, last_updated FROM client_configs WHERE client_id = %s", (client_id,))
 
             if result:
                 config, last_updated = result['config'], result['last_updated']
@@ -56,45 +55,48 @@ class ClientConfigHandler(BaseHandler):
             return
 
         try:
-            with self.db.get_cursor() as cursor:
-                # First, get the current config
-                cursor.execute("SELECT config FROM client_configs WHERE client_id = %s", (client_id,))
-                result = cursor.fetchone()
-
-                if result:
-                    current_config = json.loads(result['config'])
-
-                    # Merge new config with current config
-                    self.merge_configs(current_config, new_config)
-
-                    # Merge new tags with current tags
-                    current_tags = current_config.get('tags', {})
-                    current_tags.update(new_tags)
-                    current_config['tags'] = current_tags
-
-                    updated_config_json = json.dumps(current_config)
-
-                    if updated_config_json == result['config']:
-                        self.write({"status": "success", "message": "No changes to config"})
-                    else:
-                        cursor.execute("""
-                            UPDATE client_configs
-                            SET hostname = %s, config = %s, last_updated = NOW()
-                            WHERE client_id = %s
-                        """, (hostname, updated_config_json, client_id))
-                        self.write({"status": "success", "message": "Client config updated successfully"})
-                else:
-                    # New client, insert the config as is
-                    cursor.execute("""
-                        INSERT INTO client_configs (client_id, hostname, config, last_updated)
-                        VALUES (%s, %s, %s, NOW())
-                    """, (client_id, hostname, json.dumps(new_config)))
-                    self.write({"status": "success", "message": "New client config created successfully"})
+            message = await self.db.run(self.save_config, client_id, hostname, new_config, new_tags)
+            self.write({"status": "success", "message": message})
         except Exception as e:
             logger.error(f"Error in ClientConfigHandler POST: {str(e)}")
             self.set_status(500)
             self.write({"error": "Internal server error"})
 
+    def save_config(self, cursor, client_id, hostname, new_config, new_tags):
+        # First, get the current config
+        cursor.execute("SELECT config FROM client_configs WHERE client_id = %s", (client_id,))
+        result = cursor.fetchone()
+
+        if result:
+            current_config = json.loads(result['config'])
+
+            # Merge new config with current config
+            self.merge_configs(current_config, new_config)
+
+            # Merge new tags with current tags
+            current_tags = current_config.get('tags', {})
+            current_tags.update(new_tags)
+            current_config['tags'] = current_tags
+
+            updated_config_json = json.dumps(current_config)
+
+            if updated_config_json == result['config']:
+                return "No changes to config"
+
+            cursor.execute("""
+                UPDATE client_configs
+                SET hostname = %s, config = %s, last_updated = NOW()
+                WHERE client_id = %s
+            """, (hostname, updated_config_json, client_id))
+            return "Client config updated successfully"
+
+        # New client, insert the config as is
+        cursor.execute("""
+            INSERT INTO client_configs (client_id, hostname, config, last_updated)
+            VALUES (%s, %s, %s, NOW())
+        """, (client_id, hostname, json.dumps(new_config)))
+        return "New client config created successfully"
+
     def merge_configs(self, current_config, new_config):
         for key, value in new_config.items():
             if isinstance(value, dict) and key in current_config and isinstance(current_config[key], dict):
@@ -111,23 +113,21 @@ class FetchMetricsHandler(BaseHandler):
             return
 
         try:
-            with self.db.get_cursor() as cursor:
-                cursor.execute("SELECT tags FROM client_configs WHERE client_id = %s", (client_id,))
-                result = cursor.fetchone()
-                if not result:
-                    self.set_status(404)
-                    self.write({"error": "Client not found"})
-                    return
-
-                client_tags = result['tags'] or {}
-
-                cursor.execute("""
-                    SELECT name, code
-                    FROM metric_scripts
-                    WHERE tags @> %s OR tags IS NULL OR tags = '{}' OR %s = '{}'
-                """, (json.dumps(client_tags), json.dumps(client_tags)))
-
-                metrics = {row['name']: row['code'] for row in cursor.fetchall()}
+            result = await self.db.fetchone("SELECT tags FROM client_configs WHERE client_id = %s", (client_id,))
+            if not result:
+                self.set_status(404)
+                self.write({"error": "Client not found"})
+                return
+
+            client_tags = result['tags'] or {}
+
+            rows = await self.db.fetchall("""
+                SELECT name, code
+                FROM metric_scripts
+                WHERE tags @> %s OR tags IS NULL OR tags = '{}' OR %s = '{}'
+            """, (json.dumps(client_tags), json.dumps(client_tags)))
+
+            metrics = {row['name']: row['code'] for row in rows}
 
             self.set_header("Content-Type", "application/json")
             self.write(json.dumps(metrics))
@@ -1,7 +1,7 @@
 import { initChart, updateChart, addDataToChart, updateChartTimeRange } from './chart.js';
 import { updateAlertConfigs, addAlertConfig, deleteAlertConfig, toggleAlertState, updateRecentAlerts, setupAlertUpdates } from './alerts.js';
 import { updateDowntimes, addDowntime, deleteDowntime } from './downtimes.js';
-import { fetchHosts, fetchLatestMetrics, fetchMetricHistory, setTimeRange, updateFormVisibility, createHostSelector, updateHostInfo, getVibrantColor, processMetricData, displayMessages } from './utils.js';
+import { fetchHosts, fetchLatestMetrics, fetchHistoryBatch, setTimeRange, updateFormVisibility, createHostSelector, updateHostInfo, getVibrantColor, processMetricData, displayMessages } from './utils.js';
 
 let charts = {};
 let realtimeUpdateInterval;
@@ -51,10 +51,10 @@ async function updateDashboard(hostname, isRealtimeUpdate = false) {
 
                 const datasets = {};
                 const messages = [];
-                const fetchPromises = metricNames.map(async (metricName) => {
+                const histories = await fetchHistoryBatch(hostname, metricNames, startDate.getTime() / 1000, endDate.getTime() / 1000);
+                for (const metricName of metricNames) {
                     try {
-                        console.log(`Fetching history for ${hostname} - ${metricName}`);
-                        const metricData = await fetchMetricHistory(hostname, metricName, startDate.getTime() / 1000, endDate.getTime() / 1000);
+                        const metricData = histories[metricName] || [];
                         console.log(`Fetched data for ${metricName}:`, metricData);
                         datasets[metricName] = processMetricData(metricData, metricName);
                         console.log(`Processed datasets for ${metricName}:`, datasets[metricName]);
@@ -75,9 +75,7 @@ async function updateDashboard(hostname, isRealtimeUpdate = false) {
                     } catch (error) {
                         console.error(`Error processing data for ${metricName}:`, error);
                     }
-                });
-
-                await Promise.all(fetchPromises);
+                }
 
                 console.log('All collected messages:', messages);
 
@@ -5,16 +5,15 @@ from auth_handlers import BaseHandler
 logger = logging.getLogger(__name__)
 
 class DashboardHandler(BaseHandler):
-    def get(self):
+    async def get(self):
         try:
             host = self.get_argument('host', None)
 
             with open("dashboard.html", "r") as file:
                 dashboard_html = file.read()
 
-            with self.db.get_cursor() as cursor:
-                cursor.execute("SELECT hostname, tags FROM hosts")
-                hosts = {row['hostname']: {'tags': row['tags']} for row in cursor.fetchall()}
+            rows = await self.db.fetchall("SELECT hostname, tags FROM hosts")
+            hosts = {row['hostname']: {'tags': row['tags']} for row in rows}
 
             selected_host = None
             if host and host in hosts:
@@ -1,92 +1,339 @@
+import json
 import logging
-from datetime import datetime, timedelta
+import math
+import threading
+import time
+from archive import get_archive, series_key
 from database import get_db
+from partitions import DAY
+from psycopg2.extras import RealDictCursor
+from retention import longest, retention_groups
+from rollups import RESOLUTIONS, bucket_start, delete_before as delete_rollups_before
+from storage import get_storage
 
 logger = logging.getLogger(__name__)
 
-def aggregate_data():
-    logger.info("Starting data aggregation...")
-    db = get_db()
+JOB_NAME = 'aggregation'
+# Rows per fetch when streaming a day into the archive
+ARCHIVE_CHUNK_SIZE = 10000
 
-    try:
-        with db.conn.cursor() as cursor:
-            # Ensure the unique constraint exists
+def request_run(cursor):
+    """Ask the aggregation job to run now; it may live in another server process."""
+    cursor.execute("""
+        INSERT INTO job_state (name, run_requested) VALUES (%s, TRUE)
+        ON CONFLICT (name) DO UPDATE SET run_requested = TRUE
+    """, (JOB_NAME,))
+
+def load_status(cursor):
+    cursor.execute("SELECT watermark, status, run_requested, updated_at FROM job_state WHERE name = %s", (JOB_NAME,))
+    row = cursor.fetchone()
+    if not row:
+        return {"state": "never run"}
+    status = dict(row['status'] or {})
+    status['watermark'] = row['watermark']
+    status['run_requested'] = row['run_requested']
+    status['updated_at'] = row['updated_at'].timestamp() if row['updated_at'] else None
+    if row['watermark'] is not None:
+        status['lag_seconds'] = time.time() - row['watermark']
+    return status
+
+class AggregationJob:
+    """Background thread that keeps rollups reconciled with the raw points, seals
+    staged points for backends that stage them, and applies retention.
+
+    Rollups are maintained at ingest; this job recomputes each closed bucket from
+    the raw points once, in small chunks walking forward from a watermark stored in
+    job_state. The watermark is saved in the same transaction as its chunk, so a
+    restart resumes where the last run stopped. It only ever reads and deletes
+    through short transactions and pauses between chunks, so ingest keeps priority.
+    """
+
+    def __init__(self, interval=3600, chunk_seconds=3600, chunk_pause=0.5, lag=600, poll_interval=10,
+                 delete_batch_size=10000, raw_retention_days=30, rollup_retention_days=None):
+        self.interval = interval  # seconds between scheduled runs
+        self.chunk_seconds = chunk_seconds  # time range reconciled per transaction
+        self.chunk_pause = chunk_pause  # seconds to sleep between transactions
+        self.lag = lag  # buckets this recent may still receive points and are left alone
+        self.poll_interval = poll_interval  # how often run requests from other processes are picked up
+        self.delete_batch_size = delete_batch_size
+        # Days kept per tier for series no retention policy overrides; None keeps them forever
+        self.retention_days = {'raw': raw_retention_days, '1m': 90, '1h': 730, '1d': None,
+                               **(rollup_retention_days or {})}
+        # (cutoff, series ids) per raw retention group; points before a group's cutoff
+        # may have been removed, None keeps them forever and None ids means all series
+        self.raw_cutoffs = [(None, None)]
+        self.db = get_db()
+        self.storage = get_storage()
+        self.archive = get_archive()
+        self.wake = threading.Event()
+        self.running = False
+        self.thread = None
+        self.status_lock = threading.Lock()
+        self.status = {"state": "idle", "chunks_done": 0, "last_error": None}
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, daemon=True, name='aggregation')
+        self.thread.start()
+        logger.info(f"Aggregation job started (interval={self.interval}s, chunk={self.chunk_seconds}s)")
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        logger.info("Aggregation job stopped")
+
+    def trigger(self):
+        self.wake.set()
+
+    def get_status(self):
+        with self.status_lock:
+            return dict(self.status)
+
+    def _set_status(self, **changes):
+        with self.status_lock:
+            self.status.update(changes)
+            return dict(self.status)
+
+    def _pause(self):
+        # Returns early when stopping; a trigger must not cut the throttle short
+        deadline = time.time() + self.chunk_pause
+        while self.running and time.time() < deadline:
+            time.sleep(min(0.1, deadline - time.time()))
+
+    def _loop(self):
+        next_run = time.time()
+        while self.running:
+            try:
+                requested = self._take_request()
+                if requested or self.wake.is_set() or time.time() >= next_run:
+                    self.wake.clear()
+                    self.run_once()
+                    next_run = time.time() + self.interval
+            except Exception as e:
+                logger.error(f"An error occurred during data aggregation: {str(e)}")
+                self._set_status(state="failed", last_error=str(e))
+                next_run = time.time() + self.interval
+            self.wake.wait(self.poll_interval)
+
+    def _take_request(self):
+        with self.db.get_cursor() as cursor:
             cursor.execute("""
-                DO $$
-                BEGIN
-                    IF NOT EXISTS (
-                        SELECT 1 FROM pg_constraint 
-                        WHERE conname = 'unique_metric_timestamp'
-                    ) THEN
-                        ALTER TABLE metrics 
-                        ADD CONSTRAINT unique_metric_timestamp 
-                        UNIQUE (host_id, metric_name, timestamp);
-                    END IF;
-                END $$;
-            """)
-
-            # Define aggregation periods
-            aggregation_periods = [
-                # Data older than 7 days but newer than 30 days:
-                # Aggregate to hourly intervals
-                (timedelta(days=7), 'hour'),
-
-                # Data older than 30 days but newer than 90 days:
-                # Aggregate to daily intervals
-                (timedelta(days=30), 'day'),
-
-                # Data older than 90 days but newer than 365 days:
-                # Aggregate to weekly intervals
-                (timedelta(days=90), 'week'),
-            ]
-
-            for retention_period, interval in aggregation_periods:
-                aggregate_period(cursor, retention_period, interval)
-
-            # Delete data older than 1 year
-            delete_old_data(cursor, timedelta(days=365))
-
-            db.conn.commit()
+                UPDATE job_state SET run_requested = FALSE
+                WHERE name = %s AND run_requested
+                RETURNING name
+            """, (JOB_NAME,))
+            return cursor.fetchone() is not None
+
+    def _save(self, cursor, watermark=None):
+        cursor.execute("""
+            INSERT INTO job_state (name, watermark, status, updated_at) VALUES (%s, %s, %s, now())
+            ON CONFLICT (name) DO UPDATE
+            SET watermark = COALESCE(EXCLUDED.watermark, job_state.watermark),
+                status = EXCLUDED.status, updated_at = now()
+        """, (JOB_NAME, watermark, json.dumps(self.get_status())))
+
+    def run_once(self):
+        logger.info("Starting data aggregation...")
+        self._set_status(state="running", phase="retention", chunks_done=0,
+                         last_run_started=time.time(), last_error=None)
+        self.apply_retention()
+        if self.running:
+            self._set_status(phase="seal")
+            self.seal_points()
+        if self.running:
+            self._set_status(phase="rollups")
+            self.reconcile_rollups()
+        if self.running:
+            self._set_status(state="idle", phase=None, last_run_finished=time.time())
             logger.info("Data aggregation complete.")
-    except Exception as e:
-        db.conn.rollback()
-        logger.error(f"An error occurred during data aggregation: {str(e)}")
+        else:
+            # Stopped mid-run; the next start resumes from the saved watermark
+            self._set_status(state="interrupted")
+        with self.db.get_cursor() as cursor:
+            self._save(cursor)
 
-def aggregate_period(cursor, retention_period, interval):
-    end_date = datetime.now() - retention_period
-    start_date = end_date - retention_period
+    def apply_retention(self):
+        with self.db.get_cursor() as cursor:
+            groups = retention_groups(cursor, self.retention_days)
+        now = time.time()
 
-    cursor.execute("""
-        WITH aggregated_data AS (
-            SELECT 
-                host_id,
-                metric_name,
-                date_trunc(%s, to_timestamp(timestamp)) as bucket,
-                AVG(value) as avg_value
-            FROM metrics
-            WHERE timestamp >= %s AND timestamp < %s
-            GROUP BY host_id, metric_name, bucket
-        ),
-        deleted_data AS (
-            DELETE FROM metrics
-            WHERE timestamp >= %s AND timestamp < %s
-            RETURNING host_id, metric_name, timestamp, value
-        )
-        INSERT INTO metrics (host_id, metric_name, timestamp, value)
-        SELECT 
-            host_id, 
-            metric_name, 
-            EXTRACT(EPOCH FROM bucket),
-            avg_value
-        FROM aggregated_data
-        ON CONFLICT (host_id, metric_name, timestamp) 
-        DO UPDATE SET value = EXCLUDED.value
-    """, (interval, start_date.timestamp(), end_date.timestamp(),
-          start_date.timestamp(), end_date.timestamp()))
-
-    logger.info(f"Aggregated data to {interval} intervals for period ending {end_date}")
-
-def delete_old_data(cursor, max_age):
-    cutoff_date = datetime.now() - max_age
-    cursor.execute("DELETE FROM metrics WHERE timestamp < %s", (cutoff_date.timestamp(),))
-    logger.info(f"Deleted data older than {cutoff_date}")
\ No newline at end of file
+        # Whole storage units go once every series in them is past its cutoff; the
+        # rest of each group's older points is deleted
+        raw = groups['raw']
+        cutoffs = {days: now - days * DAY for days in raw if days is not None}
+        if self.archive:
+            # Only whole days go, so every archived day is complete and written once
+            cutoffs = {days: bucket_start(cutoff, DAY) for days, cutoff in cutoffs.items()}
+        self.raw_cutoffs = [(cutoffs.get(days), series_ids) for days, series_ids in raw.items()]
+        if self.archive and cutoffs:
+            self.archive_before([(cutoff, raw[days]) for days, cutoff in cutoffs.items()])
+            if not self.running:
+                # Unarchived points must not be dropped
+                return
+        if cutoffs:
+            self.drop_storage_units(raw, cutoffs)
+        keep = longest(raw)
+        for days, cutoff in cutoffs.items():
+            if days == keep or not self.running:
+                # The longest retention's points went with their storage units
+                continue
+            self.delete_points(cutoff, raw[days])
+
+        for resolution in RESOLUTIONS:
+            keep = longest(groups[resolution])
+            for days, series_ids in groups[resolution].items():
+                if days is None:
+                    continue
+                if days == keep:
+                    # Everything this old goes, whichever series it belongs to
+                    series_ids = None
+                self.delete_rollups(resolution, now - days * DAY, series_ids)
+
+    def drop_storage_units(self, raw, cutoffs):
+        # Units before the earliest cutoff hold no live points, unless a series kept
+        # forever has some there
+        cutoff = min(cutoffs.values())
+        with self.db.get_cursor() as cursor:
+            if None in raw:
+                first = self.storage.first_timestamp(cursor, raw[None])
+                if first is not None:
+                    cutoff = min(cutoff, first)
+            dropped = self.storage.drop_before(cursor, cutoff)
+        logger.info(f"Dropped {len(dropped)} {self.storage.name} storage units with data older than {cutoff:.0f}")
+
+    def delete_points(self, cutoff, series_ids=None):
+        # One chunk_seconds slice per transaction, starting at the oldest point left,
+        # so a long backlog never turns into one huge delete
+        total = 0
+        while self.running:
+            with self.db.get_cursor() as cursor:
+                first = self.storage.first_timestamp(cursor, series_ids)
+                if first is None or first >= cutoff:
+                    break
+                slice_end = min(bucket_start(first, self.chunk_seconds) + self.chunk_seconds, cutoff)
+                deleted = self.storage.delete(cursor, series_ids, first, math.nextafter(slice_end, -math.inf))
+            total += deleted
+            if not deleted:
+                break
+            self._pause()
+        scope = f" of {len(series_ids)} series" if series_ids is not None else ""
+        logger.info(f"Deleted {total} raw points{scope} older than {cutoff:.0f}")
+
+    def delete_rollups(self, resolution, cutoff, series_ids=None):
+        total = 0
+        while self.running:
+            with self.db.get_cursor() as cursor:
+                deleted = delete_rollups_before(cursor, resolution, cutoff, self.delete_batch_size, series_ids)
+            total += deleted
+            if deleted < self.delete_batch_size:
+                break
+            self._pause()
+        scope = f" of {len(series_ids)} series" if series_ids is not None else ""
+        logger.info(f"Deleted {total} {resolution} rollups{scope} older than {cutoff:.0f}")
+
+    def archive_before(self, purges):
+        # The days of each (cutoff, series ids) group retention removes next, skipping
+        # days already archived for the same series
+        archived = 0
+        for cutoff, series_ids in purges:
+            key = series_key(series_ids)
+            with self.db.get_cursor() as cursor:
+                first = self.storage.first_timestamp(cursor, series_ids)
+            day = bucket_start(first, DAY) if first is not None else cutoff
+            while self.running and day + DAY <= cutoff:
+                if not self.archive.has_day(day, key):
+                    archived += self.archive_day(day, series_ids, key)
+                    self._pause()
+                day += DAY
+        logger.info(f"Archived {archived} points of {len(purges)} retention groups")
+
+    def archive_day(self, day, series_ids, key):
+        # Streamed one series at a time, through a server-side cursor where the backend
+        # has one; returning the connection rolls its read-only transaction back
+        with self.db.connection() as conn:
+            chunks = self.storage.export(conn, series_ids, day, math.nextafter(day + DAY, -math.inf),
+                                         ARCHIVE_CHUNK_SIZE)
+            return self.archive.export_day(day, chunks, key, lambda ids: self._series_names(conn, ids))
+
+    def _series_names(self, conn, series_ids):
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+                SELECT s.id, h.hostname, s.metric_name, s.field
+                FROM series s
+                JOIN hosts h ON s.host_id = h.id
+                WHERE s.id = ANY(%s)
+            """, (list(series_ids),))
+            return {row['id']: (row['hostname'], row['metric_name'], row['field']) for row in cursor.fetchall()}
+
+    def seal_points(self):
+        # Backends that stage new points move closed ones to long-term storage here
+        before = time.time() - self.lag
+        after = None
+        sealed = 0
+        while self.running:
+            with self.db.get_cursor() as cursor:
+                after = self.storage.seal(cursor, before, after)
+            if after is None:
+                break
+            sealed += 1
+            self._pause()
+        if sealed:
+            logger.info(f"Sealed {sealed} time ranges of staged {self.storage.name} points")
+
+    def _raw_horizon(self):
+        # Raw points before this are gone for every series; None when some keep theirs forever
+        cutoffs = [cutoff for cutoff, _ in self.raw_cutoffs]
+        return None if None in cutoffs else min(cutoffs)
+
+    def _rebuild_ranges(self, first, last, width):
+        # (start, series ids) per retention group: only buckets starting at or after the
+        # group's own cutoff are rebuilt, earlier ones lost raw points to retention
+        ranges = []
+        for cutoff, series_ids in self.raw_cutoffs:
+            start = first if cutoff is None else max(first, math.ceil(cutoff / width) * width)
+            if start < last:
+                ranges.append((start, series_ids))
+        if len(ranges) == len(self.raw_cutoffs) and all(start == first for start, _ in ranges):
+            # Nothing to exclude, so all series go in one pass
+            return [(first, None)]
+        return ranges
+
+    def _initial_watermark(self, cursor):
+        horizon = self._raw_horizon()
+        if horizon is not None:
+            start = horizon
+        else:
+            start = self.storage.first_timestamp(cursor) or time.time()
+        return bucket_start(start, DAY)
+
+    def reconcile_rollups(self):
+        with self.db.get_cursor() as cursor:
+            cursor.execute("SELECT watermark FROM job_state WHERE name = %s", (JOB_NAME,))
+            row = cursor.fetchone()
+            watermark = row['watermark'] if row and row['watermark'] is not None else self._initial_watermark(cursor)
+        horizon = self._raw_horizon()
+        if horizon is not None:
+            # Rebuilding buckets whose raw points were dropped would delete them
+            watermark = max(watermark, bucket_start(horizon, DAY))
+
+        target = bucket_start(time.time() - self.lag, self.chunk_seconds)
+        while self.running and watermark < target:
+            chunk_end = min(bucket_start(watermark, self.chunk_seconds) + self.chunk_seconds, target)
+            started = time.time()
+            with self.db.get_cursor() as cursor:
+                # Every bucket that closed within the chunk, so a day is rebuilt
+                # once, by the chunk that ends it
+                for resolution, width in RESOLUTIONS.items():
+                    first = bucket_start(watermark, width)
+                    last = bucket_start(chunk_end, width)
+                    for start, series_ids in self._rebuild_ranges(first, last, width):
+                        self.storage.rebuild_rollup_buckets(cursor, resolution, start, last, series_ids)
+                watermark = chunk_end
+                with self.status_lock:
+                    self.status['chunks_done'] += 1
+                    self.status['last_chunk_seconds'] = time.time() - started
+                self._save(cursor, watermark)
+            self._pause()
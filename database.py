@@ -1,52 +1,327 @@
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 from psycopg2.extras import RealDictCursor
 import logging
 from contextlib import contextmanager
 import json
+import threading
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from partitions import migration_partition_points
+from latest import migration_backfill_latest
+from rollups import RESOLUTIONS, create_statements as rollup_create_statements, migration_backfill_rollups
 
 logger = logging.getLogger(__name__)
 
+class PoolTimeout(Exception):
+    pass
+
+class StreamsBusy(Exception):
+    """Every stream slot is taken; the caller should try again later."""
+
+class ConnectionPool:
+    def __init__(self, connect, minconn=1, maxconn=10, idle_timeout=300, health_check_interval=30, checkout_timeout=30):
+        self.connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.idle_timeout = idle_timeout  # idle connections above minconn are closed after this many seconds
+        self.health_check_interval = health_check_interval  # idle connections are pinged before reuse after this many seconds
+        self.checkout_timeout = checkout_timeout
+        self.idle = []  # (connection, last_used) pairs, most recently used last
+        self.size = 0
+        self.in_use = 0
+        self.condition = threading.Condition()
+        self.closed = False
+
+        for _ in range(minconn):
+            self.idle.append((self._open(), time.time()))
+            self.size += 1
+
+    def _open(self):
+        return self.connect()
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.time() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            logger.warning(f"Discarding unhealthy pooled connection: {e}")
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self):
+        deadline = time.time() + self.checkout_timeout
+        while True:
+            with self.condition:
+                while True:
+                    if self.closed:
+                        raise PoolTimeout("Connection pool is closed")
+                    if self.idle:
+                        conn, last_used = self.idle.pop()
+                        break
+                    if self.size < self.maxconn:
+                        self.size += 1
+                        conn, last_used = None, None
+                        break
+                    remaining = deadline - time.time()
+                    if remaining <= 0 or not self.condition.wait(remaining):
+                        raise PoolTimeout(f"No database connection available within {self.checkout_timeout}s")
+                self.in_use += 1
+
+            if conn is not None and self._is_healthy(conn, last_used):
+                return conn
+
+            if conn is not None:
+                self._discard(conn)
+            try:
+                return self._open()
+            except Exception:
+                with self.condition:
+                    self.size -= 1
+                    self.in_use -= 1
+                    self.condition.notify()
+                raise
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        with self.condition:
+            self.in_use -= 1
+            if discard or conn.closed or self.closed:
+                self.size -= 1
+                self._discard(conn)
+            else:
+                self.idle.append((conn, time.time()))
+            self.condition.notify()
+
+    def reap(self):
+        # Close connections that have sat idle for idle_timeout, oldest first, down to minconn
+        cutoff = time.time() - self.idle_timeout
+        reaped = []
+        with self.condition:
+            while self.idle and self.size > self.minconn and self.idle[0][1] < cutoff:
+                conn, _ = self.idle.pop(0)
+                self.size -= 1
+                reaped.append(conn)
+        for conn in reaped:
+            self._discard(conn)
+        if reaped:
+            logger.info(f"Reaped {len(reaped)} idle database connections")
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                "size": self.size,
+                "in_use": self.in_use,
+                "idle": len(self.idle),
+                "min": self.minconn,
+                "max": self.maxconn
+            }
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.size -= len(idle)
+            self.condition.notify_all()
+        for conn, _ in idle:
+            self._discard(conn)
+
 class Database:
     def __init__(self, config):
         self.config = config
-        self.conn = None
+        self.pool = None
+        self.reaper = None
+        self.reaper_stop = threading.Event()
+        self.executor = None
+        # Streams hold a connection for as long as the client reads, so only a few may run at once
+        self.max_streams = config.get('stream_concurrency', 2)
+        self.streams = 0
+
+    def _open_connection(self):
+        return psycopg2.connect(
+            host=self.config['host'],
+            database=self.config['database_name'],
+            user=self.config['username'],
+            password=self.config['password'],
+            port=self.config['port']
+        )
 
     def connect(self):
-        if self.conn is None:
+        if self.pool is None:
             try:
-                self.conn = psycopg2.connect(
-                    host=self.config['host'],
-                    database=self.config['database_name'],
-                    user=self.config['username'],
-                    password=self.config['password'],
-                    port=self.config['port']
-                )
-                logger.info("Database connection established")
+                self.pool = ConnectionPool(
+                    self._open_connection,
+                    minconn=self.config.get('pool_min', 2),
+                    maxconn=self.config.get('pool_max', 20),
+                    idle_timeout=self.config.get('pool_idle_timeout', 300),
+                    health_check_interval=self.config.get('pool_health_check_interval', 30),
+                    checkout_timeout=self.config.get('pool_checkout_timeout', 30)
+                )
+                self.reaper_stop.clear()
+                self.reaper = threading.Thread(target=self._reaper_loop, daemon=True)
+                self.reaper.start()
+                # Request handlers run their queries here so the IOLoop never blocks on PostgreSQL;
+                # max_workers bounds how many pooled connections handlers can hold at once
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.config.get('query_concurrency', 8),
+                    thread_name_prefix='db-query'
+                )
+                logger.info(f"Database connection pool established "
+                            f"(min={self.pool.minconn}, max={self.pool.maxconn})")
             except (Exception, psycopg2.Error) as error:
                 logger.error(f"Error while connecting to PostgreSQL: {error}")
                 raise
 
+    def _reaper_loop(self):
+        while not self.reaper_stop.wait(min(60, self.pool.idle_timeout)):
+            try:
+                self.pool.reap()
+            except Exception as e:
+                logger.error(f"Error reaping idle connections: {e}")
+
+    @contextmanager
+    def connection(self):
+        if self.pool is None:
+            self.connect()
+        conn = self.pool.getconn()
+        discard = False
+        try:
+            yield conn
+        except psycopg2.InterfaceError:
+            discard = True
+            raise
+        except psycopg2.OperationalError:
+            # The server may have dropped the connection; don't hand it out again
+            discard = conn.closed != 0
+            raise
+        finally:
+            self.pool.putconn(conn, discard=discard)
+
     @contextmanager
     def get_cursor(self):
-        if self.conn is None:
+        with self.connection() as conn:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            try:
+                yield cursor
+                conn.commit()
+            except Exception as e:
+                if not conn.closed:
+                    conn.rollback()
+                logger.error(f"Database error: {e}")
+                raise
+            finally:
+                cursor.close()
+
+    def _run_with_cursor(self, fn, args):
+        with self.get_cursor() as cursor:
+            return fn(cursor, *args)
+
+    async def run(self, fn, *args):
+        """Run fn(cursor, *args) in one transaction on the query executor and return its result."""
+        if self.executor is None:
             self.connect()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._run_with_cursor, fn, args)
+
+    async def stream(self, fn, *args):
+        """Iterate the generator fn(conn, *args) on the query executor one item at a time.
+
+        The pooled connection stays checked out, in one transaction, until the
+        generator is exhausted or the caller closes this one; the executor is
+        only held while an item is produced. Raises StreamsBusy when
+        stream_concurrency streams are running already.
+        """
+        if self.streams >= self.max_streams:
+            raise StreamsBusy(f"{self.streams} streams are running already")
+        if self.executor is None:
+            self.connect()
+        loop = asyncio.get_running_loop()
+        self.streams += 1
         try:
-            cursor = self.conn.cursor(cursor_factory=RealDictCursor)
-            yield cursor
-            self.conn.commit()
-        except Exception as e:
-            self.conn.rollback()
-            logger.error(f"Database error: {e}")
+            conn = await loop.run_in_executor(self.executor, self.pool.getconn)
+        except BaseException:
+            self.streams -= 1
+            raise
+        discard = False
+        items = None
+        try:
+            items = fn(conn, *args)
+            done = object()
+            while True:
+                item = await loop.run_in_executor(self.executor, next, items, done)
+                if item is done:
+                    break
+                yield item
+        except psycopg2.InterfaceError:
+            discard = True
+            raise
+        except psycopg2.OperationalError:
+            discard = conn.closed != 0
             raise
         finally:
-            cursor.close()
+            if items is not None:
+                try:
+                    await loop.run_in_executor(self.executor, items.close)
+                except psycopg2.Error as e:
+                    logger.warning(f"Error closing a streamed query: {e}")
+                    discard = True
+            try:
+                # putconn rolls the read-only transaction back
+                await loop.run_in_executor(self.executor, self.pool.putconn, conn, discard)
+            finally:
+                self.streams -= 1
+
+    async def fetchall(self, query, params=None):
+        def fetch(cursor):
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        return await self.run(fetch)
+
+    async def fetchone(self, query, params=None):
+        def fetch(cursor):
+            cursor.execute(query, params)
+            return cursor.fetchone()
+        return await self.run(fetch)
+
+    async def execute(self, query, params=None):
+        """Execute a statement and return the number of affected rows."""
+        def execute(cursor):
+            cursor.execute(query, params)
+            return cursor.rowcount
+        return await self.run(execute)
+
+    def get_stats(self):
+        if not self.pool:
+            return {}
+        return dict(self.pool.get_stats(), streams=self.streams, max_streams=self.max_streams)
 
     def close(self):
-        if self.conn:
-            self.conn.close()
-            self.conn = None
-            logger.info("Database connection closed")
+        if self.executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if self.pool:
+            self.reaper_stop.set()
+            self.pool.close()
+            self.pool = None
+            logger.info("Database connection pool closed")
 
 def create_database_if_not_exists(config):
     conn = None
@@ -79,14 +354,103 @@ def create_database_if_not_exists(config):
         if conn:
             conn.close()
 
+# Arbitrary key for the advisory lock that serializes migration runs across servers
+MIGRATION_LOCK_ID = 727274
+
+def create_index_concurrently(cursor, name, definition):
+    """Build an index without blocking writes to the table; needs an autocommit connection."""
+    cursor.execute("""
+        SELECT i.indisvalid FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s
+    """, (name,))
+    row = cursor.fetchone()
+    if row and row['indisvalid']:
+        return
+    if row:
+        # An interrupted CONCURRENTLY build leaves an invalid index behind
+        logger.warning(f"Dropping invalid index {name} left by an interrupted build")
+        cursor.execute(sql.SQL("DROP INDEX CONCURRENTLY {}").format(sql.Identifier(name)))
+    cursor.execute(sql.SQL("CREATE INDEX CONCURRENTLY {} ON ").format(sql.Identifier(name)) + sql.SQL(definition))
+
+def migration_alert_indexes(cursor):
+    # Alert rules are loaded per ingest batch by host, and matched by metric name
+    create_index_concurrently(cursor, 'idx_alerts_host_metric', 'alerts (host_id, metric_name)')
+
+def migration_downtime_indexes(cursor):
+    # Active downtimes are looked up per ingest batch by host and time range
+    create_index_concurrently(cursor, 'idx_downtimes_host_time', 'downtimes (host_id, start_time, end_time)')
+
+def migration_alert_history_indexes(cursor):
+    # Recent alerts are listed newest first, for all hosts or for one
+    create_index_concurrently(cursor, 'idx_alert_history_timestamp', 'alert_history (timestamp)')
+    create_index_concurrently(cursor, 'idx_alert_history_host_timestamp', 'alert_history (host_id, timestamp)')
+
+def migration_points_time_index(cursor):
+    # Points arrive roughly in time order, so a tiny BRIN index is enough for the
+    # aggregator's and retention's time range scans; per-series reads use the primary key
+    create_index_concurrently(cursor, 'idx_points_timestamp_brin', 'points USING brin (timestamp)')
+
+def migration_rollup_bucket_indexes(cursor):
+    # Retention deletes each rollup tier's oldest buckets in batches
+    for name in RESOLUTIONS:
+        create_index_concurrently(cursor, f"idx_rollups_{name}_bucket", f"rollups_{name} (bucket)")
+
+def migration_point_chunk_index(cursor):
+    # Retention drops the oldest chunks and sealing looks up the first one
+    create_index_concurrently(cursor, 'idx_point_chunks_start', 'point_chunks (chunk_start)')
+
+# Applied in order and recorded in schema_migrations; never renumber or edit an applied entry
+MIGRATIONS = [
+    (1, "Index alerts by host and metric", migration_alert_indexes),
+    (2, "Index downtimes by host and time range", migration_downtime_indexes),
+    (3, "Index alert history by time", migration_alert_history_indexes),
+    (4, "BRIN index on point timestamps", migration_points_time_index),
+    (5, "Partition points by time", migration_partition_points),
+    (6, "Build rollups from existing points", migration_backfill_rollups),
+    (7, "Index rollup buckets by time", migration_rollup_bucket_indexes),
+    (8, "Record the latest point of every series", migration_backfill_latest),
+    (9, "Index point chunks by time", migration_point_chunk_index),
+]
+
+def run_migrations(db):
+    # Migrations run in autocommit mode so they can build indexes concurrently
+    with db.connection() as conn:
+        conn.autocommit = True
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+                try:
+                    cursor.execute("SELECT version FROM schema_migrations")
+                    applied = {row['version'] for row in cursor.fetchall()}
+                    for version, description, migrate in MIGRATIONS:
+                        if version in applied:
+                            continue
+                        logger.info(f"Applying schema migration {version}: {description}")
+                        started = time.time()
+                        migrate(cursor)
+                        cursor.execute(
+                            "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                            (version, description)
+                        )
+                        logger.info(f"Schema migration {version} applied in {time.time() - started:.1f}s")
+                finally:
+                    cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        finally:
+            conn.autocommit = False
+
 db = None
 
-def init_db(config):
+def init_db(config, create_schema=True):
     global db
-    create_database_if_not_exists(config)
+    if create_schema:
+        create_database_if_not_exists(config)
     db = Database(config)
     db.connect()
 
+    if not create_schema:
+        return
+
     # Create tables if they don't exist
     with db.get_cursor() as cursor:
         tables = [
@@ -97,14 +461,45 @@ def init_db(config):
                     tags JSONB
                 )
             '''),
-            ("metrics", '''
-                CREATE TABLE IF NOT EXISTS metrics (
+            # One row per (host, module, field), e.g. cpu / cpu_percent
+            ("series", '''
+                CREATE TABLE IF NOT EXISTS series (
                     id SERIAL PRIMARY KEY,
-                    host_id INTEGER REFERENCES hosts(id) ON DELETE CASCADE,
+                    host_id INTEGER NOT NULL REFERENCES hosts(id) ON DELETE CASCADE,
                     metric_name VARCHAR(255) NOT NULL,
+                    field VARCHAR(255) NOT NULL,
+                    UNIQUE (host_id, metric_name, field)
+                )
+            '''),
+            ("points", '''
+                CREATE TABLE IF NOT EXISTS points (
+                    series_id INTEGER NOT NULL REFERENCES series(id) ON DELETE CASCADE,
                     timestamp FLOAT NOT NULL,
-                    value JSONB NOT NULL,
+                    value DOUBLE PRECISION,
+                    message TEXT,
+                    PRIMARY KEY (series_id, timestamp)
+                )
+            '''),
+            # Newest point per series, upserted at ingest; the spare room per page
+            # lets those updates stay HOT
+            ("metrics_latest", '''
+                CREATE TABLE IF NOT EXISTS metrics_latest (
+                    series_id INTEGER PRIMARY KEY REFERENCES series(id) ON DELETE CASCADE,
+                    timestamp FLOAT NOT NULL,
+                    value DOUBLE PRECISION,
                     message TEXT
+                ) WITH (fillfactor = 50)
+            '''),
+            # Sealed points of the pg_chunked storage backend: one row per series and
+            # hour, the hour's points as arrays sorted by timestamp
+            ("point_chunks", '''
+                CREATE TABLE IF NOT EXISTS point_chunks (
+                    series_id INTEGER NOT NULL REFERENCES series(id) ON DELETE CASCADE,
+                    chunk_start FLOAT NOT NULL,
+                    timestamps DOUBLE PRECISION[] NOT NULL,
+                    point_values DOUBLE PRECISION[] NOT NULL,
+                    messages TEXT[],
+                    PRIMARY KEY (series_id, chunk_start)
                 )
             '''),
             ("alerts", '''
@@ -158,8 +553,46 @@ def init_db(config):
                     password VARCHAR(60) NOT NULL,
                     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
                 )
+            '''),
+            # Per-series overrides of the configured retention, applied by the aggregation job
+            ("retention_policies", '''
+                CREATE TABLE IF NOT EXISTS retention_policies (
+                    id SERIAL PRIMARY KEY,
+                    name VARCHAR(255) NOT NULL,
+                    metric_pattern VARCHAR(255) NOT NULL DEFAULT '*',
+                    host_tags JSONB NOT NULL DEFAULT '{}',
+                    retention JSONB NOT NULL,
+                    priority INTEGER NOT NULL DEFAULT 0
+                )
+            '''),
+            # Progress of background jobs, e.g. the aggregation watermark
+            ("job_state", '''
+                CREATE TABLE IF NOT EXISTS job_state (
+                    name VARCHAR(50) PRIMARY KEY,
+                    watermark FLOAT,
+                    status JSONB,
+                    run_requested BOOLEAN NOT NULL DEFAULT FALSE,
+                    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+                )
+            '''),
+            # v2 signatures seen inside the replay window, shared by all server processes;
+            # losing them in a crash only reopens the window until it expires
+            ("signature_replays", '''
+                CREATE UNLOGGED TABLE IF NOT EXISTS signature_replays (
+                    signature TEXT PRIMARY KEY,
+                    expires_at FLOAT NOT NULL
+                )
+            '''),
+            ("schema_migrations", '''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+                )
             ''')
         ]
+        # min/max/sum/count/last per series and bucket, one table per resolution
+        tables.extend(rollup_create_statements())
 
         for table_name, create_statement in tables:
             try:
@@ -170,6 +603,8 @@ def init_db(config):
 
     logger.info("All necessary tables have been processed")
 
+    run_migrations(db)
+
 def get_db():
     return db
 
@@ -0,0 +1,113 @@
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+# downsample= modes of the history API; target_points is the number of points
+# LTTB keeps, and the number of time columns M4 and minmax keep extremes of
+MODES = ('lttb', 'm4', 'minmax')
+
+def lttb(timestamps, values, n):
+    """Indices of the n points Largest-Triangle-Three-Buckets keeps.
+
+    The first and last points are always kept; in between, each of n - 2 equal
+    count buckets keeps the point forming the largest triangle with the point
+    kept before it and the average of the next bucket.
+    """
+    count = len(values)
+    if n >= count:
+        return numpy.arange(count)
+    if n < 3:
+        return numpy.array([0, count - 1][:n])
+    edges = numpy.linspace(1, count - 1, n - 1).astype(numpy.int64)
+    # Averages of every bucket in one go; the last bucket looks ahead to the last point
+    sizes = numpy.diff(edges)
+    average_t = numpy.append(numpy.add.reduceat(timestamps[:count - 1], edges[:-1]) / sizes, timestamps[-1])
+    average_v = numpy.append(numpy.add.reduceat(values[:count - 1], edges[:-1]) / sizes, values[-1])
+
+    selected = numpy.empty(n, dtype=numpy.int64)
+    selected[0] = 0
+    selected[-1] = count - 1
+    previous = 0
+    for i in range(n - 2):
+        first, last = edges[i], edges[i + 1]
+        t = timestamps[first:last]
+        v = values[first:last]
+        previous_t = timestamps[previous]
+        previous_v = values[previous]
+        # Twice the triangle areas; the factor doesn't change the argmax
+        areas = numpy.abs((previous_t - average_t[i + 1]) * (v - previous_v)
+                          - (previous_t - t) * (average_v[i + 1] - previous_v))
+        previous = first + int(numpy.argmax(areas))
+        selected[i + 1] = previous
+    return selected
+
+def _columns(timestamps, n, start, end):
+    # Start index of each non-empty time column, and the column of every point
+    keys = numpy.clip(((timestamps - start) * (n / (end - start))).astype(numpy.int64), 0, n - 1)
+    starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+    column = numpy.repeat(numpy.arange(len(starts)), numpy.diff(numpy.r_[starts, len(timestamps)]))
+    return starts, column
+
+def _first_match(matches, column):
+    # Index of the first matching point in each column; every column has one
+    hits = numpy.flatnonzero(matches)
+    hit_columns = column[hits]
+    return hits[numpy.r_[True, hit_columns[1:] != hit_columns[:-1]]]
+
+def _extremes(values, starts, column):
+    minimum = _first_match(values == numpy.minimum.reduceat(values, starts)[column], column)
+    maximum = _first_match(values == numpy.maximum.reduceat(values, starts)[column], column)
+    return minimum, maximum
+
+def minmax(timestamps, values, n, start, end):
+    """Indices of the lowest and highest point in each of n equal time columns of [start, end)."""
+    if len(values) <= 2 * n:
+        return numpy.arange(len(values))
+    starts, column = _columns(timestamps, n, start, end)
+    return numpy.unique(numpy.concatenate(_extremes(values, starts, column)))
+
+def m4(timestamps, values, n, start, end):
+    """Indices of the first, last, lowest and highest point in each of n equal time columns.
+
+    Drawn as a line n pixels wide, the kept points render the same as all of them.
+    """
+    count = len(values)
+    if count <= 4 * n:
+        return numpy.arange(count)
+    starts, column = _columns(timestamps, n, start, end)
+    lasts = numpy.r_[starts[1:], count] - 1
+    return numpy.unique(numpy.concatenate((starts, lasts) + _extremes(values, starts, column)))
+
+def select(mode, timestamps, values, n, start, end):
+    if mode == 'lttb':
+        return lttb(timestamps, values, n)
+    if mode == 'm4':
+        return m4(timestamps, values, n, start, end)
+    return minmax(timestamps, values, n, start, end)
+
+def downsample_rows(rows, mode, n, start, end, skip=()):
+    """Keep the (series_id, timestamp, value, message) rows at timestamps mode picks.
+
+    rows are ordered by timestamp. Each series is downsampled on its own numeric
+    points, skipping series ids in skip; a timestamp picked for any series keeps
+    the rows of every series there, so snapshots and their messages stay whole.
+    """
+    series = {}
+    for series_id, timestamp, value, _ in rows:
+        if value is not None and series_id not in skip:
+            points = series.get(series_id)
+            if points is None:
+                points = series[series_id] = ([], [])
+            points[0].append(timestamp)
+            points[1].append(value)
+    keep = set()
+    for timestamps, values in series.values():
+        timestamps = numpy.array(timestamps, dtype=numpy.float64)
+        values = numpy.array(values, dtype=numpy.float64)
+        keep.update(timestamps[select(mode, timestamps, values, n, start, end)].tolist())
+    return [row for row in rows if row[1] in keep]
@@ -22,9 +22,7 @@ class DowntimeHandler(BaseHandler):
 
             query += " ORDER BY d.start_time DESC"
 
-            with self.db.get_cursor() as cursor:
-                cursor.execute(query, params)
-                downtimes = cursor.fetchall()
+            downtimes = await self.db.fetchall(query, params)
 
             result = [
                 {
@@ -49,20 +47,11 @@ class DowntimeHandler(BaseHandler):
                 self.write({"error": "Hostname not provided"})
                 return
 
-            with self.db.get_cursor() as cursor:
-                cursor.execute("SELECT id FROM hosts WHERE hostname = %s", (data['hostname'],))
-                host = cursor.fetchone()
-                if not host:
-                    self.set_status(404)
-                    self.write({"error": "Host not found"})
-                    return
-
-                cursor.execute("""
-                    INSERT INTO downtimes (host_id, start_time, end_time)
-                    VALUES (%s, %s, %s)
-                    RETURNING id
-                """, (host['id'], data['start_time'], data['end_time']))
-                downtime_id = cursor.fetchone()['id']
+            downtime_id = await self.db.run(self.insert_downtime, data)
+            if downtime_id is None:
+                self.set_status(404)
+                self.write({"error": "Host not found"})
+                return
 
             self.write({"status": "success", "id": downtime_id})
 
@@ -71,15 +60,27 @@ class DowntimeHandler(BaseHandler):
             self.set_status(500)
             self.write({"error": "Internal server error"})
 
+    def insert_downtime(self, cursor, data):
+        cursor.execute("SELECT id FROM hosts WHERE hostname = %s", (data['hostname'],))
+        host = cursor.fetchone()
+        if not host:
+            return None
+
+        cursor.execute("""
+            INSERT INTO downtimes (host_id, start_time, end_time)
+            VALUES (%s, %s, %s)
+            RETURNING id
+        """, (host['id'], data['start_time'], data['end_time']))
+        return cursor.fetchone()['id']
+
     async def delete(self):
         try:
             data = json.loads(self.request.body)
-            with self.db.get_cursor() as cursor:
-                cursor.execute("DELETE FROM downtimes WHERE id = %s", (data['id'],))
-                if cursor.rowcount == 0:
-                    self.set_status(404)
-                    self.write({"error": "Downtime not found"})
-                    return
+            deleted = await self.db.execute("DELETE FROM downtimes WHERE id = %s", (data['id'],))
+            if deleted == 0:
+                self.set_status(404)
+                self.write({"error": "Downtime not found"})
+                return
 
             self.write({"status": "success"})
         except Exception as e:
@@ -8,9 +8,7 @@ logger = logging.getLogger(__name__)
 class FetchHostsHandler(BaseHandler):
     async def get(self):
         try:
-            with self.db.get_cursor() as cursor:
-                cursor.execute("SELECT hostname, tags FROM hosts")
-                hosts = cursor.fetchall()
+            hosts = await self.db.fetchall("SELECT hostname, tags FROM hosts")
 
             result = {}
             for host in hosts:
@@ -26,6 +24,10 @@ class FetchHostsHandler(BaseHandler):
             self.write(json.dumps({"error": "Internal server error"}))
 
 class RemoveHostHandler(BaseHandler):
+    def initialize(self, metric_processor):
+        super().initialize()
+        self.metric_processor = metric_processor
+
     async def post(self):
         try:
             data = json.loads(self.request.body)
@@ -36,20 +38,13 @@ class RemoveHostHandler(BaseHandler):
                 self.write(json.dumps({"error": "Hostname is required"}))
                 return
 
-            with self.db.get_cursor() as cursor:
-                cursor.execute("BEGIN")
-                try:
-                    cursor.execute("DELETE FROM hosts WHERE hostname = %s", (hostname,))
-                    if cursor.rowcount == 0:
-                        cursor.execute("ROLLBACK")
-                        self.set_status(404)
-                        self.write(json.dumps({"error": "Host not found"}))
-                    else:
-                        cursor.execute("COMMIT")
-                        self.write(json.dumps({"status": "success", "message": f"Host {hostname} removed successfully"}))
-                except Exception as e:
-                    cursor.execute("ROLLBACK")
-                    raise e
+            deleted = await self.db.execute("DELETE FROM hosts WHERE hostname = %s", (hostname,))
+            self.metric_processor.invalidate_host(hostname)
+            if deleted == 0:
+                self.set_status(404)
+                self.write(json.dumps({"error": "Host not found"}))
+            else:
+                self.write(json.dumps({"status": "success", "message": f"Host {hostname} removed successfully"}))
 
         except Exception as e:
             logger.error(f"Error in RemoveHostHandler: {str(e)}")
@@ -70,50 +65,55 @@ class UpdateTagsHandler(BaseHandler):
                 self.write({"error": "Both hostname and tags are required"})
                 return
 
-            with self.db.get_cursor() as cursor:
-                # First, get the current client configuration
-                cursor.execute("""
-                    SELECT client_id, config
-                    FROM client_configs
-                    WHERE hostname = %s
-                """, (hostname,))
-                result = cursor.fetchone()
-
-                if not result:
-                    self.set_status(404)
-                    self.write({"error": f"Host not found: {hostname}"})
-                    return
-
-                client_id, current_config = result['client_id'], result['config']
-
-                # If current_config is a string, parse it to a dictionary
-                if isinstance(current_config, str):
-                    current_config = json.loads(current_config)
-                elif not isinstance(current_config, dict):
-                    current_config = {}
-
-                logger.info(f"Current config for {hostname}: {current_config}")
-
-                # Merge new tags with existing tags
-                current_tags = current_config.get('tags', {})
-                current_tags.update(new_tags)
-                current_config['tags'] = current_tags
-
-                logger.info(f"Updated config for {hostname}: {current_config}")
-
-                # Convert the updated config back to a JSON string
-                updated_config_json = json.dumps(current_config)
-
-                # Update the client configuration with the merged tags
-                cursor.execute("""
-                    UPDATE client_configs
-                    SET config = %s, last_updated = NOW()
-                    WHERE client_id = %s
-                """, (updated_config_json, client_id))
+            updated = await self.db.run(self.merge_tags, hostname, new_tags)
+            if not updated:
+                self.set_status(404)
+                self.write({"error": f"Host not found: {hostname}"})
+                return
 
             self.write({"message": f"Client configuration updated with merged tags for {hostname}. Client will fetch on next check."})
         except Exception as e:
             logger.error(f"Error updating client configuration with merged tags: {str(e)}")
             logger.error(traceback.format_exc())
             self.set_status(500)
-            self.write({"error": f"Internal server error: {str(e)}"})
\ No newline at end of file
+            self.write({"error": f"Internal server error: {str(e)}"})
+
+    def merge_tags(self, cursor, hostname, new_tags):
+        # First, get the current client configuration
+        cursor.execute("""
+            SELECT client_id, config
+            FROM client_configs
+            WHERE hostname = %s
+        """, (hostname,))
+        result = cursor.fetchone()
+
+        if not result:
+            return False
+
+        client_id, current_config = result['client_id'], result['config']
+
+        # If current_config is a string, parse it to a dictionary
+        if isinstance(current_config, str):
+            current_config = json.loads(current_config)
+        elif not isinstance(current_config, dict):
+            current_config = {}
+
+        logger.info(f"Current config for {hostname}: {current_config}")
+
+        # Merge new tags with existing tags
+        current_tags = current_config.get('tags', {})
+        current_tags.update(new_tags)
+        current_config['tags'] = current_tags
+
+        logger.info(f"Updated config for {hostname}: {current_config}")
+
+        # Convert the updated config back to a JSON string
+        updated_config_json = json.dumps(current_config)
+
+        # Update the client configuration with the merged tags
+        cursor.execute("""
+            UPDATE client_configs
+            SET config = %s, last_updated = NOW()
+            WHERE client_id = %s
+        """, (updated_config_json, client_id))
+        return True
\ No newline at end of file
@@ -0,0 +1,59 @@
+import logging
+from psycopg2.extras import execute_values
+
+logger = logging.getLogger(__name__)
+
+def update_latest(cursor, points):
+    """Record the newest of the given (series_id, timestamp, value, message) points per series.
+
+    Late points older than what's stored are ignored. Rows are upserted in
+    series order so concurrent batches can't deadlock.
+    """
+    newest = {}
+    for series_id, timestamp, value, message in points:
+        current = newest.get(series_id)
+        if current is None or timestamp >= current[0]:
+            newest[series_id] = (timestamp, value, message)
+    if not newest:
+        return
+    rows = [(series_id,) + newest[series_id] for series_id in sorted(newest)]
+    execute_values(cursor, """
+        INSERT INTO metrics_latest AS l (series_id, timestamp, value, message)
+        VALUES %s
+        ON CONFLICT (series_id) DO UPDATE
+        SET timestamp = EXCLUDED.timestamp, value = EXCLUDED.value, message = EXCLUDED.message
+        WHERE l.timestamp <= EXCLUDED.timestamp
+    """, rows, page_size=len(rows))
+
+def rebuild_latest(cursor, series_ids=None):
+    """Recompute the latest point of the given series (all when None) from the raw points."""
+    if series_ids is None:
+        cursor.execute("DELETE FROM metrics_latest")
+        condition, params = "TRUE", None
+    else:
+        cursor.execute("DELETE FROM metrics_latest WHERE series_id = ANY(%s)", (list(series_ids),))
+        condition, params = "s.id = ANY(%s)", (list(series_ids),)
+    cursor.execute(f"""
+        INSERT INTO metrics_latest (series_id, timestamp, value, message)
+        SELECT s.id, p.timestamp, p.value, p.message
+        FROM series s
+        CROSS JOIN LATERAL (
+            SELECT timestamp, value, message FROM points
+            WHERE series_id = s.id
+            ORDER BY timestamp DESC
+            LIMIT 1
+        ) p
+        WHERE {condition}
+        ON CONFLICT (series_id) DO NOTHING
+    """, params)
+    return cursor.rowcount
+
+def replace_latest(cursor, series_ids, rows):
+    """Replace the latest rows of the given series with (series_id, timestamp, value, message) rows."""
+    cursor.execute("DELETE FROM metrics_latest WHERE series_id = ANY(%s)", (list(series_ids),))
+    update_latest(cursor, rows)
+
+def migration_backfill_latest(cursor):
+    # Series written before metrics_latest existed; later points update it at ingest
+    rebuilt = rebuild_latest(cursor)
+    logger.info(f"Recorded the latest point of {rebuilt} series")
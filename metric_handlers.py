@@ -1,59 +1,144 @@
+import csv
+import io
 import json
 import time
 import logging
-from database import get_db
+from archive import get_archive
+from database import get_db, StreamsBusy
+from psycopg2.extras import RealDictCursor
+from downsampling import downsample_rows, numpy, MODES as DOWNSAMPLE_MODES
 import hmac
+import tornado.iostream
+import tornado.web
 from auth_handlers import BaseHandler
-import hashlib
+from query_planner import first_points, read_history
+from rollups import RESOLUTIONS, bucket_start
+from partitions import DAY
+from payload_codec import (decode_payload, StreamDecompressor, UnsupportedPayload, PayloadTooLarge,
+                           SUPPORTED_CONTENT_TYPES, SUPPORTED_ENCODINGS, MAX_DECOMPRESSED_SIZE,
+                           NDJSON_CONTENT_TYPE)
+from series import assemble_buckets, assemble_history, field_entry, MESSAGE_FIELD
+from signing import (generate_signature_v1, verify_signature_v2, SIGNATURE_HEADER, SIGNATURE_VERSION_HEADER,
+                     SIGNATURE_TIMESTAMP_HEADER, SIGNATURE_NONCE_HEADER, SIGNATURE_VERSIONS_HEADER, REPLAYED_REQUEST)
 
 logger = logging.getLogger(__name__)
 
+def build_metric_items(data):
+    hostname = data['hostname']
+    metrics = data['metrics']
+    tags = data.get('tags', {})
+
+    metric_items = []
+    for metric_name, metric_data in metrics.items():
+        if isinstance(metric_data, dict):
+            timestamp = metric_data.get('timestamp', time.time())
+            value = metric_data.get('value')
+            message = metric_data.get('message')
+        else:
+            timestamp = time.time()
+            value = metric_data
+            message = None
+
+        metric_item = {
+            'hostname': hostname,
+            'metric_name': metric_name,
+            'value': value,
+            'timestamp': timestamp,
+            'tags': tags,
+            'message': message
+        }
+        metric_items.append(metric_item)
+    return metric_items
+
 class MetricsHandler(BaseHandler):
-    def initialize(self, metric_processor, secret_key):
+    def initialize(self, metric_processor, secret_key, replay_guard, accept_v1_signatures=True, retry_after=5):
         super().initialize()
         self.metric_processor = metric_processor
         self.secret_key = secret_key
+        self.replay_guard = replay_guard
+        self.accept_v1_signatures = accept_v1_signatures
+        self.retry_after = retry_after
+
+    def set_default_headers(self):
+        # Advertise the payload formats we can decode (RFC 7694 Accept-Encoding,
+        # Accept-Post for media types) so clients can switch to them
+        self.set_header("Accept-Encoding", ", ".join(SUPPORTED_ENCODINGS))
+        self.set_header("Accept-Post", ", ".join(SUPPORTED_CONTENT_TYPES))
+
+    def prepare(self):
+        # set_default_headers runs before initialize, so handler options aren't available there
+        self.set_header(SIGNATURE_VERSIONS_HEADER, "1, 2" if self.accept_v1_signatures else "2")
+
+    def reject_overloaded(self):
+        self.set_status(503)
+        self.set_header("Retry-After", str(self.retry_after))
+        self.write({"error": "Server is overloaded, retry later"})
 
     async def post(self):
         try:
-            data = json.loads(self.request.body)
-            signature = self.request.headers.get('X-Signature')
+            # Shed load before spending any time on parsing or signature checks
+            if not self.metric_processor.accepting():
+                self.metric_processor.reject()
+                self.reject_overloaded()
+                return
 
+            signature = self.request.headers.get(SIGNATURE_HEADER)
             if not signature:
                 logger.warning("Metrics received without signature")
                 self.set_status(400)
                 self.write({"error": "Signature is required"})
                 return
 
-            if not self.verify_signature(data, signature):
+            # v2 signs the raw body, so forged or replayed requests are rejected
+            # before we spend anything on decompressing or parsing them
+            signature_version = self.request.headers.get(SIGNATURE_VERSION_HEADER, '1')
+            if signature_version == '2':
+                timestamp = self.request.headers.get(SIGNATURE_TIMESTAMP_HEADER)
+                error = verify_signature_v2(self.request.body, timestamp, signature, self.secret_key,
+                                            self.replay_guard.max_skew, self.request.headers.get(SIGNATURE_NONCE_HEADER))
+                if not error and not (await self.replay_guard.check_and_add_many([(signature, int(timestamp))]))[0]:
+                    error = REPLAYED_REQUEST
+                if error:
+                    logger.warning(f"Rejected v2 signature for metrics: {error}")
+                    self.set_status(400)
+                    self.write({"error": error})
+                    return
+            elif signature_version != '1' or not self.accept_v1_signatures:
+                logger.warning(f"Metrics received with unsupported signature version {signature_version}")
+                self.set_status(400)
+                self.write({"error": "Unsupported signature version"})
+                return
+
+            try:
+                data = decode_payload(
+                    self.request.body,
+                    content_encoding=self.request.headers.get('Content-Encoding'),
+                    content_type=self.request.headers.get('Content-Type')
+                )
+            except UnsupportedPayload as e:
+                logger.warning(f"Rejected metrics payload: {e}")
+                self.set_status(415)
+                self.write({"error": str(e)})
+                return
+            except PayloadTooLarge as e:
+                logger.warning(f"Rejected metrics payload: {e}")
+                self.set_status(413)
+                self.write({"error": str(e)})
+                return
+
+            if signature_version == '1' and not self.verify_signature(data, signature):
                 logger.warning("Invalid signature for metrics")
                 self.set_status(400)
                 self.write({"error": "Invalid signature"})
                 return
 
             hostname = data['hostname']
-            metrics = data['metrics']
-            tags = data.get('tags', {})
-
-            for metric_name, metric_data in metrics.items():
-                if isinstance(metric_data, dict):
-                    timestamp = metric_data.get('timestamp', time.time())
-                    value = metric_data.get('value')
-                    message = metric_data.get('message')
-                else:
-                    timestamp = time.time()
-                    value = metric_data
-                    message = None
-
-                metric_item = {
-                    'hostname': hostname,
-                    'metric_name': metric_name,
-                    'value': value,
-                    'timestamp': timestamp,
-                    'tags': tags,
-                    'message': message
-                }
-                self.metric_processor.enqueue_metric(metric_item)
+            metric_items = build_metric_items(data)
+
+            if not await self.metric_processor.submit_metrics(metric_items):
+                logger.warning(f"Rejected metrics from {hostname}: ingest queue is full")
+                self.reject_overloaded()
+                return
 
             self.write({"status": "received"})
         except Exception as e:
@@ -62,27 +147,201 @@ class MetricsHandler(BaseHandler):
             self.write({"error": "Internal server error"})
 
     def verify_signature(self, data, signature):
-        message = json.dumps(data, sort_keys=True, separators=(',', ':'))
-        expected_signature = hmac.new(self.secret_key.encode(), message.encode(), hashlib.sha256).hexdigest()
+        # v1: HMAC over the canonical re-serialization of the parsed payload
+        expected_signature = generate_signature_v1(data, self.secret_key)
         return hmac.compare_digest(signature, expected_signature)
 
 
+@tornado.web.stream_request_body
+class MetricsBatchHandler(BaseHandler):
+    """Bulk ingestion of many host snapshots in one streamed request.
+
+    The body is newline-delimited; every record is signed on its own with the v2 scheme:
+
+        <timestamp>\t<nonce>\t<signature over timestamp, nonce and snapshot bytes>\t<snapshot JSON>
+
+    Records are parsed as the body arrives and each received chunk is submitted to
+    the MetricProcessor as one batch, so the request never has to fit in memory.
+    """
+
+    def initialize(self, metric_processor, secret_key, replay_guard, max_body_size=1024 ** 3,
+                   max_reported_errors=1000, retry_after=5):
+        super().initialize()
+        self.metric_processor = metric_processor
+        self.secret_key = secret_key
+        self.replay_guard = replay_guard
+        self.max_body_size = max_body_size
+        self.max_reported_errors = max_reported_errors
+        self.retry_after = retry_after
+
+    def set_default_headers(self):
+        self.set_header("Accept-Encoding", ", ".join(SUPPORTED_ENCODINGS))
+
+    def prepare(self):
+        self.request.connection.set_max_body_size(self.max_body_size)
+        self.pending = b''
+        self.skipping_record = False  # discarding the rest of an oversized record
+        self.record_count = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = []
+        self.overloaded = False
+        self.failed = False
+        try:
+            self.decompressor = StreamDecompressor(self.request.headers.get('Content-Encoding'))
+        except UnsupportedPayload as e:
+            logger.warning(f"Rejected metrics batch: {e}")
+            self.failed = True
+            self.set_status(415)
+            self.finish({"error": str(e)})
+
+    def reject_record(self, record, error):
+        self.rejected += 1
+        if len(self.errors) < self.max_reported_errors:
+            self.errors.append({"record": record, "error": error})
+
+    def parse_record(self, record, line):
+        """Verify and decode one record; returns its signature, signature timestamp and
+        metric items, or None if it was rejected. Replays are checked by submit."""
+        if self.overloaded:
+            self.reject_record(record, "Server is overloaded")
+            return None
+
+        # JSON bodies never hold a raw tab, so three fields are a record signed without a nonce
+        parts = line.split(b'\t', 3)
+        if len(parts) == 4:
+            timestamp, nonce, signature, body = parts
+            nonce = nonce.decode(errors='replace')
+        elif len(parts) == 3:
+            timestamp, signature, body = parts
+            nonce = None
+        else:
+            self.reject_record(record, "Malformed record")
+            return None
+
+        timestamp = timestamp.decode(errors='replace')
+        signature = signature.decode(errors='replace')
+        error = verify_signature_v2(body, timestamp, signature, self.secret_key, self.replay_guard.max_skew, nonce)
+        if error:
+            self.reject_record(record, error)
+            return None
+
+        try:
+            return signature, int(timestamp), build_metric_items(json.loads(body))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.reject_record(record, f"Invalid snapshot: {e}")
+            return None
+
+    def take_records(self, data, final=False):
+        lines = (self.pending + data).split(b'\n')
+        self.pending = b'' if final else lines.pop()
+
+        if self.skipping_record:
+            if not lines:
+                # Still inside an oversized record, nothing to keep
+                self.pending = b''
+                return
+            # The oversized record ends at the first newline
+            lines.pop(0)
+            self.skipping_record = False
+        if len(self.pending) > MAX_DECOMPRESSED_SIZE:
+            self.pending = b''
+            self.skipping_record = True
+            self.reject_record(self.record_count, f"Record exceeds {MAX_DECOMPRESSED_SIZE} bytes")
+            self.record_count += 1
+
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            yield self.record_count, line
+            self.record_count += 1
+
+    async def submit(self, records):
+        verified = []
+        for record, line in records:
+            result = self.parse_record(record, line)
+            if result is not None:
+                verified.append((record,) + result)
+        if not verified:
+            return
+
+        # One replay check for the whole chunk
+        new = await self.replay_guard.check_and_add_many([(signature, timestamp)
+                                                          for _, signature, timestamp, _ in verified])
+        items = []
+        parsed = []
+        for (record, _, _, record_items), is_new in zip(verified, new):
+            if not is_new:
+                self.reject_record(record, REPLAYED_REQUEST)
+                continue
+            parsed.append(record)
+            items.extend(record_items)
+        if not parsed:
+            return
+
+        if not self.overloaded and self.metric_processor.accepting() and await self.metric_processor.submit_metrics(items):
+            self.accepted += len(parsed)
+            return
+
+        if not self.overloaded:
+            self.overloaded = True
+            self.metric_processor.reject()
+            logger.warning("Ingest queue is full, rejecting the rest of a metrics batch")
+        for record in parsed:
+            self.reject_record(record, "Server is overloaded")
+
+    async def data_received(self, chunk):
+        if self.failed:
+            return
+        try:
+            records = []
+            for data in self.decompressor.decompress(chunk):
+                records.extend(self.take_records(data))
+        except Exception as e:
+            logger.warning(f"Could not decompress metrics batch: {str(e)}")
+            self.failed = True
+            self.set_status(400)
+            self.finish({"error": "Could not decompress request body"})
+            return
+
+        try:
+            await self.submit(records)
+        except Exception as e:
+            logger.error(f"Error in MetricsBatchHandler: {str(e)}")
+            self.failed = True
+            self.set_status(500)
+            self.finish({"error": "Internal server error"})
+
+    async def post(self):
+        if self.failed:
+            return
+        try:
+            await self.submit(list(self.take_records(b'', final=True)))
+
+            if self.overloaded:
+                self.set_status(503)
+                self.set_header("Retry-After", str(self.retry_after))
+            logger.info(f"Metrics batch: {self.accepted} records accepted, {self.rejected} rejected")
+            self.write({"accepted": self.accepted, "rejected": self.rejected, "errors": self.errors})
+        except Exception as e:
+            logger.error(f"Error in MetricsBatchHandler: {str(e)}")
+            self.set_status(500)
+            self.write({"error": "Internal server error"})
+
+
 class FetchLatestHandler(BaseHandler):
     async def get(self):
         try:
-            with self.db.get_cursor() as cursor:
-                cursor.execute("""
-                    SELECT h.hostname, m.metric_name, m.timestamp, m.value, h.tags
-                    FROM metrics m
-                    JOIN hosts h ON m.host_id = h.id
-                    WHERE (h.id, m.metric_name, m.timestamp) IN (
-                        SELECT host_id, metric_name, MAX(timestamp)
-                        FROM metrics
-                        GROUP BY host_id, metric_name
-                    )
-                    ORDER BY h.hostname, m.metric_name
-                """)
-                results = cursor.fetchall()
+            # metrics_latest holds one row per series, so this never touches the history
+            results = await self.db.fetchall("""
+                SELECT h.hostname, h.tags, s.metric_name, s.field, l.value, l.message
+                FROM metrics_latest l
+                JOIN series s ON l.series_id = s.id
+                JOIN hosts h ON s.host_id = h.id
+                WHERE s.field <> %s
+                ORDER BY h.hostname, s.metric_name, s.field
+            """, (MESSAGE_FIELD,))
 
             latest_metrics = {}
             for row in results:
@@ -93,17 +352,8 @@ class FetchLatestHandler(BaseHandler):
                         'tags': row['tags'] if isinstance(row['tags'], dict) else {}
                     }
 
-                metric_value = row['value']
-                if isinstance(metric_value, str):
-                    try:
-                        metric_value = json.loads(metric_value)
-                    except json.JSONDecodeError:
-                        logger.error(f"Invalid JSON in metric value for {hostname} - {row['metric_name']}")
-                        metric_value = {'value': metric_value}  # Fallback to treating it as a single value
-                elif not isinstance(metric_value, dict):
-                    metric_value = {'value': metric_value}  # Wrap non-dict values
-
-                latest_metrics[hostname]['metrics'][row['metric_name']] = metric_value
+                module = latest_metrics[hostname]['metrics'].setdefault(row['metric_name'], {})
+                module[row['field']] = field_entry(row['value'], row['message'])
 
             self.set_header("Content-Type", "application/json")
             self.write(json.dumps(latest_metrics))
@@ -113,59 +363,270 @@ class FetchLatestHandler(BaseHandler):
             self.write(json.dumps({"error": "Internal server error", "details": str(e)}))
 
 
+def history_start(firsts, series_ids, start):
+    """start, or the time of the series' oldest stored point when start isn't set; None
+    when nothing is stored.
+
+    Raw and archived points give the exact time. A rollup tier only moves it back for
+    buckets wholly older than the finer tiers reach, so bucket alignment never widens
+    the range and with it the tier the history is read from.
+    """
+    if start > 0:
+        return start
+    archive = get_archive()
+    oldest = min(firsts['raw'].values(), default=None)
+    archived = archive.first_timestamp(series_ids) if archive else None
+    if archived is not None and (oldest is None or archived < oldest):
+        oldest = archived
+    for resolution, width in RESOLUTIONS.items():
+        first = min(firsts[resolution].values(), default=None)
+        if first is not None and (oldest is None or first + width <= oldest):
+            oldest = first
+    return oldest
+
 class FetchHistoryHandler(BaseHandler):
     async def get(self, hostname, metric_name):
         try:
             start = float(self.get_argument("start", 0))
             end = float(self.get_argument("end", time.time()))
-            target_points = int(self.get_argument("target_points", 500))  # Changed from limit to target_points
-
-            with self.db.get_cursor() as cursor:
-                cursor.execute("""
-                    SELECT m.timestamp, m.value, m.message
-                    FROM metrics m
-                    JOIN hosts h ON m.host_id = h.id
-                    WHERE h.hostname = %s AND m.metric_name = %s AND m.timestamp BETWEEN %s AND %s
-                    ORDER BY m.timestamp
-                """, (hostname, metric_name, start, end))
-
-                history = cursor.fetchall()
-
-            result = []
-            for point in history:
-                data_point = {'timestamp': point['timestamp']}
-                value = point['value']
-
-                if isinstance(value, str):
-                    try:
-                        value = json.loads(value)
-                    except json.JSONDecodeError:
-                        logger.error(f"Invalid JSON in metric value for {hostname} - {metric_name}")
-                        value = {'value': value}  # Fallback to treating it as a single value
-                elif not isinstance(value, dict):
-                    value = {'value': value}  # Wrap non-dict values
-
-                data_point.update(value)
-                if point['message']:
-                    data_point['message'] = point['message']
-                result.append(data_point)
-
-            # Adaptive sampling
-            if len(result) > target_points:
-                sampled_result = []
-                step = len(result) / target_points
-                current_index = 0
-                while current_index < len(result):
-                    sampled_result.append(result[int(current_index)])
-                    current_index += step
-                result = sampled_result
+            target_points = int(self.get_argument("target_points", 500))
+        except ValueError:
+            self.set_status(400)
+            self.write({"error": "start, end and target_points must be numbers"})
+            return
+        if target_points < 1:
+            self.set_status(400)
+            self.write({"error": "target_points must be positive"})
+            return
+        downsample = self.get_argument("downsample", None)
+        if downsample is not None and downsample not in DOWNSAMPLE_MODES:
+            self.set_status(400)
+            self.write({"error": f"downsample must be one of {', '.join(DOWNSAMPLE_MODES)}"})
+            return
+        if downsample and numpy is None:
+            self.set_status(400)
+            self.write({"error": "downsample needs numpy installed on the server"})
+            return
 
+        try:
+            if downsample:
+                result = await self.db.run(self.fetch_downsampled, hostname, metric_name, start, end,
+                                           target_points, downsample)
+            else:
+                result = await self.db.run(self.fetch_history, hostname, metric_name, start, end, target_points)
             self.write(json.dumps(result))
         except Exception as e:
             logger.error(f"Error in FetchHistoryHandler: {str(e)}", exc_info=True)
             self.set_status(500)
             self.write({"error": "Internal server error", "details": str(e)})
 
+    def history_range(self, cursor, hostname, metric_name, start, end):
+        """The metric's series as {id: field}, their first_points and the start to read from.
+
+        Returns None when there is nothing to read.
+        """
+        cursor.execute("""
+            SELECT s.id, s.field
+            FROM series s
+            JOIN hosts h ON s.host_id = h.id
+            WHERE h.hostname = %s AND s.metric_name = %s
+        """, (hostname, metric_name))
+        fields = {row['id']: row['field'] for row in cursor.fetchall()}
+        if not fields:
+            return None
+        firsts = first_points(cursor, self.storage, list(fields))
+        start = history_start(firsts, list(fields), start)
+        if start is None or end <= start:
+            return None
+        return fields, firsts, start
+
+    def fetch_history(self, cursor, hostname, metric_name, start, end, target_points):
+        """The range split into target_points buckets, read from the coarsest tier that has them."""
+        found = self.history_range(cursor, hostname, metric_name, start, end)
+        if found is None:
+            return []
+        fields, firsts, start = found
+        rows = read_history(cursor, self.storage, get_archive(), list(fields), firsts, start, end, target_points)
+        return assemble_buckets(rows, fields)
+
+    def fetch_downsampled(self, cursor, hostname, metric_name, start, end, target_points, mode):
+        """Raw points of the range, thinned by mode to keep each series' shape."""
+        metadata = {"mode": mode, "target_points": target_points, "raw_points": 0, "kept_points": 0}
+        found = self.history_range(cursor, hostname, metric_name, start, end)
+        if found is None:
+            return {"downsampling": metadata, "history": []}
+        fields, _, start = found
+        series_ids = list(fields)
+        rows = self.storage.read(cursor, series_ids, start, end)
+        archive = get_archive()
+        if archive:
+            rows = archive.merge(rows, series_ids, start, end)
+        skip = {series_id for series_id, field in fields.items() if field == MESSAGE_FIELD}
+        selected = downsample_rows(rows, mode, target_points, start, end, skip)
+        history = assemble_history([{'field': fields[series_id], 'timestamp': timestamp, 'value': value,
+                                     'message': message} for series_id, timestamp, value, message in selected])
+        metadata.update({"start": start, "end": end, "raw_points": len(rows), "kept_points": len(selected)})
+        return {"downsampling": metadata, "history": history}
+
+class FetchHistoryBatchHandler(BaseHandler):
+    async def post(self):
+        try:
+            data = json.loads(self.request.body)
+            pairs = [(item['hostname'], item['metric_name']) for item in data['series']]
+            start = float(data.get('start', 0))
+            end = float(data.get('end', time.time()))
+            target_points = int(data.get('target_points', 500))
+        except (ValueError, KeyError, TypeError):
+            self.set_status(400)
+            self.write({"error": "Expected a series list of hostname and metric_name objects; "
+                                 "start, end and target_points must be numbers"})
+            return
+        if not pairs:
+            self.set_status(400)
+            self.write({"error": "series must not be empty"})
+            return
+        if target_points < 1:
+            self.set_status(400)
+            self.write({"error": "target_points must be positive"})
+            return
+
+        try:
+            result = await self.db.run(self.fetch_histories, pairs, start, end, target_points)
+            self.write(json.dumps(result))
+        except Exception as e:
+            logger.error(f"Error in FetchHistoryBatchHandler: {str(e)}", exc_info=True)
+            self.set_status(500)
+            self.write({"error": "Internal server error", "details": str(e)})
+
+    def fetch_histories(self, cursor, pairs, start, end, target_points):
+        """History of every (hostname, metric name) pair over one range, as
+        {hostname: {metric_name: points}}, read together for all their series."""
+        result = {}
+        for hostname, metric_name in pairs:
+            result.setdefault(hostname, {})[metric_name] = []
+        cursor.execute("""
+            SELECT s.id, h.hostname, s.metric_name, s.field
+            FROM unnest(%s::text[], %s::text[]) AS q (hostname, metric_name)
+            JOIN hosts h ON h.hostname = q.hostname
+            JOIN series s ON s.host_id = h.id AND s.metric_name = q.metric_name
+        """, ([hostname for hostname, _ in pairs], [metric_name for _, metric_name in pairs]))
+        series = {row['id']: (row['hostname'], row['metric_name'], row['field']) for row in cursor.fetchall()}
+        if not series:
+            return result
+        series_ids = list(series)
+        firsts = first_points(cursor, self.storage, series_ids)
+        start = history_start(firsts, series_ids, start)
+        if start is None or end <= start:
+            return result
+
+        rows_by_metric = {}
+        for row in read_history(cursor, self.storage, get_archive(), series_ids, firsts, start, end, target_points):
+            rows_by_metric.setdefault(series[row[0]][:2], []).append(row)
+        fields = {series_id: field for series_id, (_, _, field) in series.items()}
+        for (hostname, metric_name), rows in rows_by_metric.items():
+            result[hostname][metric_name] = assemble_buckets(rows, fields)
+        return result
+
+# Rows fetched from storage per chunk of a streamed export
+EXPORT_CHUNK_SIZE = 10000
+EXPORT_RETRY_AFTER = 10
+EXPORT_COLUMNS = ('timestamp', 'field', 'value', 'message')
+EXPORT_CONTENT_TYPES = {'csv': 'text/csv; charset=UTF-8', 'ndjson': NDJSON_CONTENT_TYPE}
+
+class ExportHistoryHandler(BaseHandler):
+    async def get(self, hostname, metric_name):
+        try:
+            start = float(self.get_argument("start", 0))
+            end = float(self.get_argument("end", time.time()))
+        except ValueError:
+            self.set_status(400)
+            self.write({"error": "start and end must be numbers"})
+            return
+        export_format = self.get_argument("format", "csv")
+        if export_format not in EXPORT_CONTENT_TYPES:
+            self.set_status(400)
+            self.write({"error": f"format must be one of {', '.join(EXPORT_CONTENT_TYPES)}"})
+            return
+
+        started = False
+        rows = None
+        try:
+            fields = await self.db.run(self.fetch_fields, hostname, metric_name)
+            self.set_header("Content-Type", EXPORT_CONTENT_TYPES[export_format])
+            self.set_header("Content-Disposition",
+                            f'attachment; filename="{hostname}_{metric_name}.{export_format}"')
+            if export_format == 'csv':
+                self.write(self.format_csv([EXPORT_COLUMNS]))
+            rows = self.db.stream(self.export_rows, list(fields), start if start > 0 else None, end)
+            async for chunk in rows:
+                lines = [(timestamp, fields[series_id], value, message)
+                         for series_id, timestamp, value, message in chunk]
+                self.write(self.format_csv(lines) if export_format == 'csv' else self.format_ndjson(lines))
+                # Without a Content-Length, flushing sends the body with chunked transfer encoding
+                await self.flush()
+                started = True
+        except tornado.iostream.StreamClosedError:
+            logger.info(f"Client went away during the export of {hostname}/{metric_name}")
+        except StreamsBusy:
+            # Raised before the first chunk, so nothing has been sent yet
+            logger.warning(f"Rejected the export of {hostname}/{metric_name}: too many exports running")
+            self.clear()
+            self.set_status(503)
+            self.set_header("Retry-After", str(EXPORT_RETRY_AFTER))
+            self.write({"error": "Too many exports running, retry later"})
+        except Exception as e:
+            logger.error(f"Error in ExportHistoryHandler: {str(e)}", exc_info=True)
+            if started:
+                # Too late for an error status; the cut-off chunked response tells the client
+                raise
+            self.clear()
+            self.set_status(500)
+            self.write({"error": "Internal server error", "details": str(e)})
+        finally:
+            if rows is not None:
+                await rows.aclose()
+
+    def fetch_fields(self, cursor, hostname, metric_name):
+        cursor.execute("""
+            SELECT s.id, s.field
+            FROM series s
+            JOIN hosts h ON s.host_id = h.id
+            WHERE h.hostname = %s AND s.metric_name = %s
+        """, (hostname, metric_name))
+        return {row['id']: row['field'] for row in cursor.fetchall()}
+
+    def export_rows(self, conn, series_ids, start, end):
+        """Chunks of raw rows of the series in [start, end], one series after another with
+        its archived points first; runs on db.stream."""
+        if not series_ids:
+            return
+        archive = get_archive()
+        archive_start = archive.start() if archive else None
+        if archive_start is not None:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                firsts = self.storage.first_timestamps(cursor, series_ids)
+            archive_end = archive.end()
+        for series_id in sorted(series_ids):
+            if archive_start is not None:
+                # A day at a time, so only one day's points are held
+                day = bucket_start(max(start, archive_start) if start is not None else archive_start, DAY)
+                while day < archive_end and day <= end:
+                    day_start = max(day, start) if start is not None else day
+                    chunk = [row for row in archive.read_before([series_id], day_start, min(day + DAY, end), firsts)
+                             if row[1] < day + DAY]
+                    for i in range(0, len(chunk), EXPORT_CHUNK_SIZE):
+                        yield chunk[i:i + EXPORT_CHUNK_SIZE]
+                    day += DAY
+            yield from self.storage.export(conn, [series_id], start, end, EXPORT_CHUNK_SIZE)
+
+    def format_csv(self, lines):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(lines)
+        return buffer.getvalue()
+
+    def format_ndjson(self, lines):
+        return ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, line))) + '\n' for line in lines)
+
 class FetchMetricsForHostHandler(BaseHandler):
     async def get(self):
         hostname = self.get_argument('hostname', None)
@@ -175,15 +636,14 @@ class FetchMetricsForHostHandler(BaseHandler):
             return
 
         try:
-            with self.db.get_cursor() as cursor:
-                cursor.execute("""
-                    SELECT DISTINCT m.metric_name
-                    FROM metrics m
-                    JOIN hosts h ON m.host_id = h.id
-                    WHERE h.hostname = %s
-                    ORDER BY m.metric_name
-                """, (hostname,))
-                metrics = [row['metric_name'] for row in cursor.fetchall()]
+            rows = await self.db.fetchall("""
+                SELECT DISTINCT s.metric_name
+                FROM series s
+                JOIN hosts h ON s.host_id = h.id
+                WHERE h.hostname = %s
+                ORDER BY s.metric_name
+            """, (hostname,))
+            metrics = [row['metric_name'] for row in rows]
 
             self.write(json.dumps(metrics))
         except Exception as e:
@@ -205,32 +665,11 @@ class DeleteMetricsHandler(BaseHandler):
                 self.write({"error": "Hostname is required"})
                 return
 
-            with self.db.get_cursor() as cursor:
-                cursor.execute("SELECT id FROM hosts WHERE hostname = %s", (hostname,))
-                host = cursor.fetchone()
-                if not host:
-                    self.set_status(404)
-                    self.write({"error": "Host not found"})
-                    return
-
-                host_id = host['id']
-
-                delete_query = "DELETE FROM metrics WHERE host_id = %s"
-                params = [host_id]
-
-                if metric_name and metric_name != 'all':
-                    delete_query += " AND metric_name = %s"
-                    params.append(metric_name)
-
-                if start_time:
-                    delete_query += " AND timestamp >= %s"
-                    params.append(start_time)
-                if end_time:
-                    delete_query += " AND timestamp <= %s"
-                    params.append(end_time)
-
-                cursor.execute(delete_query, params)
-                deleted_count = cursor.rowcount
+            deleted_count = await self.db.run(self.delete_metrics, hostname, metric_name, start_time, end_time)
+            if deleted_count is None:
+                self.set_status(404)
+                self.write({"error": "Host not found"})
+                return
 
             message = f"Successfully deleted {deleted_count} metrics"
             if metric_name and metric_name != 'all':
@@ -240,4 +679,52 @@ class DeleteMetricsHandler(BaseHandler):
         except Exception as e:
             logger.error(f"Error in DeleteMetricsHandler: {str(e)}")
             self.set_status(500)
-            self.write({"error": "Internal server error"})
\ No newline at end of file
+            self.write({"error": "Internal server error"})
+
+    def delete_metrics(self, cursor, hostname, metric_name, start_time, end_time):
+        cursor.execute("SELECT id FROM hosts WHERE hostname = %s", (hostname,))
+        host = cursor.fetchone()
+        if not host:
+            return None
+
+        series_query = "SELECT id FROM series WHERE host_id = %s"
+        series_params = [host['id']]
+        if metric_name and metric_name != 'all':
+            series_query += " AND metric_name = %s"
+            series_params.append(metric_name)
+
+        cursor.execute(series_query, series_params)
+        series_ids = [row['id'] for row in cursor.fetchall()]
+        if not series_ids:
+            return 0
+        deleted_count = self.storage.delete(cursor, series_ids, start_time or None, end_time or None)
+
+        # Buckets overlapping the deleted range and latest values are recomputed from what's left
+        self.storage.rebuild_rollups(cursor, start_time or None, end_time or None, series_ids)
+        self.storage.rebuild_latest(cursor, series_ids)
+
+        # Series left without points would still be listed for the host; daily
+        # rollups are kept the longest, so a series with any left is kept too
+        emptied = set(series_ids) - self.storage.series_with_points(cursor, series_ids)
+        cursor.execute("""
+            DELETE FROM series WHERE id = ANY(%s)
+            AND NOT EXISTS (SELECT 1 FROM rollups_1d WHERE rollups_1d.series_id = series.id)
+        """, (list(emptied),))
+        return deleted_count
+
+class IngestStatsHandler(BaseHandler):
+    def initialize(self, metric_processor):
+        super().initialize()
+        self.metric_processor = metric_processor
+
+    async def get(self):
+        try:
+            self.set_header("Content-Type", "application/json")
+            stats = self.metric_processor.get_stats()
+            stats['db_pool'] = self.db.get_stats()
+            stats['storage'] = self.storage.get_stats()
+            self.write(json.dumps(stats))
+        except Exception as e:
+            logger.error(f"Error in IngestStatsHandler: {str(e)}")
+            self.set_status(500)
+            self.write({"error": "Internal server error"})
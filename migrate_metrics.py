@@ -0,0 +1,119 @@
+import argparse
+import logging
+from psycopg2.extras import execute_values
+from database import init_db, get_db, load_config
+from latest import update_latest
+from partitions import configure_partitions
+from rollups import add_points
+from series import flatten_value
+from storage import init_storage, get_storage
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def legacy_table_exists(cursor):
+    cursor.execute("SELECT to_regclass('metrics') IS NOT NULL AS exists")
+    return cursor.fetchone()['exists']
+
+def read_chunk(cursor, last_id, chunk_size):
+    """Series points of the next chunk of legacy rows, creating their series;
+    returns (last id, [(series id, timestamp, value, message)])."""
+    cursor.execute("""
+        SELECT id, host_id, metric_name, timestamp, value, message
+        FROM metrics
+        WHERE id > %s
+        ORDER BY id
+        LIMIT %s
+    """, (last_id, chunk_size))
+    rows = cursor.fetchall()
+    if not rows:
+        return None, []
+
+    points = [
+        (row['host_id'], row['metric_name'], field, row['timestamp'], value, message)
+        for row in rows if row['host_id'] is not None
+        for field, value, message in flatten_value(row['value'], row['message'])
+    ]
+    if not points:
+        return rows[-1]['id'], []
+
+    series_rows = execute_values(cursor, """
+        INSERT INTO series (host_id, metric_name, field)
+        VALUES %s
+        ON CONFLICT (host_id, metric_name, field) DO UPDATE
+        SET field = EXCLUDED.field
+        RETURNING id, host_id, metric_name, field
+    """, sorted({(host_id, metric_name, field) for host_id, metric_name, field, _, _, _ in points}), fetch=True)
+    series_ids = {(row['host_id'], row['metric_name'], row['field']): row['id'] for row in series_rows}
+
+    return rows[-1]['id'], [(series_ids[(host_id, metric_name, field)], timestamp, value, message)
+                            for host_id, metric_name, field, timestamp, value, message in points]
+
+def migrate_chunk(db, storage, last_id, chunk_size):
+    """Copy the next chunk of legacy rows the way ingest writes points, so the rollups
+    and latest values cover them; returns (last id, points read, points written)."""
+    with db.get_cursor() as cursor:
+        last_id, rows = read_chunk(cursor, last_id, chunk_size)
+    if not rows:
+        return last_id, 0, 0
+    storage.prepare(db, [timestamp for _, timestamp, _, _ in rows])
+    with db.get_cursor() as cursor:
+        inserted = storage.write(cursor, rows)
+        add_points(cursor, [(series_id, timestamp, value) for series_id, timestamp, value, _ in inserted])
+        update_latest(cursor, inserted)
+    return last_id, len(rows), len(inserted)
+
+def migrate(start_id=0, chunk_size=10000, drop_legacy=False):
+    db = get_db()
+    storage = get_storage()
+    with db.get_cursor() as cursor:
+        if not legacy_table_exists(cursor):
+            logger.info("No legacy metrics table found, nothing to migrate")
+            return
+
+    # Short transactions per chunk keep locks short, so the server can keep ingesting
+    # meanwhile; points already copied are skipped, so an interrupted run can be
+    # restarted from the last logged id
+    last_id = start_id
+    chunks = 0
+    total_points = 0
+    total_written = 0
+    while True:
+        chunk_last_id, read, written = migrate_chunk(db, storage, last_id, chunk_size)
+        if chunk_last_id is None:
+            break
+        chunks += 1
+        total_points += read
+        total_written += written
+        last_id = chunk_last_id
+        logger.info(f"Migrated legacy metrics up to id {last_id} ({total_points} points processed so far)")
+
+    logger.info(f"Migration complete: {total_points} points processed in {chunks} chunks, "
+                f"{total_written} of them new")
+
+    if drop_legacy:
+        with db.get_cursor() as cursor:
+            cursor.execute("DROP TABLE metrics")
+        logger.info("Dropped legacy metrics table")
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy legacy JSONB metrics rows into series and the configured storage backend")
+    parser.add_argument('--config', default='server_config.json', help="Path to the server config file")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="Legacy rows copied per chunk")
+    parser.add_argument('--start-id', type=int, default=0, help="Resume after this legacy metrics id")
+    parser.add_argument('--drop-legacy', action='store_true', help="Drop the legacy metrics table once copied")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    init_db(config['database'])
+    configure_partitions(config.get('partitions', {}))
+    # Points go through the configured backend, so they are stored wherever the server reads them
+    storage = init_storage(config.get('storage', {}))
+    try:
+        migrate(args.start_id, args.chunk_size, args.drop_legacy)
+    finally:
+        storage.close()
+        get_db().close()
+
+if __name__ == "__main__":
+    main()
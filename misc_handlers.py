@@ -1,7 +1,7 @@
 import tornado.web
 import logging
 from auth_handlers import BaseHandler
-from data_aggregator import aggregate_data
+from data_aggregator import request_run, load_status
 
 logger = logging.getLogger(__name__)
 
@@ -25,11 +25,30 @@ class JSHandler(BaseHandler):
             self.write({"error": "Internal server error"})
 
 class AggregateDataHandler(BaseHandler):
-    def get(self):
+    def initialize(self, aggregation_job=None):
+        super().initialize()
+        # Only the process running the job has it; the others go through job_state
+        self.aggregation_job = aggregation_job
+
+    async def get(self):
+        try:
+            status = await self.db.run(load_status)
+            if self.aggregation_job is not None:
+                status.update(self.aggregation_job.get_status())
+            self.write(status)
+        except Exception as e:
+            logger.error(f"Error in AggregateDataHandler: {str(e)}")
+            self.set_status(500)
+            self.write({"error": "Internal server error"})
+
+    async def post(self):
         try:
-            aggregate_data()
-            self.write({"status": "Data aggregation triggered successfully"})
+            await self.db.run(request_run)
+            if self.aggregation_job is not None:
+                self.aggregation_job.trigger()
+            self.set_status(202)
+            self.write({"status": "Data aggregation scheduled"})
         except Exception as e:
             logger.error(f"Error in AggregateDataHandler: {str(e)}")
             self.set_status(500)
-            self.write({"error": "Internal server error"})
\ No newline at end of file
+            self.write({"error": "Internal server error"})
@@ -3,8 +3,9 @@ import json
 import logging
 import time
 import asyncio
-import hmac
-import hashlib
+from payload_codec import encode_payload, compress, parse_header_list, NDJSON_CONTENT_TYPE
+from signing import (generate_signature_v1, sign_v2, sign_record, SIGNATURE_HEADER, SIGNATURE_VERSIONS_HEADER,
+                     REPLAYED_REQUEST)
 
 logger = logging.getLogger(__name__)
 
@@ -13,36 +14,140 @@ class NetworkManager:
         self.config_manager = config_manager
         self.max_retries = 5
         self.retry_delay = 5  # seconds
+        self.backoff_until = 0  # set when the server asks us to back off via Retry-After
+        # Payload formats the server advertised on its last /metrics response
+        self.server_content_types = []
+        self.server_encodings = []
+        self.server_signature_versions = []
+        self.batch_supported = True  # cleared if the server has no /metrics/batch endpoint
 
     def generate_signature(self, data):
-        message = json.dumps(data, sort_keys=True, separators=(',', ':'))
-        signature = hmac.new(self.config_manager.secret_key.encode(), message.encode(), hashlib.sha256).hexdigest()
-        return signature
+        return generate_signature_v1(data, self.config_manager.secret_key)
 
-    async def send_metrics(self, data_to_send):
-        signature = self.generate_signature(data_to_send)
-        headers = {'X-Signature': signature}
+    def sign(self, data, body):
+        # v2 only hashes the bytes we send; fall back to v1 until the server says it understands v2
+        if '2' in self.server_signature_versions:
+            return sign_v2(body, self.config_manager.secret_key)
+        return {SIGNATURE_HEADER: self.generate_signature(data)}
+
+    def parse_retry_after(self, value):
+        try:
+            return max(0, int(value))
+        except (TypeError, ValueError):
+            return self.retry_delay
+
+    async def send_metrics(self, data_to_send, buffer_on_failure=True):
+        if time.time() < self.backoff_until:
+            logger.info(f"Server asked us to back off for {self.backoff_until - time.time():.0f}s more, buffering metrics")
+            if buffer_on_failure:
+                self.config_manager.buffer_manager.add(data_to_send)
+            return False
 
         for attempt in range(self.max_retries):
+            body, headers = encode_payload(data_to_send, self.server_content_types, self.server_encodings)
+            headers.update(self.sign(data_to_send, body))
             try:
                 async with aiohttp.ClientSession() as session:
                     async with session.post(
                         f"{self.config_manager.server_url}/metrics",
-                        json=data_to_send,
+                        data=body,
                         headers=headers,
                         timeout=10.0
                     ) as response:
+                        self.server_content_types = parse_header_list(response.headers.get('Accept-Post'))
+                        self.server_encodings = parse_header_list(response.headers.get('Accept-Encoding'))
+                        self.server_signature_versions = parse_header_list(response.headers.get(SIGNATURE_VERSIONS_HEADER))
+                        if response.status == 415:
+                            # The server can't read what we sent; the retry uses what it just advertised
+                            logger.warning(f"Server rejected payload format {headers}, retrying with {self.server_content_types}")
+                            continue
+                        if response.status in (429, 503):
+                            retry_after = self.parse_retry_after(response.headers.get('Retry-After'))
+                            self.backoff_until = time.time() + retry_after
+                            logger.warning(f"Server is overloaded (status {response.status}), backing off for {retry_after}s")
+                            if buffer_on_failure:
+                                self.config_manager.buffer_manager.add(data_to_send)
+                                logger.info("Added metrics to buffer while server is overloaded")
+                            return False
                         response_json = await response.json()
+                        if response.status != 200:
+                            if response_json.get('error') == REPLAYED_REQUEST and buffer_on_failure:
+                                # Our signatures never repeat, so this isn't a verdict on the metrics
+                                logger.warning("Server took our metrics for a replay, buffering them for a resend")
+                                self.config_manager.buffer_manager.add(data_to_send)
+                                return False
+                            logger.error(f"Server rejected metrics with status {response.status}: {response_json}")
+                            return False
                         logger.info(f"Sent metrics: {data_to_send}, response: {response_json}")
-                        return  # Exit the retry loop if successful
+                        return True  # Exit the retry loop if successful
             except Exception as e:
                 logger.error(f"Error sending metrics (attempt {attempt + 1}/{self.max_retries}): {e}", exc_info=True)
                 if attempt < self.max_retries - 1:
                     await asyncio.sleep(self.retry_delay)
-                else:
+                elif buffer_on_failure:
                     # If all retries fail, add to buffer
                     self.config_manager.buffer_manager.add(data_to_send)
                     logger.info("Added metrics to buffer after failed retries")
+        return False
+
+    def can_send_batch(self):
+        # Batch records are always v2-signed
+        return self.batch_supported and '2' in self.server_signature_versions
+
+    async def send_metrics_batch(self, snapshots):
+        """Send many snapshots in one /metrics/batch request.
+
+        Returns the indices of snapshots the server is done with (accepted, or
+        rejected for good), or None if the request failed as a whole. Snapshots
+        rejected because the server is overloaded or took them for a replay are
+        left for a later retry.
+        """
+        if time.time() < self.backoff_until:
+            return None
+
+        secret_key = self.config_manager.secret_key
+        body = b''.join(sign_record(json.dumps(snapshot).encode(), secret_key) for snapshot in snapshots)
+        body, headers = compress(body, self.server_encodings)
+        headers['Content-Type'] = NDJSON_CONTENT_TYPE
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(
+                    f"{self.config_manager.server_url}/metrics/batch",
+                    data=body,
+                    headers=headers,
+                    timeout=60.0
+                ) as response:
+                    if response.status in (404, 405):
+                        logger.info("Server does not support batch ingestion, sending buffered metrics one by one")
+                        self.batch_supported = False
+                        return None
+                    if response.status in (429, 503):
+                        retry_after = self.parse_retry_after(response.headers.get('Retry-After'))
+                        self.backoff_until = time.time() + retry_after
+                        logger.warning(f"Server is overloaded (status {response.status}), backing off for {retry_after}s")
+                    elif response.status != 200:
+                        logger.error(f"Server rejected metrics batch with status {response.status}: {await response.text()}")
+                        return None
+                    result = await response.json()
+        except Exception as e:
+            logger.error(f"Error sending metrics batch: {e}", exc_info=True)
+            return None
+
+        errors = result.get('errors', [])
+        retry = set()
+        for error in errors:
+            # Resends are signed afresh, so a replay rejection is retried rather than given up on
+            if error['error'] in ("Server is overloaded", REPLAYED_REQUEST):
+                retry.add(error['record'])
+            else:
+                logger.error(f"Server rejected buffered metrics record {error['record']}: {error['error']}")
+        # The server caps the error list; records after the last reported one have an unknown outcome
+        if len(errors) == result['rejected']:
+            known = len(snapshots)
+        else:
+            known = errors[-1]['record'] + 1 if errors else 0
+        logger.info(f"Sent metrics batch: {result['accepted']} accepted, {result['rejected']} rejected")
+        return [index for index in range(known) if index not in retry]
 
     async def check_for_updates(self):
         try:
@@ -0,0 +1,176 @@
+import bisect
+import logging
+import re
+import time
+from datetime import datetime, timezone
+from psycopg2 import sql
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 60 * 60
+LEGACY_PARTITION = 'points_legacy'
+PARTITION_LOCK_ID = 727275
+
+# Set from the "partitions" config section at startup
+partition_days = 1
+precreate_days = 7
+
+BOUND_PATTERN = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+def configure_partitions(config):
+    global partition_days, precreate_days
+    partition_days = config.get('partition_days', 1)
+    precreate_days = config.get('precreate_days', 7)
+
+def _parse_bound(value):
+    value = value.strip("'")
+    if value == 'MINVALUE':
+        return float('-inf')
+    if value == 'MAXVALUE':
+        return float('inf')
+    return float(value)
+
+def is_partitioned(cursor):
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = 'points'::regclass")
+    return cursor.fetchone()['relkind'] == 'p'
+
+def partition_ranges(cursor):
+    """Return [(name, start, end)] for every partition of points, ordered by start."""
+    cursor.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'points'::regclass
+    """)
+    ranges = []
+    for row in cursor.fetchall():
+        match = BOUND_PATTERN.search(row['bound'])
+        if match:
+            ranges.append((row['relname'], _parse_bound(match.group(1)), _parse_bound(match.group(2))))
+    return sorted(ranges, key=lambda r: r[1])
+
+def partition_name(start):
+    moment = datetime.fromtimestamp(start, tz=timezone.utc)
+    if start % DAY == 0:
+        return f"points_{moment:%Y%m%d}"
+    return f"points_{moment:%Y%m%d_%H%M%S}"
+
+def partition_width():
+    return partition_days * DAY
+
+def window_start(timestamp):
+    return timestamp - timestamp % partition_width()
+
+def _gaps(start, end, ranges):
+    """Parts of [start, end) not covered by any existing partition range."""
+    gaps = []
+    position = start
+    for _, range_start, range_end in ranges:
+        if range_end <= position:
+            continue
+        if range_start >= end:
+            break
+        if range_start > position:
+            gaps.append((position, range_start))
+        position = max(position, range_end)
+        if position >= end:
+            break
+    if position < end:
+        gaps.append((position, end))
+    return gaps
+
+def ensure_partitions(cursor, start, end):
+    """Create the partitions needed to hold timestamps in [start, end); returns the names created.
+
+    Creating a partition locks points exclusively until commit, so run this in its
+    own short transaction, never inside a batch or aggregation transaction.
+    """
+    # Serialize creation across workers and processes; ranges are read under the lock
+    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (PARTITION_LOCK_ID,))
+    ranges = partition_ranges(cursor)
+    width = partition_width()
+    created = []
+    window = window_start(start)
+    while window < end:
+        for gap_start, gap_end in _gaps(window, window + width, ranges):
+            name = partition_name(gap_start)
+            cursor.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF points FOR VALUES FROM (%s) TO (%s)")
+                           .format(sql.Identifier(name)), (gap_start, gap_end))
+            created.append(name)
+            logger.info(f"Created partition {name} for {gap_start:.0f}..{gap_end:.0f}")
+        window += width
+    return created
+
+def precreate_partitions(cursor):
+    now = time.time()
+    return ensure_partitions(cursor, now, now + precreate_days * DAY)
+
+def drop_partitions_before(cursor, cutoff):
+    """Drop every partition whose range ends at or before cutoff; returns the names dropped."""
+    dropped = []
+    for name, _, end in partition_ranges(cursor):
+        if end <= cutoff:
+            cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+            dropped.append(name)
+            logger.info(f"Dropped partition {name} (data before {end:.0f})")
+    return dropped
+
+class PartitionCache:
+    """Remembers which time ranges of points have a partition, so ingest only
+    touches the catalog when a batch brings a timestamp outside them."""
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def load(self, ranges):
+        self.starts = [start for _, start, _ in ranges]
+        self.ends = [end for _, _, end in ranges]
+
+    def covers(self, timestamp):
+        index = bisect.bisect_right(self.starts, timestamp) - 1
+        return index >= 0 and timestamp < self.ends[index]
+
+    def clear(self):
+        self.starts = []
+        self.ends = []
+
+def migration_partition_points(cursor):
+    """Turn the plain points table into a range-partitioned one.
+
+    The existing table is attached as the first partition, bounded just past
+    tomorrow, so no rows are moved. Its bound is validated as a CHECK constraint
+    first; that scan only takes a lock that lets ingestion continue, and ATTACH
+    then trusts the constraint instead of scanning under an exclusive lock.
+    """
+    if is_partitioned(cursor):
+        return
+    boundary = window_start(time.time()) + 2 * DAY
+    boundary -= boundary % DAY
+
+    cursor.execute("ALTER TABLE points DROP CONSTRAINT IF EXISTS points_legacy_bound")
+    cursor.execute("ALTER TABLE points ADD CONSTRAINT points_legacy_bound CHECK (timestamp < %s) NOT VALID", (boundary,))
+    cursor.execute("ALTER TABLE points VALIDATE CONSTRAINT points_legacy_bound")
+
+    cursor.execute("BEGIN")
+    try:
+        cursor.execute("ALTER TABLE points RENAME TO points_legacy")
+        cursor.execute("ALTER INDEX points_pkey RENAME TO points_legacy_pkey")
+        cursor.execute("ALTER INDEX IF EXISTS idx_points_timestamp_brin RENAME TO points_legacy_timestamp_brin")
+        cursor.execute("""
+            CREATE TABLE points (
+                series_id INTEGER NOT NULL REFERENCES series(id) ON DELETE CASCADE,
+                timestamp FLOAT NOT NULL,
+                value DOUBLE PRECISION,
+                message TEXT,
+                PRIMARY KEY (series_id, timestamp)
+            ) PARTITION BY RANGE (timestamp)
+        """)
+        cursor.execute("CREATE INDEX idx_points_timestamp_brin ON points USING brin (timestamp)")
+        cursor.execute("ALTER TABLE points ATTACH PARTITION points_legacy FOR VALUES FROM (MINVALUE) TO (%s)", (boundary,))
+        cursor.execute("ALTER TABLE points_legacy DROP CONSTRAINT points_legacy_bound")
+        cursor.execute("COMMIT")
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
+    logger.info(f"Converted points to a partitioned table; existing rows kept in {LEGACY_PARTITION}")
@@ -0,0 +1,121 @@
+import json
+import zlib
+import logging
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+JSON_CONTENT_TYPE = 'application/json'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+MSGPACK_CONTENT_TYPES = (MSGPACK_CONTENT_TYPE, 'application/x-msgpack')
+
+# Only what this process can actually decode is advertised to clients
+SUPPORTED_CONTENT_TYPES = [JSON_CONTENT_TYPE] + ([MSGPACK_CONTENT_TYPE] if msgpack else [])
+SUPPORTED_ENCODINGS = ['gzip'] + (['zstd'] if zstandard else [])
+
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+MIN_COMPRESS_SIZE = 1024
+
+class UnsupportedPayload(Exception):
+    pass
+
+class PayloadTooLarge(Exception):
+    pass
+
+def parse_header_list(value):
+    return [part.split(';')[0].strip().lower() for part in (value or '').split(',') if part.strip()]
+
+def decompress(body, content_encoding, max_size=MAX_DECOMPRESSED_SIZE):
+    encoding = (content_encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return body
+    if encoding == 'gzip':
+        decompressor = zlib.decompressobj(wbits=31)
+        data = decompressor.decompress(body, max_size)
+        if decompressor.unconsumed_tail:
+            raise PayloadTooLarge(f"Decompressed payload exceeds {max_size} bytes")
+        return data
+    if encoding == 'zstd' and zstandard:
+        reader = zstandard.ZstdDecompressor().stream_reader(body)
+        data = reader.read(max_size + 1)
+        if len(data) > max_size:
+            raise PayloadTooLarge(f"Decompressed payload exceeds {max_size} bytes")
+        return data
+    raise UnsupportedPayload(f"Unsupported Content-Encoding: {encoding}")
+
+class StreamDecompressor:
+    """Decompresses a streamed request body chunk by chunk.
+
+    decompress() yields the output in pieces of at most chunk_size bytes where
+    the codec allows it, so a small compressed chunk can't expand into one huge
+    buffer.
+    """
+
+    def __init__(self, content_encoding, chunk_size=1024 * 1024):
+        self.encoding = (content_encoding or 'identity').strip().lower()
+        self.chunk_size = chunk_size
+        if self.encoding == 'identity':
+            self.decompressor = None
+        elif self.encoding == 'gzip':
+            self.decompressor = zlib.decompressobj(wbits=31)
+        elif self.encoding == 'zstd' and zstandard:
+            self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        else:
+            raise UnsupportedPayload(f"Unsupported Content-Encoding: {self.encoding}")
+
+    def decompress(self, chunk):
+        if self.decompressor is None:
+            yield chunk
+        elif self.encoding == 'gzip':
+            data = self.decompressor.decompress(chunk, self.chunk_size)
+            yield data
+            while self.decompressor.unconsumed_tail:
+                yield self.decompressor.decompress(self.decompressor.unconsumed_tail, self.chunk_size)
+        else:
+            yield self.decompressor.decompress(chunk)
+
+def decode_payload(body, content_encoding=None, content_type=None, max_size=MAX_DECOMPRESSED_SIZE):
+    data = decompress(body, content_encoding, max_size)
+    media_type = (content_type or JSON_CONTENT_TYPE).split(';')[0].strip().lower()
+    if media_type in MSGPACK_CONTENT_TYPES:
+        if not msgpack:
+            raise UnsupportedPayload(f"Unsupported Content-Type: {media_type}")
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data)
+
+def encode_payload(data, content_types=(), encodings=()):
+    """Serialize data using the best format and encoding both sides support.
+
+    Returns (body, headers). Small bodies are sent uncompressed since the
+    compression header and CPU would outweigh the saving.
+    """
+    if MSGPACK_CONTENT_TYPE in content_types and msgpack:
+        body = msgpack.packb(data, use_bin_type=True)
+        headers = {'Content-Type': MSGPACK_CONTENT_TYPE}
+    else:
+        body = json.dumps(data).encode()
+        headers = {'Content-Type': JSON_CONTENT_TYPE}
+
+    body, compress_headers = compress(body, encodings)
+    headers.update(compress_headers)
+    return body, headers
+
+def compress(body, encodings=()):
+    """Compress body with the best encoding in encodings; returns (body, headers)."""
+    if len(body) >= MIN_COMPRESS_SIZE:
+        if 'zstd' in encodings and zstandard:
+            return zstandard.ZstdCompressor().compress(body), {'Content-Encoding': 'zstd'}
+        if 'gzip' in encodings:
+            compressor = zlib.compressobj(wbits=31)
+            return compressor.compress(body) + compressor.flush(), {'Content-Encoding': 'gzip'}
+    return body, {}
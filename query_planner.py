@@ -0,0 +1,98 @@
+import logging
+import math
+from retention import TIERS
+from rollups import RESOLUTIONS, bucket_start, first_buckets, read_buckets as read_rollup_buckets
+from storage import bucket_points, combine_buckets
+
+logger = logging.getLogger(__name__)
+
+def tier_width(tier):
+    return 0 if tier == 'raw' else RESOLUTIONS[tier]
+
+def choose_tier(width):
+    """The coarsest tier whose buckets are no wider than width."""
+    return [tier for tier in TIERS if tier_width(tier) <= width][-1]
+
+def first_points(cursor, storage, series_ids):
+    """Oldest stored time of each series in every tier, as {tier: {series_id: timestamp}};
+    series without data in a tier are left out."""
+    firsts = {'raw': storage.first_timestamps(cursor, series_ids)}
+    for resolution in RESOLUTIONS:
+        firsts[resolution] = first_buckets(cursor, resolution, series_ids)
+    return firsts
+
+def _windows(firsts, tiers, series_id, start):
+    # [lower, upper) read from each tier for one series, upper None meaning through
+    # end. tiers are in order of preference; a tier covers the range back to start
+    # unless a later tier kept data from before its first bucket, which then takes
+    # over from the first bucket boundary both tiers share
+    stored = [tier for tier in tiers if series_id in firsts[tier]]
+    windows = {}
+    upper = None
+    while stored:
+        tier = stored.pop(0)
+        first = firsts[tier][series_id]
+        lower = start
+        if first > start:
+            for i, older in enumerate(stored):
+                width = max(tier_width(tier), tier_width(older))
+                if firsts[older][series_id] < bucket_start(first, width):
+                    lower = math.ceil(first / width) * width
+                    stored = stored[i:]
+                    break
+            else:
+                stored = []
+        if upper is None or lower < upper:
+            windows[tier] = (lower, upper)
+            upper = lower
+        if lower <= start:
+            break
+    return windows
+
+def read_history(cursor, storage, archive, series_ids, firsts, start, end, target_points):
+    """Points of the given series in [start, end] in about target_points buckets, as
+    bucket_points rows, read from the coarsest tier that has that many.
+
+    Buckets are a multiple of that tier's width. Where a series has less history
+    in it than in another tier, the older range is read from that tier, preferring
+    coarser ones.
+    """
+    width = (end - start) / target_points
+    tier = choose_tier(width)
+    if tier != 'raw':
+        width = math.floor(width / tier_width(tier)) * tier_width(tier)
+    stored_firsts = firsts['raw']
+    archive_start = archive.start() if archive else None
+    if archive_start is not None:
+        # Archived points count as raw ones
+        firsts = dict(firsts, raw={series_id: min(firsts['raw'].get(series_id, archive_start), archive_start)
+                                   for series_id in series_ids})
+
+    # Coarser tiers are cheaper to fill in from, but a finer one may reach further back
+    index = TIERS.index(tier)
+    preference = TIERS[index:] + TIERS[:index][::-1]
+    groups = {}
+    for series_id in series_ids:
+        for read_tier, window in _windows(firsts, preference, series_id, start).items():
+            groups.setdefault((read_tier, window), []).append(series_id)
+
+    sources = []
+    for (read_tier, (lower, upper)), ids in groups.items():
+        if read_tier == 'raw':
+            # Reads include their end, a bucket boundary the next tier starts at
+            last = end if upper is None else math.nextafter(upper, -math.inf)
+            rows = storage.read_buckets(cursor, ids, lower, last, width)
+            if archive_start is not None and any(stored_firsts.get(series_id, last) > lower for series_id in ids):
+                # Ranges past raw retention fall through to the archive
+                archived = archive.read_before(ids, lower, last, stored_firsts)
+                rows = combine_buckets(bucket_points(archived, width), rows)
+        else:
+            resolution_width = RESOLUTIONS[read_tier]
+            last = upper if upper is not None else bucket_start(end, resolution_width) + resolution_width
+            # A coarser tier's buckets land in the bucket holding their start
+            rows = read_rollup_buckets(cursor, read_tier, ids, bucket_start(lower, resolution_width), last, width)
+        sources.append((TIERS.index(read_tier), rows))
+    logger.debug(f"History of {len(series_ids)} series in {width}s buckets read from "
+                 f"{', '.join(sorted({key[0] for key in groups}, key=TIERS.index))}")
+    # Coarsest first, so a bucket's newest message comes from the finest tier
+    return combine_buckets(*[rows for _, rows in sorted(sources, key=lambda source: -source[0])])
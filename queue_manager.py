@@ -1,28 +1,48 @@
 import json
 import logging
-from database import get_db
-from queue import Queue
-import threading
-import time
-
-logger = logging.getLogger(__name__)
-
-import json
-import logging
-from database import get_db
-from queue import Queue, Empty
+import hashlib
+import asyncio
+from database import get_db, PoolTimeout
+from series import flatten_value, series_name, SCALAR_FIELD
+from rollups import add_points
+from latest import update_latest
+from tsdb import to_ticks
+from storage import get_storage
+import psycopg2
+from psycopg2 import errors
+from psycopg2.extras import execute_values
+from queue import Queue, Empty, Full
+from collections import deque, Counter
 import threading
 import time
 
 logger = logging.getLogger(__name__)
 
 class QueueManager:
-    def __init__(self, num_workers=3):
-        self.queue = Queue()
+    def __init__(self, num_workers=3, batch_size=500, flush_interval=0.5, stats_window=60,
+                 max_queue_size=100000, high_watermark=None, low_watermark=None):
+        self.queue = Queue(maxsize=max_queue_size)
+        self.max_queue_size = max_queue_size
+        # Stop accepting at high_watermark and resume only once workers have drained to low_watermark
+        self.high_watermark = high_watermark if high_watermark is not None else int(max_queue_size * 0.9)
+        self.low_watermark = low_watermark if low_watermark is not None else int(max_queue_size * 0.5)
+        self.throttled = False
+        self.rejected_payloads = 0
         self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval  # seconds a partial batch may wait for more items
+        self.stats_window = stats_window  # seconds used for the rows/sec figure
         self.workers = []
         self.running = False
-        logger.info(f"QueueManager initialized with {num_workers} workers")
+        self.stats_lock = threading.Lock()
+        self.recent_batches = deque()
+        self.total_batches = 0
+        self.total_rows = 0
+        self.failed_batches = 0
+        self.last_batch_size = 0
+        self.last_flush_latency = 0.0
+        logger.info(f"QueueManager initialized with {num_workers} workers, "
+                    f"batch_size={batch_size}, flush_interval={flush_interval}s")
 
     def start(self):
         self.running = True
@@ -44,96 +64,407 @@ class QueueManager:
         logger.debug(f"Enqueueing item: {item}")
         self.queue.put(item)
 
+    def accepting(self):
+        depth = self.queue.qsize()
+        with self.stats_lock:
+            if self.throttled and depth <= self.low_watermark:
+                self.throttled = False
+                logger.info(f"Queue drained to {depth} items, accepting payloads again")
+            elif not self.throttled and depth >= self.high_watermark:
+                self.throttled = True
+                logger.warning(f"Queue depth {depth} reached high watermark, rejecting payloads")
+            return not self.throttled
+
+    def try_enqueue_many(self, items):
+        """Enqueue all items or none of them. Returns False when the payload was rejected.
+
+        Called from the IOLoop only, so nothing else can fill the queue between
+        the capacity check and the puts.
+        """
+        if not self.accepting() or self.queue.qsize() + len(items) > self.max_queue_size:
+            with self.stats_lock:
+                self.rejected_payloads += 1
+            return False
+        for item in items:
+            self.queue.put_nowait(item)
+        return True
+
+    def reject(self):
+        with self.stats_lock:
+            self.rejected_payloads += 1
+
     def _worker_loop(self):
         logger.info("Worker loop started")
         while self.running:
-            try:
-                item = self.queue.get(timeout=1)
-                logger.debug(f"Got item from queue: {item}")
-                self._process_item(item)
-                self.queue.task_done()
-            except Empty:
+            batch = self._next_batch()
+            if not batch:
                 continue
+            started = time.time()
+            try:
+                self._process_batch(batch)
+                self._record_batch(len(batch), time.time() - started)
             except Exception as e:
-                logger.error(f"Error processing item: {e}", exc_info=True)
+                with self.stats_lock:
+                    self.failed_batches += 1
+                logger.error(f"Error processing batch of {len(batch)} items: {e}", exc_info=True)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _next_batch(self):
+        # Block for the first item, then keep draining until the batch is full
+        # or flush_interval has passed since the first item arrived.
+        try:
+            batch = [self.queue.get(timeout=1)]
+        except Empty:
+            return []
+
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+        logger.debug(f"Drained batch of {len(batch)} items")
+        return batch
+
+    def _record_batch(self, rows, latency):
+        now = time.time()
+        with self.stats_lock:
+            self.total_batches += 1
+            self.total_rows += rows
+            self.last_batch_size = rows
+            self.last_flush_latency = latency
+            self.recent_batches.append((now, rows))
+            while self.recent_batches and self.recent_batches[0][0] < now - self.stats_window:
+                self.recent_batches.popleft()
+
+    def get_stats(self):
+        now = time.time()
+        with self.stats_lock:
+            while self.recent_batches and self.recent_batches[0][0] < now - self.stats_window:
+                self.recent_batches.popleft()
+            recent_rows = sum(rows for _, rows in self.recent_batches)
+            return {
+                "num_workers": self.num_workers,
+                "batch_size": self.batch_size,
+                "flush_interval": self.flush_interval,
+                "queue_depth": self.queue.qsize(),
+                "max_queue_size": self.max_queue_size,
+                "high_watermark": self.high_watermark,
+                "low_watermark": self.low_watermark,
+                "throttled": self.throttled,
+                "rejected_payloads": self.rejected_payloads,
+                "total_batches": self.total_batches,
+                "total_rows": self.total_rows,
+                "failed_batches": self.failed_batches,
+                "last_batch_size": self.last_batch_size,
+                "last_flush_latency": self.last_flush_latency,
+                "rows_per_sec": recent_rows / self.stats_window
+            }
+
+    def _process_batch(self, items):
+        for item in items:
+            self._process_item(item)
 
     def _process_item(self, item):
         raise NotImplementedError("_process_item must be implemented in a subclass")
 
 class MetricProcessor(QueueManager):
-    def __init__(self, num_workers=3):
-        super().__init__(num_workers)
+    def __init__(self, num_workers=3, batch_size=500, flush_interval=0.5,
+                 max_queue_size=100000, high_watermark=None, low_watermark=None,
+                 spool=None, retry_delay=5):
+        super().__init__(num_workers, batch_size, flush_interval,
+                         max_queue_size=max_queue_size, high_watermark=high_watermark,
+                         low_watermark=low_watermark)
         self.db = get_db()
+        self.host_cache = {}  # hostname -> (host_id, tags_hash)
+        self.series_cache = {}  # (host_id, metric_name, field) -> series_id
+        self.storage = get_storage()
+        self.host_cache_lock = threading.Lock()
+        # With a spool, accepted payloads go to disk first and a feeder thread
+        # tails the spool into the bounded in-memory queue
+        self.spool = spool
+        self.spool_feeder = None
+        self.retry_delay = retry_delay  # seconds between attempts while the database is unreachable
         logger.info("MetricProcessor initialized")
 
+    def start(self):
+        super().start()
+        if self.spool is not None:
+            self.spool_feeder = threading.Thread(target=self._spool_feeder_loop)
+            self.spool_feeder.start()
+
+    def stop(self):
+        # Stop the feeder first; anything read but not committed stays in the spool for replay
+        self.running = False
+        if self.spool_feeder is not None:
+            self.spool_feeder.join()
+            self.spool_feeder = None
+        super().stop()
+
+    def _spool_feeder_loop(self):
+        logger.info("Spool feeder started")
+        while self.running:
+            record = self.spool.read(timeout=1)
+            if record is None:
+                continue
+            segment, items = record
+            for item in items:
+                item['spool_segment'] = segment
+                while self.running:
+                    try:
+                        self.queue.put(item, timeout=1)
+                        break
+                    except Full:
+                        continue
+
+    def accepting(self):
+        if self.spool is not None:
+            return self.spool.accepting()
+        return super().accepting()
+
+    async def submit_metrics(self, metric_items):
+        """Accept a payload's items; returns False if the payload was rejected for backpressure."""
+        if self.spool is None:
+            return self.enqueue_metrics(metric_items)
+        if not self.spool.accepting():
+            self.reject()
+            return False
+        # Wait for the group fsync off the IOLoop; once this returns the payload survives a crash
+        await asyncio.get_running_loop().run_in_executor(None, self.spool.append_durable, metric_items)
+        return True
+
+    def invalidate_host(self, hostname):
+        with self.host_cache_lock:
+            cached = self.host_cache.pop(hostname, None)
+            if cached:
+                host_id = cached[0]
+                for key in [key for key in self.series_cache if key[0] == host_id]:
+                    del self.series_cache[key]
+
+    def get_stats(self):
+        stats = super().get_stats()
+        with self.host_cache_lock:
+            stats['host_cache_size'] = len(self.host_cache)
+            stats['series_cache_size'] = len(self.series_cache)
+        if self.spool is not None:
+            stats['spool'] = self.spool.get_stats()
+        return stats
+
     def enqueue_metric(self, metric_data):
         self.queue.put(metric_data)
 
+    def enqueue_metrics(self, metric_items):
+        return self.try_enqueue_many(metric_items)
+
+    def _process_batch(self, items):
+        while True:
+            try:
+                self._write_batch(items)
+                break
+            except (psycopg2.OperationalError, PoolTimeout) as e:
+                # The database is down or stalled: hold on to the batch rather than
+                # dropping it, and let the bounded queue push back on clients meanwhile
+                if not self.running:
+                    logger.warning(f"Shutting down with {len(items)} unwritten metrics")
+                    return
+                logger.error(f"Database unavailable, retrying batch of {len(items)} metrics in {self.retry_delay}s: {e}")
+                time.sleep(self.retry_delay)
+            except Exception as e:
+                # One bad item must not drop the whole batch: retry item by item
+                logger.error(f"Batch write of {len(items)} metrics failed, retrying individually: {e}", exc_info=True)
+                failed = 0
+                for item in items:
+                    try:
+                        self._process_item(item)
+                    except Exception:
+                        failed += 1
+                if failed:
+                    logger.error(f"Dropped {failed} of {len(items)} metrics after individual retry")
+                break
+        self._ack_spool(items)
+
+    def _ack_spool(self, items):
+        if self.spool is None:
+            return
+        self.spool.ack(Counter(item['spool_segment'] for item in items if 'spool_segment' in item))
+
     def _process_item(self, item):
-        hostname = item['hostname']
-        metric_name = item['metric_name']
-        value = item['value']
-        timestamp = item['timestamp']
-        tags = item.get('tags', {})
-        message = item.get('message')  # New field for message
-
-        logger.info(f"Processing metric: {hostname} - {metric_name}: {value}")
+        self._write_batch([item])
+
+    def _write_batch(self, items):
+        try:
+            self._write_batch_once(items)
+        except errors.ForeignKeyViolation:
+            # A cached host or series was deleted behind our back (another process,
+            # or a removal racing this batch); forget the batch's hosts and retry once
+            logger.warning("Host or series referenced by cached id no longer exists, refreshing caches")
+            for hostname in {item['hostname'] for item in items}:
+                self.invalidate_host(hostname)
+            self._write_batch_once(items)
+        except errors.CheckViolation:
+            # No partition for a point: retention dropped one we had cached
+            logger.warning("Point outside every cached partition, refreshing partition cache")
+            self.storage.reset()
+            self._write_batch_once(items)
+
+    def _write_batch_once(self, items):
+        logger.debug(f"Writing batch of {len(items)} metrics")
+        self.storage.prepare(self.db, [item['timestamp'] for item in items])
         with self.db.get_cursor() as cursor:
-            try:
-                # Get or create host
-                cursor.execute("""
-                    INSERT INTO hosts (hostname, tags)
-                    VALUES (%s, %s)
-                    ON CONFLICT (hostname) DO UPDATE
-                    SET tags = EXCLUDED.tags
-                    RETURNING id
-                """, (hostname, json.dumps(tags)))
-                host = cursor.fetchone()
-
-                host_id = host['id']
-
-                # Insert metric
-                cursor.execute(
-                    "INSERT INTO metrics (host_id, metric_name, timestamp, value, message) VALUES (%s, %s, %s, %s, %s)",
-                    (host_id, metric_name, timestamp, json.dumps(value), message)
-                )
-
-                # Check if there's an active downtime
-                cursor.execute("""
-                    SELECT 1 FROM downtimes
-                    WHERE host_id = %s AND start_time <= %s AND end_time >= %s
-                """, (host_id, timestamp, timestamp))
-                is_downtime = cursor.fetchone() is not None
-
-                if not is_downtime:
-                    # Check alerts only if not in downtime
-                    cursor.execute(
-                        "SELECT * FROM alerts WHERE host_id = %s AND metric_name = %s AND enabled = TRUE",
-                        (host_id, metric_name)
-                    )
-                    alerts = cursor.fetchall()
-
-                    logger.info(f"Checking {len(alerts)} alerts for {hostname} - {metric_name}")
-
-                    for alert in alerts:
-                        logger.info(
-                            f"Checking alert: {alert['id']} - Condition: {alert['condition']}, Threshold: {alert['threshold']}")
-                        if self._check_alert_condition(alert, value):
-                            self._trigger_alert(cursor, alert, hostname, metric_name, value, timestamp)
-                        else:
-                            logger.info(f"Alert condition not met for alert {alert['id']}")
+            host_ids, cache_updates = self._resolve_hosts(cursor, items)
+
+            # Every module snapshot becomes one narrow point per field
+            points = [
+                (item['hostname'], host_ids[item['hostname']], item['metric_name'], field, item['timestamp'], value, message)
+                for item in items
+                for field, value, message in flatten_value(item['value'], item.get('message'))
+            ]
+            series_ids, series_updates = self._resolve_series(cursor, points)
+
+            if points:
+                rows = [
+                    (series_ids[(host_id, metric_name, field)], timestamp, value, message)
+                    for _, host_id, metric_name, field, timestamp, value, message in points
+                ]
+                inserted = self.storage.write(cursor, rows)
+                # Only points that were really inserted count towards the rollups
+                add_points(cursor, [(series_id, timestamp, value) for series_id, timestamp, value, _ in inserted])
+                update_latest(cursor, inserted)
+
+                # A redelivered point was checked when it was first written; compared in
+                # ticks, as a backend may hand back timestamps rounded to them
+                new = {(series_id, to_ticks(timestamp)) for series_id, timestamp, _, _ in inserted}
+                new_points = [point for point, row in zip(points, rows) if (row[0], to_ticks(row[1])) in new]
+                if new_points:
+                    self._check_alerts(cursor, new_points, host_ids)
+        # get_cursor commits the whole batch as one transaction; only cache
+        # host and series ids once they are known to be committed
+        with self.host_cache_lock:
+            self.host_cache.update(cache_updates)
+            self.series_cache.update(series_updates)
+
+    def _resolve_hosts(self, cursor, items):
+        # Last tags seen for a host within the batch win
+        tags_by_host = {}
+        for item in items:
+            tags_by_host[item['hostname']] = item.get('tags', {})
+
+        host_ids = {}
+        stale = {}
+        with self.host_cache_lock:
+            for hostname, tags in tags_by_host.items():
+                tags_hash = hashlib.sha1(json.dumps(tags, sort_keys=True).encode()).hexdigest()
+                cached = self.host_cache.get(hostname)
+                if cached and cached[1] == tags_hash:
+                    host_ids[hostname] = cached[0]
                 else:
-                    logger.info(f"Skipping alert checks for {hostname} due to active downtime")
+                    stale[hostname] = tags_hash
 
-                self.db.conn.commit()
-            except Exception as e:
-                logger.error(f"Error processing metric: {e}", exc_info=True)
-                self.db.conn.rollback()
-                raise
+        if not stale:
+            return host_ids, {}
+
+        # Only new hosts and hosts whose tags changed touch the hosts table;
+        # sorting keeps the row lock order stable across concurrent workers
+        host_rows = execute_values(cursor, """
+            INSERT INTO hosts (hostname, tags)
+            VALUES %s
+            ON CONFLICT (hostname) DO UPDATE
+            SET tags = EXCLUDED.tags
+            RETURNING id, hostname
+        """, [(hostname, json.dumps(tags_by_host[hostname])) for hostname in sorted(stale)],
+            fetch=True)
+
+        cache_updates = {}
+        for row in host_rows:
+            host_ids[row['hostname']] = row['id']
+            cache_updates[row['hostname']] = (row['id'], stale[row['hostname']])
+        return host_ids, cache_updates
+
+    def _resolve_series(self, cursor, points):
+        keys = {(host_id, metric_name, field) for _, host_id, metric_name, field, _, _, _ in points}
+        series_ids = {}
+        missing = []
+        with self.host_cache_lock:
+            for key in keys:
+                series_id = self.series_cache.get(key)
+                if series_id is None:
+                    missing.append(key)
+                else:
+                    series_ids[key] = series_id
+
+        if not missing:
+            return series_ids, {}
+
+        # The no-op update makes RETURNING yield ids for series that already exist
+        series_rows = execute_values(cursor, """
+            INSERT INTO series (host_id, metric_name, field)
+            VALUES %s
+            ON CONFLICT (host_id, metric_name, field) DO UPDATE
+            SET field = EXCLUDED.field
+            RETURNING id, host_id, metric_name, field
+        """, sorted(missing), fetch=True)
+
+        series_updates = {}
+        for row in series_rows:
+            key = (row['host_id'], row['metric_name'], row['field'])
+            series_ids[key] = row['id']
+            series_updates[key] = row['id']
+        return series_ids, series_updates
+
+    def _check_alerts(self, cursor, points, host_ids):
+        timestamps = [point[4] for point in points]
+        batch_host_ids = list(set(host_ids.values()))
+
+        # Downtimes overlapping the batch, checked per item below
+        cursor.execute("""
+            SELECT host_id, start_time, end_time FROM downtimes
+            WHERE host_id = ANY(%s) AND start_time <= %s AND end_time >= %s
+        """, (batch_host_ids, max(timestamps), min(timestamps)))
+        downtimes = {}
+        for row in cursor.fetchall():
+            downtimes.setdefault(row['host_id'], []).append((row['start_time'], row['end_time']))
+
+        cursor.execute(
+            "SELECT * FROM alerts WHERE host_id = ANY(%s) AND enabled = TRUE",
+            (batch_host_ids,)
+        )
+        alerts = {}
+        for alert in cursor.fetchall():
+            alerts.setdefault((alert['host_id'], alert['metric_name']), []).append(alert)
+
+        if not alerts:
+            return
+
+        for hostname, host_id, metric_name, field, timestamp, value, _ in points:
+            if value is None:
+                continue
+            # Alerts name a series as "module.field"; a bare module name matches modules reporting a single value
+            name = series_name(metric_name, field)
+            point_alerts = alerts.get((host_id, name), [])
+            if field == SCALAR_FIELD:
+                point_alerts = point_alerts + alerts.get((host_id, metric_name), [])
+            if not point_alerts:
+                continue
+
+            if any(start <= timestamp <= end for start, end in downtimes.get(host_id, [])):
+                logger.info(f"Skipping alert checks for {hostname} due to active downtime")
+                continue
+
+            logger.info(f"Checking {len(point_alerts)} alerts for {hostname} - {name}")
+            for alert in point_alerts:
+                logger.info(
+                    f"Checking alert: {alert['id']} - Condition: {alert['condition']}, Threshold: {alert['threshold']}")
+                if self._check_alert_condition(alert, value):
+                    self._trigger_alert(cursor, alert, hostname, name, value, timestamp)
+                else:
+                    logger.info(f"Alert condition not met for alert {alert['id']}")
 
     def _check_alert_condition(self, alert, value):
-        if isinstance(value, dict) and 'value' in value:
-            value = value['value']
         if alert['condition'] == 'above':
             return value > alert['threshold']
         elif alert['condition'] == 'below':
@@ -151,4 +482,4 @@ class MetricProcessor(QueueManager):
             logger.info(
                 f"Alert logged to database: alert_id={alert['id']}, host_id={alert['host_id']}, timestamp={timestamp}, value={value}")
         except Exception as e:
-            logger.error(f"Failed to log alert to database: {e}", exc_info=True)
\ No newline at end of file
+            logger.error(f"Failed to log alert to database: {e}", exc_info=True)
@@ -0,0 +1,79 @@
+import fnmatch
+import logging
+from rollups import RESOLUTIONS
+from series import series_name
+
+logger = logging.getLogger(__name__)
+
+# What a policy can set a retention for: raw points and each rollup tier
+TIERS = ('raw',) + tuple(RESOLUTIONS)
+
+def parse_policy(data):
+    """Check a policy sent by the admin interface; raises ValueError with a message for the user."""
+    name = data.get('name')
+    metric_pattern = data.get('metric_pattern') or '*'
+    host_tags = data.get('host_tags') or {}
+    retention = data.get('retention')
+    priority = data.get('priority', 0)
+    if not name:
+        raise ValueError("name is required")
+    if not isinstance(host_tags, dict):
+        raise ValueError("host_tags must be a JSON object")
+    if not isinstance(retention, dict) or not retention:
+        raise ValueError("retention must be a JSON object of days per tier")
+    for tier, days in retention.items():
+        if tier not in TIERS:
+            raise ValueError(f"Unknown retention tier '{tier}', expected one of {', '.join(TIERS)}")
+        if days is not None and (isinstance(days, bool) or not isinstance(days, (int, float)) or days <= 0):
+            raise ValueError(f"Retention of '{tier}' must be a positive number of days, or null to keep it forever")
+    if isinstance(priority, bool) or not isinstance(priority, int):
+        raise ValueError("priority must be an integer")
+    return {"name": name, "metric_pattern": metric_pattern, "host_tags": host_tags,
+            "retention": retention, "priority": priority}
+
+def load_policies(cursor):
+    cursor.execute("""
+        SELECT id, name, metric_pattern, host_tags, retention, priority
+        FROM retention_policies
+        ORDER BY priority DESC, id
+    """)
+    return cursor.fetchall()
+
+def policy_matches(policy, metric_name, field, tags):
+    # 'disk.*' matches the fields of the disk module, 'e2e_*' whole modules
+    pattern = policy['metric_pattern']
+    if not (fnmatch.fnmatchcase(metric_name, pattern) or fnmatch.fnmatchcase(series_name(metric_name, field), pattern)):
+        return False
+    tags = tags or {}
+    return all(tags.get(key) == value for key, value in (policy['host_tags'] or {}).items())
+
+def retention_groups(cursor, defaults):
+    """Series ids grouped by how many days each tier keeps them: {tier: {days: [series ids]}}.
+
+    A series follows the highest priority policy matching it, and defaults for
+    the tiers that policy leaves out. None days means forever. Without any
+    policies every tier has a single group whose ids are None, meaning all series.
+    """
+    policies = load_policies(cursor)
+    if not policies:
+        return {tier: {defaults[tier]: None} for tier in TIERS}
+    cursor.execute("""
+        SELECT s.id, s.metric_name, s.field, h.tags
+        FROM series s
+        JOIN hosts h ON s.host_id = h.id
+    """)
+    groups = {tier: {} for tier in TIERS}
+    for row in cursor.fetchall():
+        policy = next((policy for policy in policies
+                       if policy_matches(policy, row['metric_name'], row['field'], row['tags'])), None)
+        retention = policy['retention'] if policy else {}
+        for tier in TIERS:
+            groups[tier].setdefault(retention.get(tier, defaults[tier]), []).append(row['id'])
+    for tier in TIERS:
+        if not groups[tier]:
+            groups[tier] = {defaults[tier]: None}
+    return groups
+
+def longest(group):
+    """The longest retention among a tier's groups, None if any keeps its series forever."""
+    return None if None in group else max(group)
@@ -0,0 +1,216 @@
+import math
+import logging
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+logger = logging.getLogger(__name__)
+
+# Rollup tiers: name -> bucket width in seconds; each has its own rollups_<name> table
+RESOLUTIONS = {
+    '1m': 60,
+    '1h': 60 * 60,
+    '1d': 24 * 60 * 60,
+}
+
+ROLLUP_TABLE = '''
+    CREATE TABLE IF NOT EXISTS {} (
+        series_id INTEGER NOT NULL REFERENCES series(id) ON DELETE CASCADE,
+        bucket FLOAT NOT NULL,
+        min_value DOUBLE PRECISION NOT NULL,
+        max_value DOUBLE PRECISION NOT NULL,
+        sum_value DOUBLE PRECISION NOT NULL,
+        count BIGINT NOT NULL,
+        last_timestamp FLOAT NOT NULL,
+        last_value DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (series_id, bucket)
+    )
+'''
+
+def rollup_table(resolution):
+    return sql.Identifier(f"rollups_{resolution}")
+
+def create_statements():
+    return [(f"rollups_{name}", sql.SQL(ROLLUP_TABLE).format(rollup_table(name))) for name in RESOLUTIONS]
+
+def bucket_start(timestamp, width):
+    # Same arithmetic as the SQL side, so Python and SQL agree on bucket keys
+    return math.floor(timestamp / width) * width
+
+def summarize(points, width):
+    """Fold (series_id, timestamp, value) points into per-bucket rollup rows, sorted by key."""
+    buckets = {}
+    for series_id, timestamp, value in points:
+        if value is None:
+            continue
+        key = (series_id, bucket_start(timestamp, width))
+        row = buckets.get(key)
+        if row is None:
+            buckets[key] = [value, value, value, 1, timestamp, value]
+            continue
+        row[0] = min(row[0], value)
+        row[1] = max(row[1], value)
+        row[2] += value
+        row[3] += 1
+        if timestamp >= row[4]:
+            row[4] = timestamp
+            row[5] = value
+    return [key + tuple(row) for key, row in sorted(buckets.items())]
+
+def add_points(cursor, points):
+    """Merge newly written points into every rollup tier.
+
+    Only pass points that were actually inserted; a redelivered point would
+    otherwise be counted twice. Rows are upserted in key order so concurrent
+    batches touching the same buckets can't deadlock.
+    """
+    for name, width in RESOLUTIONS.items():
+        rows = summarize(points, width)
+        if not rows:
+            continue
+        execute_values(cursor, sql.SQL("""
+            INSERT INTO {} AS r (series_id, bucket, min_value, max_value, sum_value, count, last_timestamp, last_value)
+            VALUES %s
+            ON CONFLICT (series_id, bucket) DO UPDATE SET
+                min_value = LEAST(r.min_value, EXCLUDED.min_value),
+                max_value = GREATEST(r.max_value, EXCLUDED.max_value),
+                sum_value = r.sum_value + EXCLUDED.sum_value,
+                count = r.count + EXCLUDED.count,
+                last_value = CASE WHEN EXCLUDED.last_timestamp >= r.last_timestamp
+                                  THEN EXCLUDED.last_value ELSE r.last_value END,
+                last_timestamp = GREATEST(r.last_timestamp, EXCLUDED.last_timestamp)
+        """).format(rollup_table(name)).as_string(cursor), rows, page_size=len(rows))
+
+def _range_filter(column, first, last, series_ids):
+    conditions = [sql.SQL("TRUE")]
+    params = []
+    if first is not None:
+        conditions.append(sql.SQL("{} >= %s").format(sql.Identifier(column)))
+        params.append(first)
+    if last is not None:
+        conditions.append(sql.SQL("{} < %s").format(sql.Identifier(column)))
+        params.append(last)
+    if series_ids is not None:
+        conditions.append(sql.SQL("series_id = ANY(%s)"))
+        params.append(list(series_ids))
+    return sql.SQL(" AND ").join(conditions), params
+
+def rebuild_buckets(cursor, resolution, first=None, last=None, series_ids=None, source=None):
+    """Recompute one tier's buckets starting in [first, last) from the raw points.
+
+    first and last must be bucket aligned. Buckets whose raw points are gone
+    (deleted, or past raw retention) are removed rather than kept stale. source
+    is a (query, params) pair selecting series_id, timestamp and value to use
+    instead of the points table.
+    """
+    width = RESOLUTIONS[resolution]
+    condition, params = _range_filter('bucket', first, last, series_ids)
+    cursor.execute(sql.SQL("DELETE FROM {} WHERE {}").format(rollup_table(resolution), condition), params)
+    condition, params = _range_filter('timestamp', first, last, series_ids)
+    if source is None:
+        source_sql, source_params = sql.Identifier('points'), []
+    else:
+        source_sql, source_params = sql.SQL("({}) p").format(sql.SQL(source[0])), list(source[1])
+    # Ingest may re-create a bucket between the DELETE and the INSERT
+    cursor.execute(sql.SQL("""
+        INSERT INTO {} (series_id, bucket, min_value, max_value, sum_value, count, last_timestamp, last_value)
+        SELECT series_id, floor(timestamp / %s) * %s AS bucket,
+               MIN(value), MAX(value), SUM(value), COUNT(*), MAX(timestamp),
+               (array_agg(value ORDER BY timestamp DESC))[1]
+        FROM {}
+        WHERE value IS NOT NULL AND {}
+        GROUP BY series_id, bucket
+        ON CONFLICT (series_id, bucket) DO UPDATE SET
+            min_value = EXCLUDED.min_value,
+            max_value = EXCLUDED.max_value,
+            sum_value = EXCLUDED.sum_value,
+            count = EXCLUDED.count,
+            last_timestamp = EXCLUDED.last_timestamp,
+            last_value = EXCLUDED.last_value
+    """).format(rollup_table(resolution), source_sql, condition), [width, width] + source_params + params)
+    return cursor.rowcount
+
+def replace_buckets(cursor, resolution, first, last, series_ids, rows):
+    """Replace one tier's buckets starting in [first, last) with rows summarized elsewhere."""
+    condition, params = _range_filter('bucket', first, last, series_ids)
+    cursor.execute(sql.SQL("DELETE FROM {} WHERE {}").format(rollup_table(resolution), condition), params)
+    if rows:
+        execute_values(cursor, sql.SQL("""
+            INSERT INTO {} (series_id, bucket, min_value, max_value, sum_value, count, last_timestamp, last_value)
+            VALUES %s
+            ON CONFLICT (series_id, bucket) DO UPDATE SET
+                min_value = EXCLUDED.min_value,
+                max_value = EXCLUDED.max_value,
+                sum_value = EXCLUDED.sum_value,
+                count = EXCLUDED.count,
+                last_timestamp = EXCLUDED.last_timestamp,
+                last_value = EXCLUDED.last_value
+        """).format(rollup_table(resolution)).as_string(cursor), rows, page_size=1000)
+    return len(rows)
+
+def rebuild(cursor, start=None, end=None, series_ids=None, rebuild_tier=rebuild_buckets):
+    """Recompute every tier's buckets overlapping [start, end]; None leaves that side open.
+
+    rebuild_tier does the work for one tier; the default aggregates the points table in SQL.
+    """
+    for name, width in RESOLUTIONS.items():
+        first = bucket_start(start, width) if start is not None else None
+        last = bucket_start(end, width) + width if end is not None else None
+        rebuilt = rebuild_tier(cursor, name, first, last, series_ids)
+        logger.info(f"Rebuilt {rebuilt} {name} rollup buckets")
+
+def delete_before(cursor, resolution, cutoff, limit=None, series_ids=None):
+    """Drop buckets of one tier that end at or before cutoff, at most limit of them and
+    only of the given series when set; returns the number removed."""
+    width = RESOLUTIONS[resolution]
+    table = rollup_table(resolution)
+    condition, params = _range_filter('bucket', None, None, series_ids)
+    condition = sql.SQL("bucket <= %s AND ") + condition
+    params = [cutoff - width] + params
+    if limit is None:
+        cursor.execute(sql.SQL("DELETE FROM {} WHERE {}").format(table, condition), params)
+    else:
+        cursor.execute(sql.SQL("""
+            DELETE FROM {0} WHERE ctid = ANY(ARRAY(
+                SELECT ctid FROM {0} WHERE {1} LIMIT %s
+            ))
+        """).format(table, condition), params + [limit])
+    return cursor.rowcount
+
+def first_buckets(cursor, resolution, series_ids):
+    """Oldest bucket of each given series in one tier, as {series_id: bucket}; series without any left out."""
+    cursor.execute(sql.SQL("""
+        SELECT s.id AS series_id, r.bucket
+        FROM unnest(%s::integer[]) AS s (id)
+        CROSS JOIN LATERAL (
+            SELECT bucket FROM {}
+            WHERE series_id = s.id
+            ORDER BY bucket
+            LIMIT 1
+        ) r
+    """).format(rollup_table(resolution)), (list(series_ids),))
+    return {row['series_id']: row['bucket'] for row in cursor.fetchall()}
+
+def read_buckets(cursor, resolution, series_ids, first, last, width):
+    """One tier's buckets starting in [first, last) merged into buckets width seconds wide.
+
+    width must be a multiple of the tier's width. Rows are shaped like
+    storage.bucket_points rows, ordered by bucket; rollups keep no messages.
+    """
+    condition, params = _range_filter('bucket', first, last, series_ids)
+    cursor.execute(sql.SQL("""
+        SELECT series_id, floor(bucket / %s) * %s AS merged,
+               MIN(min_value) AS min_value, MAX(max_value) AS max_value,
+               SUM(sum_value) AS sum_value, SUM(count)::bigint AS count,
+               MAX(last_timestamp) AS last_timestamp,
+               (array_agg(last_value ORDER BY last_timestamp DESC))[1] AS last_value
+        FROM {}
+        WHERE {}
+        GROUP BY series_id, merged
+        ORDER BY merged, series_id
+    """).format(rollup_table(resolution), condition), [width, width] + params)
+    return [(row['series_id'], row['merged'], row['min_value'], row['max_value'], row['sum_value'], row['count'],
+             row['last_timestamp'], row['last_value'], None) for row in cursor.fetchall()]
+
+def migration_backfill_rollups(cursor):
+    # Points written before rollups existed; later points are added at ingest
+    rebuild(cursor)
@@ -1,16 +1,43 @@
 import tornado.web
 from auth_handlers import LoginHandler, RegisterHandler, LogoutHandler
-from metric_handlers import (MetricsHandler, FetchLatestHandler, FetchHistoryHandler,
-                             FetchMetricsForHostHandler, DeleteMetricsHandler)
+from metric_handlers import (MetricsHandler, FetchLatestHandler, FetchHistoryHandler, FetchHistoryBatchHandler,
+                             ExportHistoryHandler, FetchMetricsForHostHandler, DeleteMetricsHandler, IngestStatsHandler,
+                             MetricsBatchHandler)
 from host_handlers import FetchHostsHandler, RemoveHostHandler, UpdateTagsHandler
 from alert_handlers import AlertConfigHandler, AlertStateHandler, RecentAlertsHandler
 from downtime_handlers import DowntimeHandler
-from admin_handlers import AdminInterfaceHandler, UpdateClientHandler, UploadMetricHandler, FetchClientIdsHandler
+from admin_handlers import (AdminInterfaceHandler, UpdateClientHandler, UploadMetricHandler, FetchClientIdsHandler,
+                            RetentionPolicyHandler)
 from dashboard_handlers import DashboardHandler
 from client_handlers import ClientConfigHandler, FetchMetricsHandler
 from misc_handlers import MainHandler, JSHandler, AggregateDataHandler
+from database import get_db
+from signing import ReplayGuard, SharedReplayGuard
 
-def make_app(metric_processor, config):
+def make_app(metric_processor, config, aggregation_job=None, shared_replay_guard=False):
+    metrics_config = config['metrics']
+    ingest_config = config.get('ingest', {})
+    max_skew = metrics_config.get('signature_max_skew', 300)
+    if shared_replay_guard:
+        # Several processes share the port, so seen signatures have to be shared too
+        replay_guard = SharedReplayGuard(get_db(), max_skew=max_skew)
+    else:
+        replay_guard = ReplayGuard(max_skew=max_skew)
+    metrics_handler_args = dict(
+        metric_processor=metric_processor,
+        secret_key=metrics_config['secret_key'],
+        replay_guard=replay_guard,
+        accept_v1_signatures=metrics_config.get('accept_v1_signatures', True),
+        retry_after=ingest_config.get('retry_after', 5)
+    )
+    metrics_batch_handler_args = dict(
+        metric_processor=metric_processor,
+        secret_key=metrics_config['secret_key'],
+        replay_guard=replay_guard,
+        max_body_size=ingest_config.get('batch_max_body_size', 1024 ** 3),
+        max_reported_errors=ingest_config.get('batch_max_reported_errors', 1000),
+        retry_after=ingest_config.get('retry_after', 5)
+    )
     return tornado.web.Application([
         (r"/", MainHandler),
         (r"/fetch_client_ids", FetchClientIdsHandler),
@@ -23,10 +50,15 @@ def make_app(metric_processor, config):
         (r"/admin", AdminInterfaceHandler),
         (r"/admin/update_client", UpdateClientHandler),
         (r"/admin/upload_metric", UploadMetricHandler),
+        (r"/admin/retention_policies", RetentionPolicyHandler),
         (r"/client_config", ClientConfigHandler),
-        (r"/metrics", MetricsHandler, dict(metric_processor=metric_processor, secret_key=config['metrics']['secret_key'])),
+        (r"/metrics", MetricsHandler, metrics_handler_args),
+        (r"/metrics/batch", MetricsBatchHandler, metrics_batch_handler_args),
+        (r"/fetch/ingest_stats", IngestStatsHandler, dict(metric_processor=metric_processor)),
         (r"/fetch/latest", FetchLatestHandler),
         (r"/fetch/history/([^/]+)/([^/]+)", FetchHistoryHandler),
+        (r"/fetch/history_batch", FetchHistoryBatchHandler),
+        (r"/fetch/history_export/([^/]+)/([^/]+)", ExportHistoryHandler),
         (r"/fetch/hosts", FetchHostsHandler),
         (r"/alert_config", AlertConfigHandler),
         (r"/alert_state", AlertStateHandler),
@@ -40,8 +72,8 @@ def make_app(metric_processor, config):
         (r"/admin.js", JSHandler, {"filename": "admin.js"}),
         (r"/downtimes.js", JSHandler, {"filename": "downtimes.js"}),
         (r"/utils.js", JSHandler, {"filename": "utils.js"}),
-        (r"/aggregate", AggregateDataHandler),
-        (r"/remove_host", RemoveHostHandler),
+        (r"/aggregate", AggregateDataHandler, dict(aggregation_job=aggregation_job)),
+        (r"/remove_host", RemoveHostHandler, dict(metric_processor=metric_processor)),
         (r"/static/(.*)", tornado.web.StaticFileHandler, {"path": "static"})
     ],
     cookie_secret=config["webapp"]["cookie_secret"],
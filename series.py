@@ -0,0 +1,103 @@
+import json
+import math
+
+# Field holding a module-level message; it has no numeric value
+MESSAGE_FIELD = ''
+# Field used when a module reports a bare value instead of a dict of fields
+SCALAR_FIELD = 'value'
+
+def to_float(value):
+    if isinstance(value, bool):
+        return float(value)
+    if isinstance(value, (int, float)):
+        value = float(value)
+        return value if math.isfinite(value) else None
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+        return value if math.isfinite(value) else None
+    return None
+
+def flatten_value(value, message=None):
+    """Split one module's output into (field, numeric value, message) rows.
+
+    Module output is either a dict of fields, each a bare value or a
+    {'value': ..., 'message': ...} dict, or a single bare value. Values that
+    aren't numeric are stored as None; a non-numeric string is kept as the
+    point's message so it isn't lost.
+    """
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+    if not isinstance(value, dict):
+        value = {SCALAR_FIELD: value}
+
+    rows = []
+    for field, field_data in value.items():
+        field_message = None
+        if isinstance(field_data, dict):
+            field_message = field_data.get('message')
+            field_data = field_data.get('value')
+        number = to_float(field_data)
+        if number is None and isinstance(field_data, str) and not field_message:
+            field_message = field_data
+        rows.append((str(field), number, field_message))
+    if message:
+        rows.append((MESSAGE_FIELD, None, message))
+    return rows
+
+def assemble_buckets(rows, fields):
+    """Group bucket rows into per-bucket dicts shaped like assemble_history's.
+
+    rows are (series_id, bucket, min, max, sum, count, last_timestamp, last_value,
+    message) tuples ordered by bucket, and fields maps series ids to field names.
+    A field's value is its average over the bucket, next to min, max, last and count.
+    """
+    result = []
+    data_point = None
+    for series_id, bucket, min_value, max_value, sum_value, count, _, last_value, message in rows:
+        if data_point is None or data_point['timestamp'] != bucket:
+            data_point = {'timestamp': bucket}
+            result.append(data_point)
+        field = fields[series_id]
+        if field == MESSAGE_FIELD:
+            if message:
+                data_point['message'] = message
+            continue
+        entry = field_entry(sum_value / count if count else None, message)
+        if count:
+            entry.update({'min': min_value, 'max': max_value, 'last': last_value, 'count': count})
+        data_point[field] = entry
+    return result
+
+def series_name(metric_name, field):
+    return f"{metric_name}.{field}" if field else metric_name
+
+def field_entry(value, message=None):
+    entry = {'value': value}
+    if message:
+        entry['message'] = message
+    return entry
+
+def assemble_history(rows):
+    """Group timestamp-ordered point rows back into per-snapshot dicts.
+
+    Each row needs 'field', 'timestamp', 'value' and 'message'; the result has the
+    shape the dashboard reads: {'timestamp': t, field: {'value': v, 'message': m}}.
+    """
+    result = []
+    data_point = None
+    for row in rows:
+        if data_point is None or data_point['timestamp'] != row['timestamp']:
+            data_point = {'timestamp': row['timestamp']}
+            result.append(data_point)
+        if row['field'] == MESSAGE_FIELD:
+            if row['message']:
+                data_point['message'] = row['message']
+        else:
+            data_point[row['field']] = field_entry(row['value'], row['message'])
+    return result
@@ -1,16 +1,25 @@
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 from tornado.options import define, options
 import json
 import logging
+import os
 from routes import make_app
 from database import init_db, get_db
+from storage import init_storage, get_storage
+from archive import init_archive
 from queue_manager import MetricProcessor
-from data_aggregator import aggregate_data
+from spool import Spool
+from data_aggregator import AggregationJob
+from partitions import configure_partitions, precreate_partitions
 
 # Define command-line options
 define("port", default=8888, help="run on the given port", type=int)
 define("config", default="server_config.json", help="path to config file", type=str)
+define("processes", default=1, help="number of server processes sharing the port (0 = one per CPU)", type=int)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -27,6 +36,15 @@ def load_config(config_path):
         logger.error(f"Invalid JSON in config file: {config_path}")
         raise
 
+async def precreate_future_partitions():
+    def precreate():
+        with get_db().get_cursor() as cursor:
+            return precreate_partitions(cursor)
+    try:
+        await tornado.ioloop.IOLoop.current().run_in_executor(None, precreate)
+    except Exception as e:
+        logger.error(f"Failed to pre-create partitions: {str(e)}")
+
 def main():
     # Parse command-line options
     tornado.options.parse_command_line()
@@ -35,28 +53,106 @@ def main():
     config = load_config(options.config)
     logger.info(f"Loaded configuration from {options.config}")
 
-    # Initialize database
+    # Initialize database; every ingest worker, concurrent handler query and export holds a pooled connection
+    db_config = config['database']
+    db_config.setdefault('pool_max', config.get('num_workers', 3) + db_config.get('query_concurrency', 8)
+                         + db_config.get('stream_concurrency', 2) + 2)
+    configure_partitions(config.get('partitions', {}))
+    storage_config = config.get('storage', {})
+    if storage_config.get('backend', 'postgres') == 'tsdb' and options.processes != 1:
+        # The embedded store is written by a single process
+        logger.error("The tsdb storage backend needs --processes=1")
+        return
+    task_id = None
     try:
-        init_db(config['database'])
+        init_db(db_config)
+        with get_db().get_cursor() as cursor:
+            precreate_partitions(cursor)
+        if options.processes != 1:
+            # Create the schema once in the parent, then fork; each child opens its
+            # own pool since connections can't be shared across processes
+            get_db().close()
+            try:
+                task_id = tornado.process.fork_processes(options.processes)
+            except KeyboardInterrupt:
+                # Only the parent gets here; the children shut themselves down
+                logger.info("Received shutdown signal, waiting for server processes to stop")
+                return
+            init_db(db_config, create_schema=False)
+            logger.info(f"Server process {task_id} started with pid {os.getpid()}")
         logger.info("Database initialized successfully")
+        init_storage(storage_config)
+        init_archive(config.get('archive', {}))
     except Exception as e:
         logger.error(f"Failed to initialize database: {str(e)}")
         return
 
+    # Open the ingest spool; anything left from a previous run is replayed once the workers start
+    spool_config = config.get('spool', {})
+    spool = None
+    if spool_config.get('enabled', False):
+        spool_path = spool_config.get('path', 'spool')
+        if task_id is not None:
+            # A spool has a single reader, so every process gets its own directory
+            spool_path = os.path.join(spool_path, f"worker-{task_id}")
+        spool = Spool(
+            spool_path,
+            segment_size=spool_config.get('segment_size', 64 * 1024 * 1024),
+            fsync_interval=spool_config.get('fsync_interval', 0.05),
+            max_bytes=spool_config.get('max_bytes', 10 * 1024 ** 3)
+        )
+        logger.info(f"Ingest spool enabled at {spool.path}")
+
     # Initialize metric processor
-    metric_processor = MetricProcessor(num_workers=config.get('num_workers', 3))
+    ingest_config = config.get('ingest', {})
+    metric_processor = MetricProcessor(
+        num_workers=config.get('num_workers', 3),
+        batch_size=ingest_config.get('batch_size', 500),
+        flush_interval=ingest_config.get('flush_interval', 0.5),
+        max_queue_size=ingest_config.get('max_queue_size', 100000),
+        high_watermark=ingest_config.get('high_watermark'),
+        low_watermark=ingest_config.get('low_watermark'),
+        spool=spool,
+        retry_delay=ingest_config.get('retry_delay', 5)
+    )
     metric_processor.start()
     logger.info(f"Started metric processor with {metric_processor.num_workers} workers")
 
-    # Create Tornado application
-    app = make_app(metric_processor, config=config)
+    # Aggregation and retention run in a background thread; with several
+    # processes only the first one runs it
+    aggregation_job = None
+    partition_callback = None
+    if task_id in (None, 0):
+        aggregation_config = config.get('aggregation', {})
+        retention_config = config.get('retention', {})
+        aggregation_job = AggregationJob(
+            interval=aggregation_config.get('interval', 3600),
+            chunk_seconds=aggregation_config.get('chunk_seconds', 3600),
+            chunk_pause=aggregation_config.get('chunk_pause', 0.5),
+            lag=aggregation_config.get('lag', 600),
+            poll_interval=aggregation_config.get('poll_interval', 10),
+            delete_batch_size=aggregation_config.get('delete_batch_size', 10000),
+            raw_retention_days=retention_config.get('raw_days', 30),
+            rollup_retention_days=retention_config.get('rollup_days')
+        )
+        aggregation_job.start()
+        # Keep the next days' partitions created ahead of time, so ingest rarely has to
+        partition_callback = tornado.ioloop.PeriodicCallback(precreate_future_partitions, 60 * 60 * 1000)  # hourly
+        partition_callback.start()
 
-    # Set up periodic callback for data aggregation (run daily)
-    aggregation_callback = tornado.ioloop.PeriodicCallback(aggregate_data, 24 * 60 * 60 * 1000)  # 24 hours in milliseconds
-    aggregation_callback.start()
+    # Create Tornado application
+    app = make_app(metric_processor, config=config, aggregation_job=aggregation_job,
+                   shared_replay_guard=task_id is not None)
 
     # Start the server
-    app.listen(options.port)
+    if task_id is None:
+        app.listen(options.port)
+    else:
+        # Every process binds its own SO_REUSEPORT socket so the kernel spreads
+        # connections across processes instead of waking all of them on accept
+        sockets = tornado.netutil.bind_sockets(options.port, reuse_port=True)
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets(sockets)
     logger.info(f"Server started on http://localhost:{options.port}")
 
     # Start the IOLoop
@@ -67,7 +163,13 @@ def main():
     finally:
         # Cleanup
         metric_processor.stop()
-        aggregation_callback.stop()
+        if spool:
+            spool.close()
+        get_storage().close()
+        if aggregation_job:
+            aggregation_job.stop()
+        if partition_callback:
+            partition_callback.stop()
         db = get_db()
         if db:
             db.close()
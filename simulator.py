@@ -5,8 +5,13 @@ from datetime import datetime
 import math
 import json
 from multiprocessing import Pool, cpu_count
-import io
 import logging
+from psycopg2.extras import execute_values
+from database import init_db, get_db
+from latest import update_latest
+from partitions import configure_partitions
+from rollups import add_points
+from storage import init_storage
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -27,6 +32,9 @@ def load_config():
 
 config = load_config()
 
+# Points written per transaction
+WRITE_BATCH_SIZE = 10000
+
 
 def get_db_connection():
     db_config = config['database']
@@ -54,10 +62,10 @@ def generate_host_data(args):
         for metric in metrics:
             value = generate_value(metric, current_time, base_values[metric], start_time)
             value = max(0, min(value, 100))
-            data.append(f"{host}\t{metric}\t{current_time}\t{value}")
+            data.append((metric, current_time, value))
         current_time += 3600 / metrics_per_hour
 
-    return "\n".join(data)
+    return host, data
 
 
 def generate_value(metric, timestamp, base_value, start_time):
@@ -74,49 +82,64 @@ def generate_value(metric, timestamp, base_value, start_time):
         return base_value + 30 * math.sin(day_progress) + random.uniform(-10, 10)
 
 
+def write_points(db, storage, rows):
+    """Write (series id, timestamp, value, message) rows the way ingest does, so the
+    rollups and latest values match what the storage backend actually kept."""
+    for i in range(0, len(rows), WRITE_BATCH_SIZE):
+        batch = rows[i:i + WRITE_BATCH_SIZE]
+        storage.prepare(db, [timestamp for _, timestamp, _, _ in batch])
+        with db.get_cursor() as cursor:
+            inserted = storage.write(cursor, batch)
+            add_points(cursor, [(series_id, timestamp, value) for series_id, timestamp, value, _ in inserted])
+            update_latest(cursor, inserted)
+
+
 def generate_test_data(num_hosts, days_of_data, metrics_per_hour):
     logger.info("Generating test data...")
     hosts = [f"host_{i}" for i in range(num_hosts)]
     end_time = time.time()
     start_time = end_time - (days_of_data * 24 * 60 * 60)
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    init_db(config['database'], create_schema=False)
+    configure_partitions(config.get('partitions', {}))
+    db = get_db()
+    # Points go through the configured backend, so they are stored wherever the server reads them
+    storage = init_storage(config.get('storage', {}))
 
     try:
-        # Insert hosts
-        host_data = [(host, json.dumps({"alias": f"Alias for {host}", "location": "Test Location"})) for host in hosts]
-        cursor.executemany("INSERT INTO hosts (hostname, tags) VALUES (%s, %s)", host_data)
-        conn.commit()
+        with db.get_cursor() as cursor:
+            host_data = [(host, json.dumps({"alias": f"Alias for {host}", "location": "Test Location"})) for host in hosts]
+            host_rows = execute_values(cursor, "INSERT INTO hosts (hostname, tags) VALUES %s RETURNING id, hostname",
+                                       host_data, fetch=True)
+            host_ids = {row['hostname']: row['id'] for row in host_rows}
 
         # Generate metric data in parallel
         with Pool(cpu_count()) as pool:
             results = pool.map(generate_host_data,
                                [(host, days_of_data, metrics_per_hour, start_time, end_time) for host in hosts])
 
-        # Use COPY to insert metric data
-        cursor.execute(
-            "CREATE TEMPORARY TABLE temp_metrics (hostname TEXT, metric_name TEXT, timestamp FLOAT, value FLOAT)")
-        for result in results:
-            with io.StringIO(result) as f:
-                cursor.copy_from(f, 'temp_metrics', columns=('hostname', 'metric_name', 'timestamp', 'value'))
+        for host, data in results:
+            # Simulated modules report a single value, stored in the module's "value" field
+            with db.get_cursor() as cursor:
+                series_rows = execute_values(cursor, """
+                    INSERT INTO series (host_id, metric_name, field)
+                    VALUES %s
+                    ON CONFLICT (host_id, metric_name, field) DO UPDATE
+                    SET field = EXCLUDED.field
+                    RETURNING id, metric_name
+                """, [(host_ids[host], metric, 'value') for metric in sorted({metric for metric, _, _ in data})],
+                    fetch=True)
+                series_ids = {row['metric_name']: row['id'] for row in series_rows}
+            write_points(db, storage, [(series_ids[metric], timestamp, value, None) for metric, timestamp, value in data])
+            logger.info(f"Wrote {len(data)} points for {host}")
 
-        cursor.execute("""
-            INSERT INTO metrics (host_id, metric_name, timestamp, value)
-            SELECT h.id, tm.metric_name, tm.timestamp, tm.value
-            FROM temp_metrics tm
-            JOIN hosts h ON tm.hostname = h.hostname
-        """)
-
-        conn.commit()
         logger.info("Data generation complete.")
     except psycopg2.Error as e:
-        conn.rollback()
         logger.error(f"Error generating test data: {e}")
         raise
     finally:
-        cursor.close()
-        conn.close()
+        storage.close()
+        db.close()
 
 
 def clear_test_data():
@@ -139,7 +162,7 @@ def clear_test_data():
 
         # Now delete the metrics
         cursor.execute("""
-            DELETE FROM metrics 
+            DELETE FROM series
             WHERE host_id IN (SELECT id FROM hosts WHERE hostname LIKE 'host_%')
         """)
 
@@ -0,0 +1,220 @@
+import os
+import json
+import struct
+import zlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Every record is a length and CRC32 header followed by one JSON-encoded payload
+RECORD_HEADER = struct.Struct('<II')
+SEGMENT_SUFFIX = '.spool'
+
+class Spool:
+    """Append-only, segmented on-disk log of accepted metric payloads.
+
+    Writers append records and wait for the next group fsync before acknowledging
+    the client. A single reader tails the log into the in-memory queue; items are
+    acked once their batch is committed, and a segment file is deleted once it has
+    been fully read and every item read from it has been acked. Segments left on
+    disk at startup are replayed from the beginning, so delivery is at-least-once.
+    """
+
+    def __init__(self, path, segment_size=64 * 1024 * 1024, fsync_interval=0.05, max_bytes=10 * 1024 ** 3):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.resume_bytes = int(max_bytes * 0.8)
+        self.condition = threading.Condition()
+        self.throttled = False
+        self.running = True
+
+        os.makedirs(path, exist_ok=True)
+        existing = self._list_segments()
+        self.segment_sizes = {segment: os.path.getsize(self._segment_path(segment)) for segment in existing}
+        self.outstanding = {}  # segment -> items handed to the queue but not yet acked
+
+        self.write_segment = existing[-1] + 1 if existing else 0
+        self.write_file = open(self._segment_path(self.write_segment), 'ab')
+        self.segment_sizes[self.write_segment] = 0
+        self.written_seq = 0
+        self.synced_seq = 0
+        self.synced_offset = 0  # bytes of the write segment known to be on disk
+
+        self.read_segment = existing[0] if existing else self.write_segment
+        self.read_offset = 0
+        self.read_file = None
+
+        if existing:
+            replay_bytes = sum(self.segment_sizes[segment] for segment in existing)
+            logger.info(f"Replaying {len(existing)} spool segments ({replay_bytes} bytes) from {path}")
+
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flusher.start()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, f"{segment:012d}{SEGMENT_SUFFIX}")
+
+    def _list_segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def append(self, items):
+        data = json.dumps(items, separators=(',', ':')).encode()
+        record = RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+        with self.condition:
+            if self.segment_sizes[self.write_segment] >= self.segment_size:
+                self._roll_segment()
+            self.write_file.write(record)
+            self.segment_sizes[self.write_segment] += len(record)
+            self.written_seq += 1
+            return self.written_seq
+
+    def append_durable(self, items):
+        """Append a payload and block until it has been fsynced."""
+        seq = self.append(items)
+        with self.condition:
+            while self.synced_seq < seq and self.running:
+                self.condition.wait()
+        return seq
+
+    def _roll_segment(self):
+        # Seal the current segment; everything written so far becomes durable
+        self._sync_locked()
+        self.write_file.close()
+        self.write_segment += 1
+        self.write_file = open(self._segment_path(self.write_segment), 'ab')
+        self.segment_sizes[self.write_segment] = 0
+        self.synced_offset = 0
+        self.condition.notify_all()
+
+    def _sync_locked(self):
+        if self.synced_seq == self.written_seq:
+            return
+        self.write_file.flush()
+        os.fsync(self.write_file.fileno())
+        self.synced_seq = self.written_seq
+        self.synced_offset = self.segment_sizes[self.write_segment]
+        self.condition.notify_all()
+
+    def _flush_loop(self):
+        # Group commit: one fsync covers every append since the previous one
+        while self.running:
+            time.sleep(self.fsync_interval)
+            try:
+                with self.condition:
+                    self._sync_locked()
+            except Exception as e:
+                logger.error(f"Error syncing spool segment: {e}", exc_info=True)
+
+    def read(self, timeout=1):
+        """Return the next durable (segment, items) record, or None if none arrives within timeout."""
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                sealed = self.read_segment < self.write_segment
+                limit = self.segment_sizes[self.read_segment] if sealed else self.synced_offset
+                if self.read_offset < limit:
+                    break
+                if sealed:
+                    self._advance_read_segment()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.running:
+                    return None
+                self.condition.wait(remaining)
+            segment, offset = self.read_segment, self.read_offset
+
+        # Bytes below limit are complete and never rewritten, so they can be read unlocked
+        if self.read_file is None:
+            self.read_file = open(self._segment_path(segment), 'rb')
+        self.read_file.seek(offset)
+        header = self.read_file.read(RECORD_HEADER.size)
+        items = None
+        if len(header) == RECORD_HEADER.size:
+            length, crc = RECORD_HEADER.unpack(header)
+            data = self.read_file.read(length)
+            if len(data) == length and zlib.crc32(data) == crc:
+                items = json.loads(data)
+                offset += RECORD_HEADER.size + length
+
+        with self.condition:
+            if items is None:
+                # A torn write from a crash can only be at the tail of a segment
+                logger.warning(f"Skipping corrupt tail of spool segment {segment} at offset {offset}")
+                self.read_offset = limit
+                return None
+            self.read_offset = offset
+            self.outstanding[segment] = self.outstanding.get(segment, 0) + len(items)
+        return segment, items
+
+    def _advance_read_segment(self):
+        if self.read_file is not None:
+            self.read_file.close()
+            self.read_file = None
+        finished = self.read_segment
+        self.read_segment = min(segment for segment in self.segment_sizes if segment > finished)
+        self.read_offset = 0
+        self._maybe_delete(finished)
+
+    def _maybe_delete(self, segment):
+        if (segment in self.segment_sizes and segment < self.read_segment and segment < self.write_segment
+                and self.outstanding.get(segment, 0) == 0):
+            os.remove(self._segment_path(segment))
+            del self.segment_sizes[segment]
+            self.outstanding.pop(segment, None)
+            logger.debug(f"Deleted fully committed spool segment {segment}")
+
+    def ack(self, counts):
+        """Mark items as committed; counts maps segment -> number of items."""
+        with self.condition:
+            for segment, count in counts.items():
+                self.outstanding[segment] = self.outstanding.get(segment, 0) - count
+                self._maybe_delete(segment)
+
+    def size(self):
+        with self.condition:
+            return sum(self.segment_sizes.values())
+
+    def accepting(self):
+        size = self.size()
+        with self.condition:
+            if self.throttled and size <= self.resume_bytes:
+                self.throttled = False
+                logger.info(f"Spool shrank to {size} bytes, accepting payloads again")
+            elif not self.throttled and size >= self.max_bytes:
+                self.throttled = True
+                logger.warning(f"Spool reached {size} bytes, rejecting payloads")
+            return not self.throttled
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                "bytes": sum(self.segment_sizes.values()),
+                "segments": len(self.segment_sizes),
+                "max_bytes": self.max_bytes,
+                "throttled": self.throttled,
+                "unacked_items": sum(self.outstanding.values())
+            }
+
+    def close(self):
+        with self.condition:
+            self._sync_locked()
+            self.running = False
+            self.write_file.close()
+            if self.read_file is not None:
+                self.read_file.close()
+                self.read_file = None
+            # Drop segments whose items were all committed so a clean restart doesn't replay them
+            for segment in sorted(self.segment_sizes):
+                fully_read = segment < self.read_segment or (
+                    segment == self.read_segment and self.read_offset >= self.segment_sizes[segment])
+                if fully_read and self.outstanding.get(segment, 0) == 0:
+                    os.remove(self._segment_path(segment))
+                    del self.segment_sizes[segment]
+            self.condition.notify_all()
+        self.flusher.join()
+        logger.info("Spool closed")
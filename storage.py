@@ -0,0 +1,615 @@
+import logging
+import threading
+from psycopg2.extras import RealDictCursor, execute_values
+from partitions import PartitionCache, ensure_partitions, partition_ranges, partition_width, window_start, drop_partitions_before
+from rollups import RESOLUTIONS, bucket_start, rebuild as rebuild_rollups, rebuild_buckets, replace_buckets, summarize
+from latest import rebuild_latest, replace_latest
+from tsdb import TimeSeriesDB
+
+logger = logging.getLogger(__name__)
+
+# Time span of one point_chunks row
+CHUNK_SECONDS = 60 * 60
+
+def _conditions(start, end, series_ids, timestamp='timestamp', series='series_id'):
+    conditions = ["TRUE"]
+    params = []
+    if start is not None:
+        conditions.append(f"{timestamp} >= %s")
+        params.append(start)
+    if end is not None:
+        conditions.append(f"{timestamp} <= %s")
+        params.append(end)
+    if series_ids is not None:
+        conditions.append(f"{series} = ANY(%s)")
+        params.append(list(series_ids))
+    return " AND ".join(conditions), params
+
+# Per-bucket aggregates of a points query, in the order bucket_points returns them
+BUCKET_COLUMNS = """
+    series_id, floor(timestamp / %s) * %s AS bucket,
+    MIN(value) AS min_value, MAX(value) AS max_value, COALESCE(SUM(value), 0) AS sum_value, COUNT(value) AS count,
+    MAX(timestamp) FILTER (WHERE value IS NOT NULL) AS last_timestamp,
+    (array_agg(value ORDER BY timestamp DESC) FILTER (WHERE value IS NOT NULL))[1] AS last_value,
+    (array_agg(message ORDER BY timestamp DESC) FILTER (WHERE message IS NOT NULL))[1] AS message
+"""
+
+def bucket_points(rows, width):
+    """Fold (series_id, timestamp, value, message) rows into (series_id, bucket, min, max, sum,
+    count, last_timestamp, last_value, message) rows ordered by bucket; message is the newest one."""
+    buckets = {}
+    for series_id, timestamp, value, message in rows:
+        key = (series_id, bucket_start(timestamp, width))
+        row = buckets.get(key)
+        if row is None:
+            row = buckets[key] = [None, None, 0.0, 0, None, None, None, None]
+        if value is not None:
+            row[0] = value if row[0] is None else min(row[0], value)
+            row[1] = value if row[1] is None else max(row[1], value)
+            row[2] += value
+            row[3] += 1
+            if row[4] is None or timestamp >= row[4]:
+                row[4] = timestamp
+                row[5] = value
+        if message is not None and (row[7] is None or timestamp >= row[7]):
+            row[6] = message
+            row[7] = timestamp
+    return [key + tuple(row[:7]) for key, row in sorted(buckets.items(), key=lambda item: (item[0][1], item[0][0]))]
+
+def combine_buckets(*row_lists):
+    """Merge bucket_points rows from several sources, given oldest data first, e.g.
+    the archive and then hot storage; a later source's message wins."""
+    buckets = {}
+    for rows in row_lists:
+        for row in rows:
+            key = row[:2]
+            current = buckets.get(key)
+            if current is None:
+                buckets[key] = row
+                continue
+            min_value = min((v for v in (current[2], row[2]) if v is not None), default=None)
+            max_value = max((v for v in (current[3], row[3]) if v is not None), default=None)
+            last = current[6:8] if row[6] is None or (current[6] is not None and current[6] > row[6]) else row[6:8]
+            message = row[8] if row[8] is not None else current[8]
+            buckets[key] = key + (min_value, max_value, current[4] + row[4], current[5] + row[5]) + last + (message,)
+    return [buckets[key] for key in sorted(buckets, key=lambda key: (key[1], key[0]))]
+
+def _bucket_rows(cursor):
+    return [(row['series_id'], row['bucket'], row['min_value'], row['max_value'], row['sum_value'], row['count'],
+             row['last_timestamp'], row['last_value'], row['message']) for row in cursor.fetchall()]
+
+class Storage:
+    """Where raw points live. Hosts, series, rollups, alerts and configs always stay
+    in PostgreSQL; a backend only stores (series id, timestamp, value, message) points.
+
+    Methods taking a cursor run inside the caller's transaction; a backend that
+    doesn't keep points in PostgreSQL ignores it.
+    """
+
+    name = None
+
+    def prepare(self, db, timestamps):
+        """Called before a batch's transaction, for work that needs its own transaction."""
+
+    def reset(self):
+        """Forget cached state after a write failed because it was stale."""
+
+    def write(self, cursor, rows):
+        """Store (series id, timestamp, value, message) rows; returns the rows that were new."""
+        raise NotImplementedError
+
+    def read(self, cursor, series_ids, start=None, end=None):
+        """Rows of the given series (all when None) in [start, end], ordered by timestamp;
+        a None bound leaves that side open."""
+        raise NotImplementedError
+
+    def export(self, conn, series_ids, start, end, chunk_size):
+        """Yield the points of the given series (all when None) in [start, end], ordered by
+        series id and then timestamp, in lists of at most chunk_size, so exporting a long
+        range never holds all of it; a None start begins at the oldest.
+
+        conn is a connection of its own, left in one transaction throughout. This
+        version reads one series and CHUNK_SECONDS window at a time.
+        """
+        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            if series_ids is None:
+                cursor.execute("SELECT id FROM series ORDER BY id")
+                series_ids = [row['id'] for row in cursor.fetchall()]
+            chunk = []
+            for series_id in sorted(series_ids):
+                window = start if start is not None else self.first_timestamp(cursor, [series_id])
+                while window is not None and window <= end:
+                    window_end = window + CHUNK_SECONDS
+                    chunk.extend(row for row in self.read(cursor, [series_id], window, min(window_end, end))
+                                 if row[1] < window_end)
+                    while len(chunk) >= chunk_size:
+                        yield chunk[:chunk_size]
+                        chunk = chunk[chunk_size:]
+                    window = window_end
+            if chunk:
+                yield chunk
+
+    def read_buckets(self, cursor, series_ids, start, end, width):
+        """Points of the given series in [start, end] aggregated into buckets width seconds
+        wide, as bucket_points rows. This version aggregates read() in Python."""
+        return bucket_points(self.read(cursor, series_ids, start, end), width)
+
+    def latest(self, cursor, series_ids):
+        """Newest row of each given series."""
+        raise NotImplementedError
+
+    def delete(self, cursor, series_ids, start=None, end=None):
+        """Remove points of the given series in [start, end]; returns the number removed."""
+        raise NotImplementedError
+
+    def series_with_points(self, cursor, series_ids):
+        raise NotImplementedError
+
+    def first_timestamp(self, cursor, series_ids=None):
+        """Oldest stored timestamp of the given series (all when None)."""
+        raise NotImplementedError
+
+    def first_timestamps(self, cursor, series_ids):
+        """Oldest stored timestamp of each given series, as {series_id: timestamp}; series
+        without points are left out. This version asks first_timestamp once per series."""
+        firsts = {}
+        for series_id in series_ids:
+            first = self.first_timestamp(cursor, [series_id])
+            if first is not None:
+                firsts[series_id] = first
+        return firsts
+
+    def drop_before(self, cursor, cutoff):
+        """Retention: drop whole storage units older than cutoff; returns their names."""
+        raise NotImplementedError
+
+    def seal(self, cursor, before, after=None):
+        """Move one unit of staged points between after and before into long-term
+        storage; returns where the next call should continue, or None when done."""
+        return None
+
+    def rebuild_rollup_buckets(self, cursor, resolution, first=None, last=None, series_ids=None):
+        # Generic version: summarize the raw points in Python and replace the buckets
+        rows = self.read(cursor, series_ids, first, last)
+        points = [(series_id, timestamp, value) for series_id, timestamp, value, _ in rows
+                  if last is None or timestamp < last]
+        return replace_buckets(cursor, resolution, first, last, series_ids,
+                               summarize(points, RESOLUTIONS[resolution]))
+
+    def rebuild_rollups(self, cursor, start=None, end=None, series_ids=None):
+        rebuild_rollups(cursor, start, end, series_ids, rebuild_tier=self.rebuild_rollup_buckets)
+
+    def rebuild_latest(self, cursor, series_ids):
+        replace_latest(cursor, series_ids, self.latest(cursor, series_ids))
+
+    def get_stats(self):
+        return {"backend": self.name}
+
+    def close(self):
+        pass
+
+class PostgresStorage(Storage):
+    """Points in the partitioned points table, one row per point."""
+
+    name = 'postgres'
+
+    def __init__(self):
+        self.partition_cache = PartitionCache()
+        self.lock = threading.Lock()
+
+    def prepare(self, db, timestamps):
+        with self.lock:
+            missing = {window_start(timestamp) for timestamp in timestamps
+                       if not self.partition_cache.covers(timestamp)}
+        if not missing:
+            return
+        # Separate short transaction: creating a partition locks points until commit
+        with db.get_cursor() as cursor:
+            for window in sorted(missing):
+                ensure_partitions(cursor, window, window + partition_width())
+            ranges = partition_ranges(cursor)
+        with self.lock:
+            self.partition_cache.load(ranges)
+
+    def reset(self):
+        with self.lock:
+            self.partition_cache.clear()
+
+    def write(self, cursor, rows):
+        # ON CONFLICT DO NOTHING keeps redelivered points from failing the batch
+        inserted = execute_values(cursor, """
+            INSERT INTO points (series_id, timestamp, value, message)
+            VALUES %s
+            ON CONFLICT DO NOTHING
+            RETURNING series_id, timestamp, value, message
+        """, rows, page_size=len(rows), fetch=True)
+        return [(row['series_id'], row['timestamp'], row['value'], row['message']) for row in inserted]
+
+    def read(self, cursor, series_ids, start=None, end=None):
+        condition, params = _conditions(start, end, series_ids)
+        cursor.execute(f"SELECT series_id, timestamp, value, message FROM points WHERE {condition} ORDER BY timestamp", params)
+        return [(row['series_id'], row['timestamp'], row['value'], row['message']) for row in cursor.fetchall()]
+
+    def _points_query(self, series_ids, start, end):
+        condition, params = _conditions(start, end, series_ids)
+        return f"SELECT series_id, timestamp, value, message FROM points WHERE {condition}", params
+
+    def export(self, conn, series_ids, start, end, chunk_size):
+        # A named cursor keeps the result on the server, which sends chunk_size rows per
+        # fetch; in primary key order the index hands them over without a sort
+        query, params = self._points_query(series_ids, start, end)
+        with conn.cursor(name='export_points') as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute(query + " ORDER BY series_id, timestamp", params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+
+    def read_buckets(self, cursor, series_ids, start, end, width):
+        # Only one row per bucket leaves the database
+        condition, params = _conditions(start, end, series_ids)
+        cursor.execute(f"""
+            SELECT {BUCKET_COLUMNS}
+            FROM points WHERE {condition}
+            GROUP BY series_id, bucket
+            ORDER BY bucket, series_id
+        """, [width, width] + params)
+        return _bucket_rows(cursor)
+
+    def latest(self, cursor, series_ids):
+        cursor.execute("""
+            SELECT s.id AS series_id, p.timestamp, p.value, p.message
+            FROM series s
+            CROSS JOIN LATERAL (
+                SELECT timestamp, value, message FROM points
+                WHERE series_id = s.id
+                ORDER BY timestamp DESC
+                LIMIT 1
+            ) p
+            WHERE s.id = ANY(%s)
+        """, (list(series_ids),))
+        return [(row['series_id'], row['timestamp'], row['value'], row['message']) for row in cursor.fetchall()]
+
+    def delete(self, cursor, series_ids, start=None, end=None):
+        condition, params = _conditions(start, end, series_ids)
+        cursor.execute(f"DELETE FROM points WHERE {condition}", params)
+        return cursor.rowcount
+
+    def series_with_points(self, cursor, series_ids):
+        cursor.execute("""
+            SELECT s.id FROM series s
+            WHERE s.id = ANY(%s) AND EXISTS (SELECT 1 FROM points p WHERE p.series_id = s.id)
+        """, (list(series_ids),))
+        return {row['id'] for row in cursor.fetchall()}
+
+    def first_timestamp(self, cursor, series_ids=None):
+        if series_ids is None:
+            cursor.execute("SELECT MIN(timestamp) AS first FROM points")
+        else:
+            cursor.execute("""
+                SELECT MIN(p.timestamp) AS first
+                FROM unnest(%s::integer[]) AS s (id)
+                CROSS JOIN LATERAL (
+                    SELECT timestamp FROM points
+                    WHERE series_id = s.id
+                    ORDER BY timestamp
+                    LIMIT 1
+                ) p
+            """, (list(series_ids),))
+        return cursor.fetchone()['first']
+
+    def first_timestamps(self, cursor, series_ids):
+        cursor.execute("""
+            SELECT s.id AS series_id, p.timestamp
+            FROM unnest(%s::integer[]) AS s (id)
+            CROSS JOIN LATERAL (
+                SELECT timestamp FROM points
+                WHERE series_id = s.id
+                ORDER BY timestamp
+                LIMIT 1
+            ) p
+        """, (list(series_ids),))
+        return {row['series_id']: row['timestamp'] for row in cursor.fetchall()}
+
+    def drop_before(self, cursor, cutoff):
+        return drop_partitions_before(cursor, cutoff)
+
+    def rebuild_rollup_buckets(self, cursor, resolution, first=None, last=None, series_ids=None):
+        # Aggregated in the database instead of shipping the points to Python
+        return rebuild_buckets(cursor, resolution, first, last, series_ids)
+
+    def rebuild_latest(self, cursor, series_ids):
+        rebuild_latest(cursor, series_ids)
+
+class ChunkedPostgresStorage(PostgresStorage):
+    """Points in PostgreSQL, packed into one point_chunks row per series and hour.
+
+    New points are staged in the points table; the aggregation job seals every
+    closed hour into arrays sorted by timestamp, so reading a day of one series
+    touches 24 rows instead of thousands and the per-row overhead is paid once
+    per hour. Reads and deletes cover both tables.
+    """
+
+    name = 'pg_chunked'
+
+    def write(self, cursor, rows):
+        # Also skips redelivered points whose hour has been sealed already
+        inserted = execute_values(cursor, f"""
+            INSERT INTO points (series_id, timestamp, value, message)
+            SELECT v.series_id, v.timestamp, v.value, v.message
+            FROM (VALUES %s) AS v (series_id, timestamp, value, message)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM point_chunks c
+                WHERE c.series_id = v.series_id
+                  AND c.chunk_start = floor(v.timestamp / {CHUNK_SECONDS}) * {CHUNK_SECONDS}
+                  AND v.timestamp = ANY(c.timestamps)
+            )
+            ON CONFLICT DO NOTHING
+            RETURNING series_id, timestamp, value, message
+        """, rows, template="(%s::integer, %s::float8, %s::float8, %s::text)", page_size=len(rows), fetch=True)
+        return [(row['series_id'], row['timestamp'], row['value'], row['message']) for row in inserted]
+
+    def _points_query(self, series_ids, start, end):
+        first = bucket_start(start, CHUNK_SECONDS) if start is not None else None
+        chunk_condition, chunk_params = _conditions(first, end, series_ids, 'c.chunk_start', 'c.series_id')
+        point_condition, point_params = _conditions(start, end, None, 't.timestamp')
+        staged_condition, staged_params = _conditions(start, end, series_ids)
+        # unnest pads a NULL messages array with NULLs
+        return f"""
+            SELECT c.series_id, t.timestamp, t.value, t.message
+            FROM point_chunks c
+            CROSS JOIN LATERAL unnest(c.timestamps, c.point_values, c.messages) AS t (timestamp, value, message)
+            WHERE {chunk_condition} AND {point_condition}
+            UNION ALL
+            SELECT series_id, timestamp, value, message FROM points WHERE {staged_condition}
+        """, chunk_params + point_params + staged_params
+
+    def read(self, cursor, series_ids, start=None, end=None):
+        query, params = self._points_query(series_ids, start, end)
+        cursor.execute(query + " ORDER BY timestamp", params)
+        return [(row['series_id'], row['timestamp'], row['value'], row['message']) for row in cursor.fetchall()]
+
+    def read_buckets(self, cursor, series_ids, start, end, width):
+        query, params = self._points_query(series_ids, start, end)
+        cursor.execute(f"""
+            SELECT {BUCKET_COLUMNS}
+            FROM ({query}) p
+            GROUP BY series_id, bucket
+            ORDER BY bucket, series_id
+        """, [width, width] + params)
+        return _bucket_rows(cursor)
+
+    def latest(self, cursor, series_ids):
+        # Chunk arrays are sorted, so the newest sealed point is the last element
+        cursor.execute("""
+            SELECT s.id AS series_id, p.timestamp, p.value, p.message
+            FROM series s
+            CROSS JOIN LATERAL (
+                (SELECT timestamp, value, message FROM points
+                 WHERE series_id = s.id
+                 ORDER BY timestamp DESC
+                 LIMIT 1)
+                UNION ALL
+                (SELECT timestamps[n], point_values[n], messages[n]
+                 FROM point_chunks, cardinality(timestamps) AS n
+                 WHERE series_id = s.id
+                 ORDER BY chunk_start DESC
+                 LIMIT 1)
+                ORDER BY timestamp DESC
+                LIMIT 1
+            ) p
+            WHERE s.id = ANY(%s)
+        """, (list(series_ids),))
+        return [(row['series_id'], row['timestamp'], row['value'], row['message']) for row in cursor.fetchall()]
+
+    def delete(self, cursor, series_ids, start=None, end=None):
+        removed = super().delete(cursor, series_ids, start, end)
+        # Chunks entirely inside the range go at once; the ones at its edges are rewritten
+        condition, params = _conditions(start, end - CHUNK_SECONDS if end is not None else None,
+                                        series_ids, 'chunk_start')
+        cursor.execute(f"DELETE FROM point_chunks WHERE {condition} RETURNING cardinality(timestamps) AS points", params)
+        removed += sum(row['points'] for row in cursor.fetchall())
+
+        first = bucket_start(start, CHUNK_SECONDS) if start is not None else None
+        condition, params = _conditions(first, end, series_ids, 'chunk_start')
+        cursor.execute(f"""
+            SELECT series_id, chunk_start, timestamps, point_values, messages
+            FROM point_chunks WHERE {condition}
+            FOR UPDATE
+        """, params)
+        for row in cursor.fetchall():
+            points = zip(row['timestamps'], row['point_values'], row['messages'] or [None] * len(row['timestamps']))
+            kept = [point for point in points
+                    if (start is not None and point[0] < start) or (end is not None and point[0] > end)]
+            removed += len(row['timestamps']) - len(kept)
+            key = (row['series_id'], row['chunk_start'])
+            if kept:
+                self._store_chunks(cursor, [self._chunk_row(key, kept)])
+            else:
+                cursor.execute("DELETE FROM point_chunks WHERE series_id = %s AND chunk_start = %s", key)
+        return removed
+
+    def series_with_points(self, cursor, series_ids):
+        cursor.execute("""
+            SELECT s.id FROM series s
+            WHERE s.id = ANY(%s)
+              AND (EXISTS (SELECT 1 FROM points p WHERE p.series_id = s.id)
+                   OR EXISTS (SELECT 1 FROM point_chunks c WHERE c.series_id = s.id))
+        """, (list(series_ids),))
+        return {row['id'] for row in cursor.fetchall()}
+
+    def first_timestamp(self, cursor, series_ids=None):
+        if series_ids is not None:
+            first = super().first_timestamp(cursor, series_ids)
+            cursor.execute("""
+                SELECT MIN(c.timestamps[1]) AS first
+                FROM unnest(%s::integer[]) AS s (id)
+                CROSS JOIN LATERAL (
+                    SELECT timestamps FROM point_chunks
+                    WHERE series_id = s.id
+                    ORDER BY chunk_start
+                    LIMIT 1
+                ) c
+            """, (list(series_ids),))
+            sealed = cursor.fetchone()['first']
+            return min((t for t in (first, sealed) if t is not None), default=None)
+        cursor.execute("""
+            SELECT LEAST(
+                (SELECT MIN(timestamp) FROM points),
+                (SELECT MIN(timestamps[1]) FROM point_chunks
+                 WHERE chunk_start = (SELECT MIN(chunk_start) FROM point_chunks))
+            ) AS first
+        """)
+        return cursor.fetchone()['first']
+
+    def first_timestamps(self, cursor, series_ids):
+        firsts = super().first_timestamps(cursor, series_ids)
+        cursor.execute("""
+            SELECT s.id AS series_id, c.timestamps[1] AS timestamp
+            FROM unnest(%s::integer[]) AS s (id)
+            CROSS JOIN LATERAL (
+                SELECT timestamps FROM point_chunks
+                WHERE series_id = s.id
+                ORDER BY chunk_start
+                LIMIT 1
+            ) c
+        """, (list(series_ids),))
+        for row in cursor.fetchall():
+            first = firsts.get(row['series_id'])
+            if first is None or row['timestamp'] < first:
+                firsts[row['series_id']] = row['timestamp']
+        return firsts
+
+    def drop_before(self, cursor, cutoff):
+        dropped = super().drop_before(cursor, cutoff)
+        cursor.execute("DELETE FROM point_chunks WHERE chunk_start <= %s RETURNING series_id, chunk_start",
+                       (cutoff - CHUNK_SECONDS,))
+        return dropped + [f"point_chunks {row['series_id']}@{row['chunk_start']:.0f}" for row in cursor.fetchall()]
+
+    def rebuild_rollup_buckets(self, cursor, resolution, first=None, last=None, series_ids=None):
+        # The points table only holds the staged points, so aggregate the unnested chunks too
+        return rebuild_buckets(cursor, resolution, first, last, series_ids,
+                               source=self._points_query(series_ids, first, last))
+
+    rebuild_latest = Storage.rebuild_latest
+
+    def seal(self, cursor, before, after=None):
+        before = bucket_start(before, CHUNK_SECONDS)
+        condition, params = _conditions(after, None, None)
+        cursor.execute(f"SELECT MIN(timestamp) AS first FROM points WHERE {condition} AND timestamp < %s",
+                       params + [before])
+        first = cursor.fetchone()['first']
+        if first is None:
+            return None
+        start = bucket_start(first, CHUNK_SECONDS)
+        cursor.execute("""
+            DELETE FROM points WHERE timestamp >= %s AND timestamp < %s
+            RETURNING series_id, timestamp, value, message
+        """, (start, start + CHUNK_SECONDS))
+        staged = {}
+        for row in cursor.fetchall():
+            staged.setdefault(row['series_id'], {})[row['timestamp']] = (row['value'], row['message'])
+
+        # Late points for an hour sealed earlier are merged into its chunk
+        cursor.execute("""
+            SELECT series_id, timestamps, point_values, messages FROM point_chunks
+            WHERE chunk_start = %s AND series_id = ANY(%s)
+            FOR UPDATE
+        """, (start, sorted(staged)))
+        for row in cursor.fetchall():
+            messages = row['messages'] or [None] * len(row['timestamps'])
+            staged[row['series_id']].update(zip(row['timestamps'], zip(row['point_values'], messages)))
+
+        self._store_chunks(cursor, [
+            self._chunk_row((series_id, start), [(timestamp,) + points[timestamp] for timestamp in points])
+            for series_id, points in sorted(staged.items())
+        ])
+        return start + CHUNK_SECONDS
+
+    def _chunk_row(self, key, points):
+        points = sorted(points, key=lambda point: point[0])
+        messages = [point[2] for point in points]
+        return key + ([point[0] for point in points], [point[1] for point in points],
+                      messages if any(message is not None for message in messages) else None)
+
+    def _store_chunks(self, cursor, rows):
+        execute_values(cursor, """
+            INSERT INTO point_chunks (series_id, chunk_start, timestamps, point_values, messages)
+            VALUES %s
+            ON CONFLICT (series_id, chunk_start) DO UPDATE SET
+                timestamps = EXCLUDED.timestamps,
+                point_values = EXCLUDED.point_values,
+                messages = EXCLUDED.messages
+        """, rows, template="(%s, %s, %s::float8[], %s::float8[], %s::text[])", page_size=500)
+
+class TsdbStorage(Storage):
+    """Points in the embedded compressed store (tsdb.py) on local disk.
+
+    The store has a single writer, so the server must run as one process. Points
+    are written before the batch's PostgreSQL transaction commits; if that commit
+    fails, the retried batch finds them already stored, and the aggregation job
+    corrects the rollups once their buckets close.
+    """
+
+    name = 'tsdb'
+
+    def __init__(self, path, block_duration=2 * 60 * 60, grace=10 * 60, compact_duration=24 * 60 * 60, fsync=True):
+        self.store = TimeSeriesDB(path, block_duration=block_duration, grace=grace,
+                                  compact_duration=compact_duration, fsync=fsync)
+        self.store.open()
+
+    def write(self, cursor, rows):
+        return self.store.write(rows)
+
+    def read(self, cursor, series_ids, start=None, end=None):
+        return self.store.read(series_ids, start, end)
+
+    def latest(self, cursor, series_ids):
+        return self.store.latest(series_ids)
+
+    def delete(self, cursor, series_ids, start=None, end=None):
+        return self.store.delete(series_ids, start, end)
+
+    def series_with_points(self, cursor, series_ids):
+        return self.store.series_with_points(series_ids)
+
+    def first_timestamp(self, cursor, series_ids=None):
+        return self.store.first_timestamp(series_ids)
+
+    def drop_before(self, cursor, cutoff):
+        return self.store.drop_before(cutoff)
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats.update(self.store.get_stats())
+        return stats
+
+    def close(self):
+        self.store.close()
+
+storage = None
+
+def init_storage(config):
+    global storage
+    backend = config.get('backend', 'postgres')
+    if backend == 'postgres':
+        storage = PostgresStorage()
+    elif backend == 'pg_chunked':
+        storage = ChunkedPostgresStorage()
+    elif backend == 'tsdb':
+        storage = TsdbStorage(
+            config.get('path', 'tsdb'),
+            block_duration=config.get('block_duration', 2 * 60 * 60),
+            grace=config.get('grace', 10 * 60),
+            compact_duration=config.get('compact_duration', 24 * 60 * 60),
+            fsync=config.get('fsync', True)
+        )
+    else:
+        raise ValueError(f"Unknown storage backend: {backend}")
+    logger.info(f"Using {backend} storage for metric points")
+    return storage
+
+def get_storage():
+    return storage
@@ -0,0 +1,13 @@
+from unittest import mock
+
+from storage import ChunkedPostgresStorage
+
+def test_chunked_rollup_rebuild_stays_in_the_database():
+    storage = ChunkedPostgresStorage()
+    cursor = mock.MagicMock()
+    with mock.patch.object(ChunkedPostgresStorage, 'read', side_effect=AssertionError("read() called")) as read:
+        storage.rebuild_rollups(cursor, 0, 86400, [1, 2])
+    read.assert_not_called()
+    inserts = [repr(call.args[0]) for call in cursor.execute.call_args_list if 'INSERT INTO' in repr(call.args[0])]
+    assert len(inserts) == 3
+    assert all('point_chunks' in query and 'unnest' in query for query in inserts)
@@ -0,0 +1,642 @@
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Timestamps are kept as integer microseconds so they can be delta encoded
+TICKS_PER_SECOND = 1000000
+MIN_TICKS = -(1 << 63)
+MAX_TICKS = (1 << 63) - 1
+# A quiet NaN payload standing in for a missing value; stored values are always finite
+NONE_BITS = 0x7ff8000000000bad
+
+WAL_RECORD = struct.Struct('<II')  # payload length, crc32
+WAL_POINT = struct.Struct('<IqQI')  # series id, ticks, value bits, message length
+CHUNK_HEADER = struct.Struct('<II')  # point count, bitstream length
+
+# Delta-of-delta buckets as (prefix, prefix bits, value bits); anything larger
+# is written as prefix 1111 plus 64 bits. Collection jitter of a few milliseconds
+# fits the 14 bit bucket.
+DOD_BUCKETS = [(0b10, 2, 14), (0b110, 3, 20), (0b1110, 4, 32)]
+
+def to_ticks(timestamp):
+    return int(round(timestamp * TICKS_PER_SECOND))
+
+def from_ticks(ticks):
+    return ticks / TICKS_PER_SECOND
+
+def value_bits(value):
+    if value is None:
+        return NONE_BITS
+    return struct.unpack('>Q', struct.pack('>d', value))[0]
+
+def bits_value(bits):
+    if bits == NONE_BITS:
+        return None
+    return struct.unpack('>d', struct.pack('>Q', bits))[0]
+
+class BitWriter:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.current = 0
+        self.bits = 0
+
+    def write(self, value, nbits):
+        self.current = (self.current << nbits) | (value & ((1 << nbits) - 1))
+        self.bits += nbits
+        while self.bits >= 8:
+            self.bits -= 8
+            self.buffer.append((self.current >> self.bits) & 0xff)
+        self.current &= (1 << self.bits) - 1
+
+    def getvalue(self):
+        if self.bits:
+            return bytes(self.buffer) + bytes([(self.current << (8 - self.bits)) & 0xff])
+        return bytes(self.buffer)
+
+class BitReader:
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read(self, nbits):
+        start = self.position >> 3
+        end = (self.position + nbits + 7) >> 3
+        chunk = int.from_bytes(self.data[start:end], 'big')
+        shift = (end - start) * 8 - (self.position & 7) - nbits
+        self.position += nbits
+        return (chunk >> shift) & ((1 << nbits) - 1)
+
+def _signed(value, nbits):
+    return value - (1 << nbits) if value >= 1 << (nbits - 1) else value
+
+def encode_chunk(points):
+    """Encode time-ordered (ticks, value bits, message) points Gorilla style.
+
+    Timestamps are delta-of-delta encoded and values XORed with their
+    predecessor, so regular intervals and slowly changing values cost a few bits
+    per point. Messages are rare and go into a zlib'd sparse list after the bits.
+    """
+    writer = BitWriter()
+    first_ticks, first_bits, _ = points[0]
+    writer.write(first_ticks, 64)
+    writer.write(first_bits, 64)
+    previous_ticks, previous_delta = first_ticks, 0
+    previous_bits, leading, trailing = first_bits, 65, 0
+
+    for ticks, bits, _ in points[1:]:
+        delta = ticks - previous_ticks
+        dod = delta - previous_delta
+        if dod == 0:
+            writer.write(0, 1)
+        else:
+            for prefix, prefix_bits, nbits in DOD_BUCKETS:
+                if -(1 << (nbits - 1)) <= dod < 1 << (nbits - 1):
+                    writer.write(prefix, prefix_bits)
+                    writer.write(dod, nbits)
+                    break
+            else:
+                writer.write(0b1111, 4)
+                writer.write(dod, 64)
+        previous_ticks, previous_delta = ticks, delta
+
+        xor = bits ^ previous_bits
+        if xor == 0:
+            writer.write(0, 1)
+        else:
+            new_leading = min(64 - xor.bit_length(), 31)
+            new_trailing = (xor & -xor).bit_length() - 1
+            if leading <= new_leading and trailing <= new_trailing:
+                # Meaningful bits fit in the previous window
+                writer.write(0b10, 2)
+                writer.write(xor >> trailing, 64 - leading - trailing)
+            else:
+                leading, trailing = new_leading, new_trailing
+                length = 64 - leading - trailing
+                writer.write(0b11, 2)
+                writer.write(leading, 5)
+                writer.write(length - 1, 6)
+                writer.write(xor >> trailing, length)
+        previous_bits = bits
+
+    stream = writer.getvalue()
+    messages = [[i, message] for i, (_, _, message) in enumerate(points) if message]
+    blob = zlib.compress(json.dumps(messages).encode()) if messages else b''
+    return CHUNK_HEADER.pack(len(points), len(stream)) + stream + blob
+
+def decode_chunk(data):
+    """Inverse of encode_chunk: a list of (ticks, value, message)."""
+    count, stream_length = CHUNK_HEADER.unpack_from(data)
+    stream = bytes(data[CHUNK_HEADER.size:CHUNK_HEADER.size + stream_length])
+    blob = bytes(data[CHUNK_HEADER.size + stream_length:])
+    messages = dict(json.loads(zlib.decompress(blob))) if blob else {}
+
+    reader = BitReader(stream)
+    ticks = _signed(reader.read(64), 64)
+    bits = reader.read(64)
+    points = [(ticks, bits_value(bits), messages.get(0))]
+    delta, leading, trailing = 0, 0, 0
+    for i in range(1, count):
+        if reader.read(1):
+            for prefix, prefix_bits, nbits in DOD_BUCKETS:
+                if reader.read(1) == 0:
+                    delta += _signed(reader.read(nbits), nbits)
+                    break
+            else:
+                delta += _signed(reader.read(64), 64)
+        ticks += delta
+
+        if reader.read(1):
+            if reader.read(1):
+                leading = reader.read(5)
+                length = reader.read(6) + 1
+                trailing = 64 - leading - length
+            bits ^= reader.read(64 - leading - trailing) << trailing
+        points.append((ticks, bits_value(bits), messages.get(i)))
+    return points
+
+class Block:
+    """An immutable directory of compressed chunks, one per series, read through mmap."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+        self.sequence = meta['sequence']
+        self.min_ticks = meta['min_ticks']
+        self.max_ticks = meta['max_ticks']
+        self.series = {int(series_id): entry for series_id, entry in meta['series'].items()}
+        with open(os.path.join(path, 'chunks'), 'rb') as chunks_file:
+            # Blocks are never modified once written; a replaced block is unlinked
+            # but its mapping stays valid for readers still holding it
+            self.data = mmap.mmap(chunks_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def write(directory, name, sequence, points_by_series):
+        """Write a block atomically; points_by_series maps series id -> {ticks: (value, message)}."""
+        return Block.write_series(directory, name, sequence, (
+            (series_id, [(ticks, value, message) for ticks, (value, message) in sorted(points.items())])
+            for series_id, points in sorted(points_by_series.items())))
+
+    @staticmethod
+    def write_series(directory, name, sequence, series_points):
+        """Write a block atomically from (series id, [(ticks, value, message)]) pairs in series
+        id order, each with its points in ticks order; only one series is held at a time."""
+        tmp_path = os.path.join(directory, name + '.tmp')
+        os.makedirs(tmp_path)
+        series = {}
+        offset = 0
+        min_ticks, max_ticks = None, None
+        try:
+            with open(os.path.join(tmp_path, 'chunks'), 'wb') as chunks_file:
+                for series_id, points in series_points:
+                    if not points:
+                        continue
+                    chunk = encode_chunk([(ticks, value_bits(value), message) for ticks, value, message in points])
+                    chunks_file.write(chunk)
+                    series[str(series_id)] = [offset, len(chunk), points[0][0], points[-1][0], len(points)]
+                    offset += len(chunk)
+                    min_ticks = points[0][0] if min_ticks is None else min(min_ticks, points[0][0])
+                    max_ticks = points[-1][0] if max_ticks is None else max(max_ticks, points[-1][0])
+                chunks_file.flush()
+                os.fsync(chunks_file.fileno())
+        except BaseException:
+            # series_points may be reading from the database
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        if not series:
+            shutil.rmtree(tmp_path)
+            return None
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as meta_file:
+            json.dump({'sequence': sequence, 'min_ticks': min_ticks, 'max_ticks': max_ticks, 'series': series}, meta_file)
+            meta_file.flush()
+            os.fsync(meta_file.fileno())
+        path = os.path.join(directory, name)
+        os.rename(tmp_path, path)
+        return Block(path)
+
+    def overlaps(self, start_ticks, end_ticks):
+        return self.min_ticks <= end_ticks and self.max_ticks >= start_ticks
+
+    def read_series(self, series_id, start_ticks, end_ticks):
+        entry = self.series.get(series_id)
+        if entry is None or entry[2] > end_ticks or entry[3] < start_ticks:
+            return []
+        offset, length = entry[0], entry[1]
+        return [point for point in decode_chunk(self.data[offset:offset + length])
+                if start_ticks <= point[0] <= end_ticks]
+
+    def read_all(self):
+        return {series_id: {ticks: (value, message)
+                            for ticks, value, message in self.read_series(series_id, self.min_ticks, self.max_ticks)}
+                for series_id in self.series}
+
+    def size(self):
+        return len(self.data)
+
+    def point_count(self):
+        return sum(entry[4] for entry in self.series.values())
+
+class TimeSeriesDB:
+    """Embedded store for numeric points keyed by (series id, timestamp).
+
+    New points are appended to a write-ahead log and kept in an in-memory head.
+    Once a block_duration window is over (plus grace for stragglers), its points
+    are sealed into an immutable compressed block and the log is rewritten
+    without them. Blocks of the same day are compacted into one. A timestamp
+    written twice keeps its first value, like ON CONFLICT DO NOTHING.
+    """
+
+    def __init__(self, path, block_duration=2 * 60 * 60, grace=10 * 60, compact_duration=24 * 60 * 60,
+                 fsync=True, check_interval=60):
+        self.path = path
+        self.block_duration = block_duration
+        self.grace = grace
+        self.compact_duration = compact_duration
+        self.fsync = fsync
+        self.check_interval = check_interval
+        self.lock = threading.Lock()  # guards head, sealing, blocks and the WAL
+        self.structure_lock = threading.Lock()  # one seal, compaction, delete or drop at a time
+        self.head = {}  # series id -> {ticks: (value, message)}
+        self.sealing = {}  # points being written to a block, still visible to reads
+        self.blocks = []  # ordered by sequence; earlier blocks win on duplicate timestamps
+        self.next_sequence = 0
+        self.sealed_until = 0
+        self.wal = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def open(self):
+        self.blocks_path = os.path.join(self.path, 'blocks')
+        os.makedirs(self.blocks_path, exist_ok=True)
+        for name in os.listdir(self.blocks_path):
+            block_path = os.path.join(self.blocks_path, name)
+            if name.endswith('.tmp'):
+                # Left by a crash while writing; its points are still in the WAL or older blocks
+                shutil.rmtree(block_path)
+                continue
+            self.blocks.append(Block(block_path))
+        self.blocks.sort(key=lambda block: block.sequence)
+        # Compacted blocks keep an old sequence under a new name, so both are considered
+        used = [block.sequence for block in self.blocks] + [int(block.name) for block in self.blocks]
+        self.next_sequence = max(used) + 1 if used else 0
+
+        self.wal_path = os.path.join(self.path, 'wal')
+        replayed = self._replay_wal()
+        self.wal = open(self.wal_path, 'ab')
+        logger.info(f"Opened time series store at {self.path}: {len(self.blocks)} blocks, "
+                    f"{replayed} points replayed from the WAL")
+
+        self.thread = threading.Thread(target=self._maintenance_loop, daemon=True, name='tsdb-maintenance')
+        self.thread.start()
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            if self.wal:
+                self.wal.close()
+                self.wal = None
+
+    def _replay_wal(self):
+        if not os.path.exists(self.wal_path):
+            return 0
+        replayed = 0
+        good_offset = 0
+        with open(self.wal_path, 'rb') as wal:
+            data = wal.read()
+        offset = 0
+        while offset + WAL_RECORD.size <= len(data):
+            length, crc = WAL_RECORD.unpack_from(data, offset)
+            payload = data[offset + WAL_RECORD.size:offset + WAL_RECORD.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            for series_id, ticks, value, message in self._decode_record(payload):
+                self.head.setdefault(series_id, {}).setdefault(ticks, (value, message))
+                replayed += 1
+            offset += WAL_RECORD.size + length
+            good_offset = offset
+        if good_offset < len(data):
+            # A torn write from a crash; everything before it was acknowledged
+            logger.warning(f"Truncating {len(data) - good_offset} bytes of incomplete WAL data")
+            with open(self.wal_path, 'r+b') as wal:
+                wal.truncate(good_offset)
+        return replayed
+
+    @staticmethod
+    def _encode_record(points):
+        parts = []
+        for series_id, ticks, value, message in points:
+            message_bytes = message.encode() if message else b''
+            parts.append(WAL_POINT.pack(series_id, ticks, value_bits(value), len(message_bytes)))
+            parts.append(message_bytes)
+        payload = b''.join(parts)
+        return WAL_RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+
+    @staticmethod
+    def _decode_record(payload):
+        offset = 0
+        while offset < len(payload):
+            series_id, ticks, bits, message_length = WAL_POINT.unpack_from(payload, offset)
+            offset += WAL_POINT.size
+            message = payload[offset:offset + message_length].decode() if message_length else None
+            offset += message_length
+            yield series_id, ticks, bits_value(bits), message
+
+    def _append_wal(self, points):
+        self.wal.write(self._encode_record(points))
+        self.wal.flush()
+        if self.fsync:
+            os.fsync(self.wal.fileno())
+
+    def _checkpoint_wal(self):
+        # Rewrite the log with only what's left in the head; caller holds self.lock
+        tmp_path = self.wal_path + '.tmp'
+        with open(tmp_path, 'wb') as wal:
+            points = [(series_id, ticks, value, message)
+                      for series_id, series_points in self.head.items()
+                      for ticks, (value, message) in series_points.items()]
+            if points:
+                wal.write(self._encode_record(points))
+            wal.flush()
+            os.fsync(wal.fileno())
+        self.wal.close()
+        os.rename(tmp_path, self.wal_path)
+        self.wal = open(self.wal_path, 'ab')
+
+    def _stored_in_blocks(self, points):
+        # (series id, ticks) keys of points already sealed into a block; caller holds self.lock
+        wanted = {}
+        for series_id, ticks, value, message in points:
+            wanted.setdefault(series_id, set()).add(ticks)
+        stored = set()
+        for series_id, ticks_set in wanted.items():
+            first, last = min(ticks_set), max(ticks_set)
+            for block in self.blocks:
+                # read_series skips blocks whose range for the series misses [first, last]
+                stored.update((series_id, ticks) for ticks, value, message in block.read_series(series_id, first, last)
+                              if ticks in ticks_set)
+        return stored
+
+    def write(self, points):
+        """Store (series id, timestamp, value, message) points; returns the ones that were new.
+
+        Points already in the head, being sealed or in a block whose range for the
+        series overlaps the batch are dropped, so redelivered data is stored once.
+        """
+        with self.lock:
+            new = []
+            seen = set()
+            for series_id, timestamp, value, message in points:
+                ticks = to_ticks(timestamp)
+                key = (series_id, ticks)
+                if key in seen or ticks in self.head.get(series_id, ()) or ticks in self.sealing.get(series_id, ()):
+                    continue
+                seen.add(key)
+                new.append((series_id, ticks, value, message))
+            stored = self._stored_in_blocks(new) if new and self.blocks else None
+            if stored:
+                new = [point for point in new if (point[0], point[1]) not in stored]
+            if not new:
+                return []
+            self._append_wal(new)
+            for series_id, ticks, value, message in new:
+                self.head.setdefault(series_id, {})[ticks] = (value, message)
+        return [(series_id, from_ticks(ticks), value, message) for series_id, ticks, value, message in new]
+
+    def _snapshot(self, series_ids, start_ticks, end_ticks):
+        with self.lock:
+            blocks = [block for block in self.blocks if block.overlaps(start_ticks, end_ticks)]
+            memory = []
+            for source in (self.sealing, self.head):
+                ids = source.keys() if series_ids is None else [i for i in series_ids if i in source]
+                memory.append({series_id: {ticks: point for ticks, point in source[series_id].items()
+                                           if start_ticks <= ticks <= end_ticks}
+                               for series_id in ids})
+        return blocks, memory
+
+    def read(self, series_ids, start=None, end=None):
+        """Points of the given series (all when None) in [start, end], ordered by timestamp."""
+        start_ticks = to_ticks(start) if start is not None else MIN_TICKS
+        end_ticks = to_ticks(end) if end is not None else MAX_TICKS
+        blocks, memory = self._snapshot(series_ids, start_ticks, end_ticks)
+        merged = {}
+        for block in blocks:
+            ids = block.series.keys() if series_ids is None else series_ids
+            for series_id in ids:
+                points = block.read_series(series_id, start_ticks, end_ticks)
+                if points:
+                    target = merged.setdefault(series_id, {})
+                    for ticks, value, message in points:
+                        target.setdefault(ticks, (value, message))
+        for source in memory:
+            for series_id, points in source.items():
+                target = merged.setdefault(series_id, {})
+                for ticks, point in points.items():
+                    target.setdefault(ticks, point)
+        rows = [(from_ticks(ticks), series_id, value, message)
+                for series_id, points in merged.items()
+                for ticks, (value, message) in points.items()]
+        rows.sort()
+        return [(series_id, timestamp, value, message) for timestamp, series_id, value, message in rows]
+
+    def latest(self, series_ids):
+        """Newest point of each given series, as (series id, timestamp, value, message) rows."""
+        with self.lock:
+            blocks = list(self.blocks)
+            newest = {}
+            for source in (self.sealing, self.head):
+                for series_id in series_ids:
+                    points = source.get(series_id)
+                    if points:
+                        ticks = max(points)
+                        if series_id not in newest or ticks > newest[series_id][0]:
+                            newest[series_id] = (ticks,) + points[ticks]
+        for block in sorted(blocks, key=lambda block: block.max_ticks, reverse=True):
+            for series_id in series_ids:
+                entry = block.series.get(series_id)
+                if entry is None or (series_id in newest and newest[series_id][0] >= entry[3]):
+                    continue
+                ticks, value, message = block.read_series(series_id, entry[3], entry[3])[0]
+                newest[series_id] = (ticks, value, message)
+        return [(series_id, from_ticks(ticks), value, message) for series_id, (ticks, value, message) in newest.items()]
+
+    def first_timestamp(self, series_ids=None):
+        with self.lock:
+            if series_ids is None:
+                candidates = [block.min_ticks for block in self.blocks]
+                candidates.extend(min(points) for source in (self.sealing, self.head)
+                                  for points in source.values() if points)
+            else:
+                candidates = [block.series[series_id][2] for block in self.blocks
+                              for series_id in series_ids if series_id in block.series]
+                candidates.extend(min(source[series_id]) for source in (self.sealing, self.head)
+                                  for series_id in series_ids if source.get(series_id))
+        return from_ticks(min(candidates)) if candidates else None
+
+    def series_with_points(self, series_ids):
+        with self.lock:
+            found = {series_id for series_id in series_ids
+                     if self.head.get(series_id) or self.sealing.get(series_id)}
+            for block in self.blocks:
+                found.update(series_id for series_id in series_ids if series_id in block.series)
+        return found
+
+    def _new_block_name(self):
+        sequence = self.next_sequence
+        self.next_sequence += 1
+        return f"{sequence:08d}", sequence
+
+    def _replace_blocks(self, old_blocks, new_block):
+        # Caller holds self.lock; readers may still hold the old blocks' mappings
+        self.blocks = [block for block in self.blocks if block not in old_blocks]
+        if new_block is not None:
+            self.blocks.append(new_block)
+            self.blocks.sort(key=lambda block: block.sequence)
+        for block in old_blocks:
+            shutil.rmtree(block.path, ignore_errors=True)
+
+    def seal(self, now=None):
+        """Move head points from finished windows into a new block; returns the points sealed."""
+        now = time.time() if now is None else now
+        cutoff = to_ticks((now - self.grace) // self.block_duration * self.block_duration)
+        with self.structure_lock:
+            if cutoff <= self.sealed_until:
+                return 0
+            with self.lock:
+                for series_id in list(self.head):
+                    points = self.head[series_id]
+                    old = {ticks: point for ticks, point in points.items() if ticks < cutoff}
+                    if old:
+                        self.sealing[series_id] = old
+                        for ticks in old:
+                            del points[ticks]
+                        if not points:
+                            del self.head[series_id]
+                name, sequence = self._new_block_name()
+            count = sum(len(points) for points in self.sealing.values())
+            try:
+                block = Block.write(self.blocks_path, name, sequence, self.sealing) if count else None
+            except Exception:
+                # Put the points back; they are still in the WAL
+                with self.lock:
+                    for series_id, points in self.sealing.items():
+                        self.head.setdefault(series_id, {}).update(points)
+                    self.sealing = {}
+                raise
+            with self.lock:
+                self._replace_blocks([], block)
+                self.sealing = {}
+                self.sealed_until = cutoff
+                if block is not None:
+                    self._checkpoint_wal()
+            if block is not None:
+                logger.info(f"Sealed {count} points into block {block.name} ({block.size()} bytes)")
+            return count
+
+    def compact(self, now=None):
+        """Merge the blocks of each finished compact_duration window into one block."""
+        now = time.time() if now is None else now
+        window = to_ticks(self.compact_duration)
+        current = to_ticks(now) // window * window
+        with self.structure_lock:
+            with self.lock:
+                groups = {}
+                for block in self.blocks:
+                    if block.max_ticks < current:
+                        groups.setdefault(block.min_ticks // window, []).append(block)
+            for blocks in groups.values():
+                if len(blocks) < 2:
+                    continue
+                merged = {}
+                for block in blocks:
+                    for series_id, points in block.read_all().items():
+                        target = merged.setdefault(series_id, {})
+                        for ticks, point in points.items():
+                            target.setdefault(ticks, point)
+                with self.lock:
+                    name, _ = self._new_block_name()
+                # Keep the earliest sequence so the merged block still wins over later duplicates
+                new_block = Block.write(self.blocks_path, name, blocks[0].sequence, merged)
+                with self.lock:
+                    self._replace_blocks(blocks, new_block)
+                logger.info(f"Compacted {len(blocks)} blocks into {name}")
+
+    def delete(self, series_ids, start=None, end=None):
+        """Remove points of the given series in [start, end]; returns the number removed."""
+        start_ticks = to_ticks(start) if start is not None else MIN_TICKS
+        end_ticks = to_ticks(end) if end is not None else MAX_TICKS
+        series_ids = set(series_ids)
+        removed = 0
+        with self.structure_lock:
+            with self.lock:
+                for series_id in series_ids:
+                    points = self.head.get(series_id, {})
+                    doomed = [ticks for ticks in points if start_ticks <= ticks <= end_ticks]
+                    for ticks in doomed:
+                        del points[ticks]
+                    removed += len(doomed)
+                if removed:
+                    self._checkpoint_wal()
+                affected = [block for block in self.blocks if block.overlaps(start_ticks, end_ticks)
+                            and any(series_id in block.series for series_id in series_ids)]
+            for block in affected:
+                # Blocks are immutable, so the block is rewritten without those points
+                points_by_series = block.read_all()
+                for series_id in series_ids & points_by_series.keys():
+                    points = points_by_series[series_id]
+                    doomed = [ticks for ticks in points if start_ticks <= ticks <= end_ticks]
+                    for ticks in doomed:
+                        del points[ticks]
+                    removed += len(doomed)
+                with self.lock:
+                    name, _ = self._new_block_name()
+                new_block = Block.write(self.blocks_path, name, block.sequence, points_by_series)
+                with self.lock:
+                    self._replace_blocks([block], new_block)
+        return removed
+
+    def drop_before(self, cutoff):
+        """Drop blocks holding only points older than cutoff; returns their names."""
+        cutoff_ticks = to_ticks(cutoff)
+        with self.structure_lock, self.lock:
+            old = [block for block in self.blocks if block.max_ticks < cutoff_ticks]
+            self._replace_blocks(old, None)
+        for block in old:
+            logger.info(f"Dropped block {block.name} (data before {from_ticks(block.max_ticks):.0f})")
+        return [block.name for block in old]
+
+    def get_stats(self):
+        with self.lock:
+            blocks = list(self.blocks)
+            head_points = sum(len(points) for points in self.head.values())
+            head_series = len(self.head)
+        block_points = sum(block.point_count() for block in blocks)
+        block_bytes = sum(block.size() for block in blocks)
+        return {
+            "blocks": len(blocks),
+            "block_points": block_points,
+            "block_bytes": block_bytes,
+            "bytes_per_point": block_bytes / block_points if block_points else None,
+            "head_series": head_series,
+            "head_points": head_points,
+            "wal_bytes": os.path.getsize(self.wal_path) if os.path.exists(self.wal_path) else 0
+        }
+
+    def _maintenance_loop(self):
+        while not self.stop_event.wait(self.check_interval):
+            try:
+                self.seal()
+                self.compact()
+            except Exception as e:
+                logger.error(f"Error in time series store maintenance: {str(e)}")
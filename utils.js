@@ -30,6 +30,27 @@ async function fetchMetricHistory(hostname, metricName, startDate, endDate) {
     return history;
 }
 
+async function fetchHistoryBatch(hostname, metricNames, startDate, endDate) {
+    if (metricNames.length === 0) {
+        return {};
+    }
+    const response = await fetch('/fetch/history_batch', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            series: metricNames.map(metricName => ({ hostname, metric_name: metricName })),
+            start: startDate,
+            end: endDate
+        })
+    });
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+    const histories = await response.json();
+    console.log(`Fetched history for ${hostname}:`, histories);
+    return histories[hostname] || {};
+}
+
 let updateInterval;
 
 function setTimeRange(range) {
@@ -203,9 +224,10 @@ async function updateDashboard(hostname, isRealtimeUpdate = false) {
 
                 const datasets = {};
                 const messages = [];
-                const fetchPromises = metricNames.map(async (metricName) => {
+                const histories = await fetchHistoryBatch(hostname, metricNames, startDate.getTime() / 1000, endDate.getTime() / 1000);
+                for (const metricName of metricNames) {
                     try {
-                        const metricData = await fetchMetricHistory(hostname, metricName, startDate.getTime() / 1000, endDate.getTime() / 1000);
+                        const metricData = histories[metricName] || [];
                         console.log(`Fetched data for ${metricName}:`, metricData);
                         datasets[metricName] = processMetricData(metricData, metricName);
                         console.log(`Processed datasets for ${metricName}:`, datasets[metricName]);
@@ -226,9 +248,7 @@ async function updateDashboard(hostname, isRealtimeUpdate = false) {
                     } catch (error) {
                         console.error(`Error processing data for ${metricName}:`, error);
                     }
-                });
-
-                await Promise.all(fetchPromises);
+                }
 
                 console.log('All collected messages:', messages);
 
@@ -346,6 +366,7 @@ export {
     fetchHosts,
     fetchLatestMetrics,
     fetchMetricHistory,
+    fetchHistoryBatch,
     setTimeRange,
     updateFormVisibility,
     createHostSelector,